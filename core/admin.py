@@ -1,9 +1,11 @@
 from django.contrib import admin
-from .models import Patient, Staff, Appointment, Billing, Inventory,Doctor
+from .models import Patient, Staff, Appointment, Billing, Inventory,Doctor, DoctorSchedule, Job
 
 admin.site.register(Patient)
 admin.site.register(Staff)
 admin.site.register(Appointment)
 admin.site.register(Billing)
 admin.site.register(Inventory)
-admin.site.register(Doctor)
\ No newline at end of file
+admin.site.register(Doctor)
+admin.site.register(DoctorSchedule)
+admin.site.register(Job)
@@ -0,0 +1,156 @@
+import bisect
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .availability import NO_SLOT, PAST_TIME, SLOT_TAKEN, booked_starts, doctor_slots, is_booked, lock_doctor, working_weeks
+from .dashboard_cache import bump_dashboard_version
+from .models import OPEN_STATUSES, Appointment
+
+# A doctor's action applied to many appointments in one request. Ownership
+# is checked with one query for the whole batch and the changes are written
+# with one UPDATE (status actions) or one bulk_update (reschedules) in a
+# transaction, instead of a request and a save() per appointment. Every
+# appointment gets its own outcome. update() and bulk_update() send no
+# post_save signals, so the dashboard versions are bumped here.
+
+STATUS_ACTIONS = {'Accept': 'Accepted', 'Cancel': 'Canceled', 'Complete': 'Completed'}
+ACTIONS = [*STATUS_ACTIONS, 'Reschedule']
+
+OK = 'ok'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+CONFLICT = 'conflict'
+
+RACED = 'Another booking changed these slots meanwhile; try again.'
+
+Outcome = namedtuple('Outcome', ['id', 'result', 'message'])
+
+
+def apply_batch(doctor_id, action, ids, new_dates=None):
+    # [Outcome] in the order of `ids`; new_dates maps id -> datetime for
+    # Reschedule
+    ids = list(dict.fromkeys(ids))
+    rows = {
+        row['id']: row
+        for row in Appointment.objects.filter(id__in=ids, doctor_id=doctor_id).values('id', 'patient_id', 'date', 'status')
+    }
+    outcomes = {pk: Outcome(pk, NOT_FOUND, 'No such appointment of yours.') for pk in ids if pk not in rows}
+    if rows:
+        if action == 'Reschedule':
+            outcomes.update(_reschedule(doctor_id, rows, new_dates or {}))
+        else:
+            outcomes.update(_set_status(doctor_id, rows, STATUS_ACTIONS[action]))
+    changed = [rows[pk] for pk, outcome in outcomes.items() if outcome.result == OK]
+    if changed:
+        bump_dashboard_version('doctor', doctor_id)
+        for patient_id in {row['patient_id'] for row in changed}:
+            bump_dashboard_version('patient', patient_id)
+    return [outcomes[pk] for pk in ids]
+
+
+def _slot_lengths(doctor_id, rows, pks):
+    # pk -> length of the doctor's slot the appointment starts; appointments
+    # off the schedule (e.g. booked before it changed) get the longest slot
+    week = working_weeks([doctor_id])[doctor_id]
+    longest = timedelta(minutes=max((shift.minutes for shifts in week.values() for shift in shifts), default=0))
+    lengths = {}
+    for pk in pks:
+        when = rows[pk]['date']
+        slot = next(doctor_slots(doctor_id, week, [], when, when + timedelta(microseconds=1)), None)
+        lengths[pk] = slot.end - slot.start if slot is not None and slot.start == when else longest
+    return lengths
+
+
+def _set_status(doctor_id, rows, status):
+    outcomes = {}
+    targets = set(rows)
+    # Reopening a canceled or completed appointment must not double book its
+    # time, with another appointment or within the batch
+    reopened = [pk for pk, row in rows.items() if row['status'] not in OPEN_STATUSES] if status in OPEN_STATUSES else []
+    if reopened:
+        lengths = _slot_lengths(doctor_id, rows, reopened)
+        longest = max(lengths.values())
+        start = min(rows[pk]['date'] for pk in reopened) - longest
+        end = max(rows[pk]['date'] for pk in reopened) + longest
+    try:
+        with transaction.atomic():
+            lock_doctor(doctor_id)
+            if reopened:
+                booked = booked_starts([doctor_id], start, end, ignore=reopened)[doctor_id]
+                for pk in sorted(reopened, key=lambda pk: (rows[pk]['date'], pk)):
+                    if is_booked(booked, rows[pk]['date'], lengths[pk]):
+                        outcomes[pk] = Outcome(pk, CONFLICT, SLOT_TAKEN)
+                        targets.discard(pk)
+                    else:
+                        bisect.insort(booked, rows[pk]['date'])
+            Appointment.objects.filter(id__in=targets, doctor_id=doctor_id).update(status=status, updated_at=Now())
+            if reopened:
+                # As in _reschedule: check again after the write
+                booked = booked_starts([doctor_id], start, end)[doctor_id]
+                for pk in targets.intersection(reopened):
+                    when, length = rows[pk]['date'], lengths[pk]
+                    if bisect.bisect_left(booked, when + length) - bisect.bisect_right(booked, when - length) > 1:
+                        raise IntegrityError('Slot taken meanwhile')
+    except IntegrityError:
+        return {pk: Outcome(pk, CONFLICT, RACED) for pk in rows}
+    outcomes.update((pk, Outcome(pk, OK, '')) for pk in targets)
+    return outcomes
+
+
+def _reschedule(doctor_id, rows, new_dates):
+    outcomes = {}
+    moves = {}
+    now = timezone.now()
+    week = working_weeks([doctor_id])[doctor_id]
+    for pk in rows:
+        when = new_dates.get(pk)
+        if when is None:
+            outcomes[pk] = Outcome(pk, INVALID, 'Give the new date and time.')
+            continue
+        if when < now:
+            outcomes[pk] = Outcome(pk, INVALID, PAST_TIME)
+            continue
+        slot = next(doctor_slots(doctor_id, week, [], when, when + timedelta(microseconds=1)), None)
+        if slot is None or slot.start != when:
+            outcomes[pk] = Outcome(pk, INVALID, NO_SLOT)
+            continue
+        moves[pk] = slot
+    if not moves:
+        return outcomes
+
+    longest = max(slot.end - slot.start for slot in moves.values())
+    start = min(slot.start for slot in moves.values()) - longest
+    end = max(slot.end for slot in moves.values())
+    # The moving appointments give up their old times; the first of the
+    # batch to claim a slot gets it
+    booked = booked_starts([doctor_id], start, end, ignore=list(moves))[doctor_id]
+    for pk, slot in sorted(moves.items(), key=lambda item: (item[1].start, item[0])):
+        if is_booked(booked, slot.start, slot.end - slot.start):
+            outcomes[pk] = Outcome(pk, CONFLICT, SLOT_TAKEN)
+            del moves[pk]
+        else:
+            bisect.insort(booked, slot.start)
+    if not moves:
+        return outcomes
+
+    moved = [Appointment(id=pk, date=slot.start, status='Rescheduled', updated_at=now) for pk, slot in moves.items()]
+    try:
+        with transaction.atomic():
+            lock_doctor(doctor_id)
+            Appointment.objects.bulk_update(moved, ['date', 'status', 'updated_at'])
+            # As in book_slot: check again after the write, which bookings
+            # made since the check above cannot slip past
+            booked = booked_starts([doctor_id], start, end)[doctor_id]
+            for slot in moves.values():
+                length = slot.end - slot.start
+                if bisect.bisect_left(booked, slot.end) - bisect.bisect_right(booked, slot.start - length) > 1:
+                    raise IntegrityError('Slot taken meanwhile')
+    except IntegrityError:
+        outcomes.update((pk, Outcome(pk, CONFLICT, RACED)) for pk in moves)
+        return outcomes
+    outcomes.update((pk, Outcome(pk, OK, '')) for pk in moves)
+    return outcomes
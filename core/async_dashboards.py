@@ -0,0 +1,59 @@
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections, connection
+
+from .metrics import recording_queries
+from .query_budget import counting_queries
+
+# Helpers for the async dashboard views. Django's async ORM still runs every
+# query on the one thread shared by sync code, so queries awaited together
+# execute one after another. gather_queries() instead gives each query its
+# own worker thread and connection, so a dashboard takes about as long as its
+# slowest query rather than the sum of them.
+
+
+def _in_worker(query):
+    def run():
+        # Worker threads outlive requests; apply CONN_MAX_AGE and health
+        # checks the way request_started/request_finished do
+        close_old_connections()
+        try:
+            # Connect (and run the connection setup pragmas) outside the
+            # view's query count
+            connection.ensure_connection()
+            with counting_queries(), recording_queries():
+                return query()
+        finally:
+            close_old_connections()
+    return run
+
+
+async def gather_queries(*queries):
+    # Run zero-argument callables and return their results in order
+    if not settings.DASHBOARD_CONCURRENT_QUERIES:
+        return [await run_sync(query) for query in queries]
+    return await asyncio.gather(*(sync_to_async(_in_worker(query), thread_sensitive=False)() for query in queries))
+
+
+async def run_sync(func, *args, **kwargs):
+    # On the shared sync thread (and connection), e.g. for rendering templates
+    # or falling back to a sync view
+    def run():
+        with counting_queries():
+            return func(*args, **kwargs)
+    return await sync_to_async(run)()
+
+
+def async_login_required(view_func):
+    # login_required only wraps sync views on Django 5.0
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view_func(request, *args, **kwargs)
+    return wrapper
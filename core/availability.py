@@ -0,0 +1,184 @@
+import bisect
+import heapq
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import Appointment, Doctor, DoctorSchedule
+
+# Free appointment slots. A doctor's week is a set of shifts per weekday
+# (DoctorSchedule rows, or DEFAULT_WORKING_HOURS for doctors without any),
+# each cut into slots of the shift's length. Every appointment that is not
+# canceled takes up one slot's length from its start time, and a slot is
+# free when no such appointment overlaps it. A search walks its date range
+# in widening windows (WINDOW_DAYS); for each it loads the booked start times
+# of all its doctors with one indexed range query, kept sorted per doctor so
+# checking a slot is a bisect, and merges the doctors' slots lazily in time
+# order. Asking for the next 20 slots usually stops inside the first window.
+#
+# book_slot() saves an appointment so that concurrent bookings cannot take
+# the same slot twice; the appointment_doctor_slot_uniq constraint backs it.
+
+Shift = namedtuple('Shift', ['start', 'end', 'minutes'])
+Slot = namedtuple('Slot', ['doctor_id', 'start', 'end'])
+
+# Ends of the search windows, in days from the start of the search; the
+# last window runs to the end of the range
+WINDOW_DAYS = (1, 7)
+
+FREE = 'free'
+BOOKED = 'booked'
+CLOSED = 'closed'
+
+PAST_TIME = 'Choose a time in the future.'
+NO_SLOT = 'The doctor has no appointment slot starting at that time.'
+SLOT_TAKEN = 'That slot is already booked; choose another time.'
+
+
+class SlotTaken(Exception):
+    pass
+
+
+def _parse_time(value):
+    return value if isinstance(value, time) else time.fromisoformat(value)
+
+
+def default_week():
+    week = {}
+    for weekday, start, end, minutes in settings.DEFAULT_WORKING_HOURS:
+        week.setdefault(weekday, []).append(Shift(_parse_time(start), _parse_time(end), minutes))
+    return {weekday: sorted(shifts) for weekday, shifts in week.items()}
+
+
+def working_weeks(doctor_ids):
+    # doctor id -> {weekday: [Shift, ...] by start time}
+    weeks = {}
+    rows = DoctorSchedule.objects.filter(doctor_id__in=doctor_ids).values_list(
+        'doctor_id', 'weekday', 'start_time', 'end_time', 'slot_minutes',
+    )
+    for doctor_id, weekday, start, end, minutes in rows:
+        weeks.setdefault(doctor_id, {}).setdefault(weekday, []).append(Shift(start, end, minutes))
+    default = default_week()
+    return {
+        doctor_id: {weekday: sorted(shifts) for weekday, shifts in weeks[doctor_id].items()} if doctor_id in weeks else default
+        for doctor_id in doctor_ids
+    }
+
+
+def _longest_slot(weeks):
+    minutes = [shift.minutes for week in weeks.values() for shifts in week.values() for shift in shifts]
+    return timedelta(minutes=max(minutes, default=0))
+
+
+def booked_starts(doctor_ids, start, end, ignore=()):
+    # doctor id -> sorted start times of the appointments in (start, end)
+    # that still take up time, leaving out the appointments with pks in `ignore`
+    booked = {doctor_id: [] for doctor_id in doctor_ids}
+    appointments = Appointment.objects.filter(doctor_id__in=doctor_ids, date__gt=start, date__lt=end).exclude(status='Canceled')
+    if ignore:
+        appointments = appointments.exclude(pk__in=ignore)
+    for doctor_id, when in appointments.order_by('doctor_id', 'date').values_list('doctor_id', 'date'):
+        booked[doctor_id].append(when)
+    return booked
+
+
+def is_booked(starts, slot_start, length):
+    # Whether an appointment starting in (slot_start - length, slot_start + length) overlaps the slot
+    index = bisect.bisect_right(starts, slot_start - length)
+    return index < len(starts) and starts[index] < slot_start + length
+
+
+def doctor_slots(doctor_id, week, booked, start, end):
+    # The doctor's free slots starting in [start, end), in time order
+    day = timezone.localtime(start).date()
+    last_day = timezone.localtime(end).date()
+    while day <= last_day:
+        for shift in week.get(day.weekday(), ()):
+            length = timedelta(minutes=shift.minutes)
+            slot = timezone.make_aware(datetime.combine(day, shift.start))
+            close = timezone.make_aware(datetime.combine(day, shift.end))
+            if slot < start:
+                # Jump to the first slot boundary at or after start
+                slot += -((slot - start) // length) * length
+            while slot + length <= close and slot < end:
+                if not is_booked(booked, slot, length):
+                    yield Slot(doctor_id, slot, slot + length)
+                slot += length
+        day += timedelta(days=1)
+
+
+def free_slots(doctor_ids, start, end, limit=None):
+    # Free slots of the given doctors starting in [start, end), earliest
+    # first and by doctor id within the same time
+    doctor_ids = sorted(doctor_ids)
+    if not doctor_ids or start >= end:
+        return []
+    weeks = working_weeks(doctor_ids)
+    longest = _longest_slot(weeks)
+    found = []
+    window_ends = [start + timedelta(days=days) for days in WINDOW_DAYS if start + timedelta(days=days) < end] + [end]
+    window_start = start
+    for window_end in window_ends:
+        booked = booked_starts(doctor_ids, window_start - longest, window_end + longest)
+        slots = heapq.merge(
+            *(doctor_slots(doctor_id, weeks[doctor_id], booked[doctor_id], window_start, window_end) for doctor_id in doctor_ids),
+            key=attrgetter('start'),
+        )
+        found.extend(islice(slots, None if limit is None else limit - len(found)))
+        if limit is not None and len(found) >= limit:
+            break
+        window_start = window_end
+    return found
+
+
+def find_slot(doctor_id, when):
+    # The doctor's slot starting at `when`, booked or not, or None
+    week = working_weeks([doctor_id])[doctor_id]
+    slot = next(doctor_slots(doctor_id, week, [], when, when + timedelta(microseconds=1)), None)
+    return slot if slot is not None and slot.start == when else None
+
+
+def slot_is_booked(slot, ignore=None):
+    length = slot.end - slot.start
+    ignore = () if ignore is None else [ignore]
+    booked = booked_starts([slot.doctor_id], slot.start - length, slot.end, ignore=ignore)[slot.doctor_id]
+    return is_booked(booked, slot.start, length)
+
+
+def slot_status(doctor_id, when, ignore=None):
+    # FREE or BOOKED when `when` starts one of the doctor's slots, else CLOSED
+    slot = find_slot(doctor_id, when)
+    if slot is None:
+        return CLOSED
+    return BOOKED if slot_is_booked(slot, ignore) else FREE
+
+
+def lock_doctor(doctor_id):
+    # Queues PostgreSQL transactions changing a doctor's bookings behind each
+    # other; SQLite's write lock already does that from the first write on
+    if connection.features.has_select_for_update:
+        list(Doctor.objects.select_for_update().filter(pk=doctor_id).values_list('pk'))
+
+
+def book_slot(appointment, update_fields=None):
+    # Saves the appointment (new or moved) unless another appointment holds
+    # its slot by then, in which case SlotTaken is raised and nothing is
+    # saved. The check runs after the write, in the same transaction: on
+    # SQLite the write takes the database's write lock, so bookings run one
+    # at a time from there on, and PostgreSQL bookings queue on a lock of
+    # the doctor's row first. Identical start times are refused by the
+    # unique constraint as well.
+    slot = find_slot(appointment.doctor_id, appointment.date)
+    try:
+        with transaction.atomic():
+            lock_doctor(appointment.doctor_id)
+            appointment.save(update_fields=update_fields)
+            if slot is not None and slot_is_booked(slot, ignore=appointment.pk):
+                raise SlotTaken
+    except IntegrityError:
+        raise SlotTaken
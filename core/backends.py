@@ -0,0 +1,23 @@
+from django.contrib.auth import backends
+from django.contrib.auth.models import User
+
+from .roles import ROLE_MODELS
+
+
+class ModelBackend(backends.ModelBackend):
+    # The stock backend, fetching the user's profile rows in the same query so
+    # the login redirect knows the role without another one
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User._default_manager.select_related(*ROLE_MODELS).get(**{User.USERNAME_FIELD: username})
+        except User.DoesNotExist:
+            # Hash anyway so unknown usernames take as long as wrong passwords
+            User().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
@@ -0,0 +1,15 @@
+from .invoices import render_bill
+from .jobs import job
+
+
+def bill_description(patient, doctor):
+    patient = patient.user.get_full_name() if patient is not None else 'unknown patient'
+    doctor = doctor.user.get_full_name() if doctor is not None else 'unknown doctor'
+    return f"Bill generated for {patient} by Dr. {doctor}"
+
+
+# Renders a new bill's invoice into the invoice cache, off the request, so
+# the month-end archive finds it ready (see core.invoices)
+@job('render_invoice')
+def render_invoice(bill_id):
+    render_bill(bill_id)
@@ -0,0 +1,74 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+
+from .models import Appointment
+
+# Patient and doctor dashboards cache their rendered lists with the {% cache %}
+# tag, varying on a per-profile version number. Saving or deleting an
+# Appointment, Prescription or Billing row bumps the version of the patient
+# and doctor it belongs to, so their next view re-renders while everyone
+# else's cached fragments stay valid. Renaming a patient or doctor bumps the
+# dashboards that show the name (bump_counterpart_dashboards).
+
+
+def dashboard_cache():
+    return caches[settings.DASHBOARD_CACHE_ALIAS]
+
+
+def version_key(role, profile_id):
+    return 'core:dashboard-version:%s:%s' % (role, profile_id)
+
+
+def _fresh_version():
+    # Never reuse a version a fragment may still be cached under, even if the
+    # counter itself was evicted
+    return time.time_ns()
+
+
+def get_dashboard_version(role, profile_id):
+    cache = dashboard_cache()
+    key = version_key(role, profile_id)
+    version = cache.get(key)
+    if version is None:
+        version = _fresh_version()
+        cache.set(key, version, None)
+    return version
+
+
+def bump_dashboard_version(role, profile_id):
+    if profile_id is None:
+        return
+    cache = dashboard_cache()
+    key = version_key(role, profile_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _fresh_version(), None)
+
+
+def bump_counterpart_dashboards(role, profile_id):
+    # Each appointment on a dashboard shows the other side's name, so it is
+    # on the dashboards of everyone the patient or doctor has appointments with
+    if profile_id is None:
+        return
+    other = 'doctor' if role == 'patient' else 'patient'
+    appointments = Appointment.objects.filter(**{role + '_id': profile_id})
+    for other_id in appointments.values_list(other + '_id', flat=True).distinct():
+        bump_dashboard_version(other, other_id)
+
+
+def dashboard_context(request):
+    return {
+        'dashboard_cache_alias': settings.DASHBOARD_CACHE_ALIAS,
+        'dashboard_cache_timeout': settings.DASHBOARD_CACHE_TIMEOUT,
+        'dashboard_version': get_dashboard_version(request.role, request.profile_id),
+    }
+
+
+def fragment_is_cached(fragment_name, *vary_on):
+    # Whether {% cache ... fragment_name *vary_on %} would be a hit, so views
+    # can skip fetching what the fragment would render
+    return dashboard_cache().has_key(make_template_fragment_key(fragment_name, vary_on))
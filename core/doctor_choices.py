@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Doctor
+
+DOCTOR_CHOICES_KEY = 'core:doctor-choices'
+
+
+# The cached value maps doctor id -> (name, specialty, user id). It is built
+# with one query on a miss and dropped by the Doctor and User signals, so
+# rendering the booking form needs no queries until a doctor changes.
+
+def _timeout():
+    return getattr(settings, 'DOCTOR_CHOICES_TIMEOUT', 600)
+
+
+def _display_name(username, first_name, last_name):
+    return f"{first_name} {last_name}".strip() or username
+
+
+def rebuild_doctor_choices():
+    rows = Doctor.objects.values_list('id', 'user_id', 'user__username', 'user__first_name', 'user__last_name', 'specialty')
+    choices = {
+        doctor_id: (_display_name(username, first_name, last_name), specialty, user_id)
+        for doctor_id, user_id, username, first_name, last_name, specialty in rows
+    }
+    cache.set(DOCTOR_CHOICES_KEY, choices, _timeout())
+    return choices
+
+
+def _cached_choices():
+    choices = cache.get(DOCTOR_CHOICES_KEY)
+    if choices is None:
+        choices = rebuild_doctor_choices()
+    return choices
+
+
+def get_doctor_choices(specialty=None):
+    # [(doctor id, name, specialty)] sorted by name
+    choices = [
+        (doctor_id, name, doctor_specialty)
+        for doctor_id, (name, doctor_specialty, _) in _cached_choices().items()
+        if specialty is None or doctor_specialty == specialty
+    ]
+    choices.sort(key=lambda choice: (choice[1].lower(), choice[0]))
+    return choices
+
+
+def get_specialties():
+    return sorted({specialty for _, specialty, _ in _cached_choices().values()})
+
+
+def invalidate_doctor_choices():
+    # Dropped rather than patched: concurrent read-modify-writes of the one
+    # entry would lose updates. Dropped again once committed, in case a
+    # rebuild read the old rows before then.
+    cache.delete(DOCTOR_CHOICES_KEY)
+    transaction.on_commit(lambda: cache.delete(DOCTOR_CHOICES_KEY))
+
+
+def doctor_saved(doctor):
+    invalidate_doctor_choices()
+
+
+def doctor_deleted(doctor):
+    invalidate_doctor_choices()
+
+
+def user_saved(user, update_fields=None):
+    # Users are saved on every login, which cannot change a name; other saves
+    # only matter for doctors
+    if update_fields is not None and not {'username', 'first_name', 'last_name'} & set(update_fields):
+        return
+    choices = cache.get(DOCTOR_CHOICES_KEY)
+    if choices is not None and not any(user_id == user.pk for _, _, user_id in choices.values()):
+        return
+    invalidate_doctor_choices()
@@ -0,0 +1,28 @@
+import hashlib
+
+from django.db.models import Count, IntegerField, Max, Value
+
+# ETags for the JSON dashboard API. A response's ETag is derived from the
+# row count and latest updated_at of each queryset it serializes: a save
+# moves the latest marker and a delete changes the count. All querysets are
+# summed up in one UNION ALL query over the (owner, updated_at) indexes, so
+# a poll answered with 304 costs that one query and no serialization.
+# Fields read through joins (e.g. a doctor's name) are covered by `version`,
+# the viewer's dashboard version, which renames bump (see
+# core.dashboard_cache.bump_counterpart_dashboards).
+
+
+def _marker(queryset, position):
+    return (
+        queryset.order_by()
+        .values(position=Value(position, output_field=IntegerField()))
+        .annotate(rows=Count('pk'), latest=Max('updated_at'))
+        .values_list('position', 'rows', 'latest')
+    )
+
+
+def rows_etag(*querysets, version=None):
+    markers = [_marker(queryset, position) for position, queryset in enumerate(querysets)]
+    query = markers[0].union(*markers[1:], all=True) if len(markers) > 1 else markers[0]
+    summary = repr((sorted(query), version))
+    return hashlib.sha256(summary.encode()).hexdigest()[:32]
@@ -0,0 +1,129 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from .models import Billing, Inventory, Prescription
+
+# Streaming exports of the billing and prescription history. Rows are read
+# with .iterator() in chunks of EXPORT_CHUNK_SIZE (a server-side cursor on
+# PostgreSQL, chunked fetches on SQLite) and formatted one batch at a time,
+# so memory stays flat whatever the table size. Patient and doctor columns
+# hold the user's full name. The inventory export is in the format
+# import_inventory reads.
+
+EXPORTS = {
+    'bills': {
+        'model': Billing,
+        'date_field': 'date',
+        'columns': ['id', 'date', 'patient', 'doctor', 'amount', 'description'],
+    },
+    'prescriptions': {
+        'model': Prescription,
+        'date_field': 'created_at',
+        'columns': ['id', 'created_at', 'patient', 'doctor', 'medicine', 'dosage', 'duration'],
+    },
+    'inventory': {
+        'model': Inventory,
+        'date_field': 'date',
+        'columns': ['item_name', 'quantity', 'date'],
+    },
+}
+
+NAME_COLUMNS = ('patient', 'doctor')
+
+
+def supports_doctor_filter(kind):
+    return 'doctor' in EXPORTS[kind]['columns']
+
+
+class Echo:
+    # File-like target for csv.writer that returns each line instead of storing it
+    def write(self, value):
+        return value
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+
+
+FORMATS = {
+    'csv': ('text/csv', csv_lines),
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+}
+
+
+def _date_filters(model, date_field, date_from, date_to):
+    filters = {}
+    if isinstance(model._meta.get_field(date_field), models.DateTimeField):
+        # Compare against datetimes rather than __date so the index on the
+        # column can serve the range
+        if date_from:
+            filters[date_field + '__gte'] = timezone.make_aware(datetime.combine(date_from, time.min))
+        if date_to:
+            filters[date_field + '__lt'] = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))
+    else:
+        if date_from:
+            filters[date_field + '__gte'] = date_from
+        if date_to:
+            filters[date_field + '__lte'] = date_to
+    return filters
+
+
+def export_rows(kind, date_from=None, date_to=None, doctor=None, chunk_size=None):
+    spec = EXPORTS[kind]
+    model, columns = spec['model'], spec['columns']
+    lookups = []
+    for column in columns:
+        if column in NAME_COLUMNS:
+            lookups += [column + '__user__first_name', column + '__user__last_name']
+        else:
+            lookups.append(column)
+
+    queryset = model.objects.filter(**_date_filters(model, spec['date_field'], date_from, date_to))
+    if doctor is not None:
+        queryset = queryset.filter(doctor=doctor)
+    queryset = queryset.order_by('id').values_list(*lookups)
+
+    for values in queryset.iterator(chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE):
+        values = iter(values)
+        row = []
+        for column in columns:
+            if column in NAME_COLUMNS:
+                first_name, last_name = next(values), next(values)
+                row.append(('%s %s' % (first_name or '', last_name or '')).strip())
+            else:
+                row.append(next(values))
+        yield row
+
+
+def export_stream(kind, output_format='csv', batch_size=None, **filters):
+    # Join lines into batches so the response is not written one row at a time
+    batch_size = batch_size or settings.EXPORT_CHUNK_SIZE
+    columns = EXPORTS[kind]['columns']
+    lines = FORMATS[output_format][1](columns, export_rows(kind, **filters))
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
@@ -1,8 +1,15 @@
 # forms.py
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
-from .models import Patient, Doctor, Staff, Appointment, Billing, Inventory, Prescription
+from django.forms.models import ModelChoiceIterator, ModelChoiceIteratorValue
+from django.utils import timezone
+from .models import Patient, Doctor, Staff, Appointment, Billing, Inventory, InventoryMovement, Prescription
+from .doctor_choices import get_doctor_choices
+from .availability import BOOKED, CLOSED, NO_SLOT, PAST_TIME, SLOT_TAKEN, slot_status
+from .appointment_batch import ACTIONS
+from .exports import FORMATS, supports_doctor_filter
 
 class UserRegistrationForm(UserCreationForm):
     class Meta:
@@ -29,6 +36,48 @@ class StaffForm(forms.ModelForm):
         fields = ['role', 'phone']
 
 
+class CachedDoctorChoiceIterator(ModelChoiceIterator):
+    # Options come from the doctor choice cache instead of the queryset
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for doctor_id, name, specialty in get_doctor_choices(self.field.specialty):
+            yield (ModelChoiceIteratorValue(doctor_id, None), f"{name} - Doctor ({specialty})")
+
+    def __len__(self):
+        return len(get_doctor_choices(self.field.specialty)) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(get_doctor_choices(self.field.specialty))
+
+
+class DoctorChoiceField(forms.ModelChoiceField):
+    iterator = CachedDoctorChoiceIterator
+
+    def __init__(self, specialty=None, **kwargs):
+        self.specialty = specialty
+        queryset = Doctor.objects.all()
+        if specialty is not None:
+            queryset = queryset.filter(specialty=specialty)
+        super().__init__(queryset=queryset, **kwargs)
+
+
+def slot_taken_error():
+    return forms.ValidationError(SLOT_TAKEN, code='slot_taken')
+
+
+def check_slot(form, doctor_id, when, ignore=None):
+    # Adds an error on `date` unless `when` starts a free slot of the doctor
+    if when < timezone.now():
+        form.add_error('date', PAST_TIME)
+        return
+    status = slot_status(doctor_id, when, ignore=ignore)
+    if status == CLOSED:
+        form.add_error('date', forms.ValidationError(NO_SLOT, code='no_slot'))
+    elif status == BOOKED:
+        form.add_error('date', slot_taken_error())
+
+
 class AppointmentForm(forms.ModelForm):
     class Meta:
         model = Appointment
@@ -37,6 +86,66 @@ class AppointmentForm(forms.ModelForm):
             'date': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
         }
 
+    def __init__(self, *args, specialty=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['doctor'] = DoctorChoiceField(specialty=specialty, label=self.fields['doctor'].label)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        doctor, when = cleaned_data.get('doctor'), cleaned_data.get('date')
+        if doctor is not None and when is not None:
+            check_slot(self, doctor.pk, when)
+        return cleaned_data
+
+
+class RescheduleForm(forms.ModelForm):
+    class Meta:
+        model = Appointment
+        fields = ['date']
+
+    def clean(self):
+        cleaned_data = super().clean()
+        when = cleaned_data.get('date')
+        if when is not None:
+            check_slot(self, self.instance.doctor_id, when, ignore=self.instance.pk)
+        return cleaned_data
+
+
+class BatchActionForm(forms.Form):
+    # `action` is an action name applied to the checked appointment_ids, or
+    # "<action>:<id>" from the buttons of a single appointment. Reschedules
+    # take each appointment's time from new_date_<id>.
+    action = forms.CharField()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        action = cleaned_data.get('action')
+        if action is None:
+            return cleaned_data
+        action, _, single = action.partition(':')
+        if action not in ACTIONS:
+            raise forms.ValidationError('Unknown action.')
+        try:
+            ids = [int(value) for value in ([single] if single else self.data.getlist('appointment_ids'))]
+        except ValueError:
+            raise forms.ValidationError('Invalid appointment id.')
+        if not ids:
+            raise forms.ValidationError('Select at least one appointment.')
+        if len(ids) > settings.BATCH_ACTION_MAX_APPOINTMENTS:
+            raise forms.ValidationError('Select at most %d appointments.' % settings.BATCH_ACTION_MAX_APPOINTMENTS)
+        new_dates = {}
+        if action == 'Reschedule':
+            field = forms.DateTimeField(required=False)
+            for pk in ids:
+                try:
+                    when = field.clean(self.data.get('new_date_%d' % pk))
+                except forms.ValidationError:
+                    raise forms.ValidationError('Appointment #%d: enter a valid date and time.' % pk)
+                if when is not None:
+                    new_dates[pk] = when
+        cleaned_data.update(action=action, ids=ids, new_dates=new_dates)
+        return cleaned_data
+
 class BillingForm(forms.ModelForm):
     billing_amount = forms.DecimalField(label='Billing Amount', min_value=0)
 
@@ -54,7 +163,76 @@ class InventoryForm(forms.ModelForm):
             'date': forms.DateInput(attrs={'type': 'date'}),
         }
 
+# Name and date of an item; its quantity only changes through movements
+class InventoryDetailsForm(forms.ModelForm):
+    class Meta:
+        model = Inventory
+        fields = ['item_name', 'date']
+        widgets = {
+            'date': forms.DateInput(attrs={'type': 'date'}),
+        }
+
+class InventoryMovementForm(forms.Form):
+    kind = forms.ChoiceField(choices=InventoryMovement.KIND_CHOICES)
+    quantity = forms.IntegerField(help_text='Adjustments may be negative')
+    note = forms.CharField(max_length=255, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        kind, quantity = cleaned_data.get('kind'), cleaned_data.get('quantity')
+        if quantity is not None:
+            if kind == InventoryMovement.ADJUSTMENT and quantity == 0:
+                self.add_error('quantity', 'An adjustment must change the stock.')
+            elif kind != InventoryMovement.ADJUSTMENT and quantity <= 0:
+                self.add_error('quantity', 'Must be a positive number.')
+        return cleaned_data
+
+# One CSV row of a bulk inventory import. Same fields as InventoryForm, with
+# the quantity constraint checked in Python instead of by a query per row.
+class InventoryImportRowForm(forms.Form):
+    item_name = forms.CharField(max_length=100)
+    quantity = forms.IntegerField(min_value=0)
+    date = forms.DateField()
+
+class InventoryImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV with item_name, quantity and date columns')
+
 class PrescriptionForm(forms.ModelForm):
     class Meta:
         model = Prescription
         fields = ['medicine', 'dosage', 'duration']
+
+class DateRangeForm(forms.Form):
+    date_from = forms.DateField(required=False)
+    date_to = forms.DateField(required=False)
+    doctor = DoctorChoiceField(required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError('date_from must not be after date_to.')
+        return cleaned_data
+
+class AvailabilityForm(forms.Form):
+    doctor = DoctorChoiceField(required=False)
+    specialty = forms.CharField(required=False)
+    date_from = forms.DateField(required=False)
+    days = forms.IntegerField(min_value=1, required=False)
+    limit = forms.IntegerField(min_value=1, required=False)
+
+class ExportFilterForm(DateRangeForm):
+    format = forms.ChoiceField(choices=[(name, name) for name in FORMATS], required=False)
+
+    def __init__(self, *args, kind=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kind = kind
+
+    def clean_format(self):
+        return self.cleaned_data['format'] or 'csv'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('doctor') and self.kind and not supports_doctor_filter(self.kind):
+            raise forms.ValidationError('The %s export cannot be filtered by doctor.' % self.kind)
+        return cleaned_data
@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    # Django's PBKDF2 hasher with the work factor taken from
+    # settings.PASSWORD_PBKDF2_ITERATIONS. Hashes made with another count
+    # still verify and are rehashed at the configured count on the next login.
+    @property
+    def iterations(self):
+        return settings.PASSWORD_PBKDF2_ITERATIONS
@@ -0,0 +1,89 @@
+from django.db import connection, transaction
+from django.db.models import DateTimeField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Inventory, InventoryMovement, InventorySnapshot
+
+# Stock changes go through record_movement(): one conditional UPDATE with an
+# F() expression plus one ledger row, in a transaction. The database does the
+# arithmetic, so concurrent receipts and dispenses cannot overwrite each
+# other, and a dispense larger than the stock is refused instead of going
+# negative. Inventory.quantity stays the current stock (an O(1) read);
+# snapshots let the ledger be replayed from a recent point instead of from
+# the first movement.
+
+
+class InsufficientStock(ValueError):
+    pass
+
+
+SIGNS = {
+    InventoryMovement.RECEIPT: 1,
+    InventoryMovement.DISPENSE: -1,
+    InventoryMovement.ADJUSTMENT: 1,
+}
+
+
+def record_movement(inventory_id, kind, quantity, user=None, note=''):
+    # quantity is positive for receipts and dispenses; adjustments are signed
+    change = SIGNS[kind] * quantity
+    items = Inventory.objects.filter(pk=inventory_id)
+    if change < 0:
+        items = items.filter(quantity__gte=-change)
+    with transaction.atomic():
+        if not items.update(quantity=F('quantity') + change):
+            if Inventory.objects.filter(pk=inventory_id).exists():
+                raise InsufficientStock('Not enough stock for a change of %d.' % change)
+            raise Inventory.DoesNotExist('Inventory item %s does not exist.' % inventory_id)
+        return InventoryMovement.objects.create(
+            inventory_id=inventory_id, kind=kind, quantity_change=change, created_by=user, note=note,
+        )
+
+
+def record_opening_stock(inventory, user=None, note='Opening stock'):
+    # For a new item saved with its starting quantity already set
+    if inventory.quantity:
+        InventoryMovement.objects.create(
+            inventory=inventory, kind=InventoryMovement.RECEIPT, quantity_change=inventory.quantity,
+            created_by=user, note=note,
+        )
+
+
+def take_snapshots():
+    # One INSERT ... SELECT: each item's quantity together with the newest
+    # movement already counted in it, without reading the rows back; returns
+    # the number of snapshots taken
+    last_movement = (
+        InventoryMovement.objects.filter(inventory=OuterRef('pk')).order_by('-id').values('id')[:1]
+    )
+    rows = Inventory.objects.order_by().annotate(
+        last_movement=Coalesce(Subquery(last_movement), 0),
+        taken=Value(timezone.now(), output_field=DateTimeField()),
+    ).values_list('pk', 'quantity', 'last_movement', 'taken')
+    select, params = rows.query.sql_with_params()
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(InventorySnapshot._meta.get_field(name).column) for name in ('inventory', 'quantity', 'last_movement_id', 'taken_at'))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) %s' % (qn(InventorySnapshot._meta.db_table), columns, select), params)
+        return cursor.rowcount
+
+
+def with_ledger_quantity(queryset=None, until=None):
+    # Annotate items with ledger_quantity: the latest snapshot (taken by
+    # `until`, if given) plus the movements recorded after it. Equal to
+    # quantity unless stock was changed outside record_movement().
+    queryset = Inventory.objects.all() if queryset is None else queryset
+    snapshots = InventorySnapshot.objects.filter(inventory=OuterRef('pk'))
+    movements = InventoryMovement.objects.filter(inventory=OuterRef('pk'), id__gt=OuterRef('snapshot_movement_id'))
+    if until is not None:
+        snapshots = snapshots.filter(taken_at__lte=until)
+        movements = movements.filter(created_at__lte=until)
+    snapshots = snapshots.order_by('-taken_at', '-id')
+    movement_total = movements.values('inventory').annotate(total=Sum('quantity_change')).values('total')
+    return queryset.annotate(
+        snapshot_quantity=Coalesce(Subquery(snapshots.values('quantity')[:1]), 0),
+        snapshot_movement_id=Coalesce(Subquery(snapshots.values('last_movement_id')[:1]), 0),
+    ).annotate(
+        ledger_quantity=F('snapshot_quantity') + Coalesce(Subquery(movement_total), 0),
+    )
@@ -0,0 +1,110 @@
+import csv
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from .forms import InventoryImportRowForm
+from .models import Inventory, InventoryMovement
+
+# Bulk inventory upsert from CSV in the export format (item_name, quantity,
+# date). The file is read row by row; valid rows are applied in chunks of
+# INVENTORY_IMPORT_CHUNK_SIZE, each chunk costing one lookup of the existing
+# items plus one batched UPDATE and bulk inserts of new items and their
+# ledger movements. Quantities in the file are counted stock; the difference
+# from the current stock is recorded as an adjustment. item_name is not
+# unique, so when several rows share a name the oldest one is updated.
+# Invalid rows are reported with their line number and skipped; the rest of
+# the file is still imported. A file that cannot be read to the end (not
+# UTF-8, broken CSV) raises ValueError and imports nothing: the chunks are
+# written in one transaction.
+
+COLUMNS = ['item_name', 'quantity', 'date']
+IMPORT_NOTE = 'CSV import'
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    updated: int = 0
+    errors: list = field(default_factory=list)  # (line number, message)
+
+
+def _flush(rows, result):
+    # rows: {item_name: cleaned_data}; later lines of the file already won
+    updates, movements, to_create = [], [], []
+    with transaction.atomic():
+        existing = {}
+        items = Inventory.objects.select_for_update().filter(item_name__in=list(rows)).order_by('-id')
+        for item_name, pk, quantity in items.values_list('item_name', 'id', 'quantity'):
+            existing[item_name] = (pk, quantity)
+        for name, data in rows.items():
+            if name not in existing:
+                to_create.append(Inventory(**data))
+                continue
+            # The file holds counted stock: apply the difference as an
+            # adjustment so the ledger still adds up to the quantity
+            pk, quantity = existing[name]
+            change = data['quantity'] - quantity
+            updates.append((change, connection.ops.adapt_datefield_value(data['date']), pk))
+            if change:
+                movements.append(InventoryMovement(
+                    inventory_id=pk, kind=InventoryMovement.ADJUSTMENT, quantity_change=change, note=IMPORT_NOTE,
+                ))
+        # bulk_update() compiles a CASE WHEN per field and row, which costs
+        # more than the writes themselves; a parameterised UPDATE per row
+        # through executemany does not
+        qn = connection.ops.quote_name
+        sql = 'UPDATE %s SET %s = %s + %%s, %s = %%s WHERE %s = %%s' % (
+            qn(Inventory._meta.db_table), qn('quantity'), qn('quantity'), qn('date'), qn('id'),
+        )
+        if updates:
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, updates)
+        for item in Inventory.objects.bulk_create(to_create):
+            if item.quantity:
+                movements.append(InventoryMovement(
+                    inventory=item, kind=InventoryMovement.RECEIPT, quantity_change=item.quantity, note=IMPORT_NOTE,
+                ))
+        InventoryMovement.objects.bulk_create(movements)
+    result.updated += len(updates)
+    result.created += len(to_create)
+
+
+def import_inventory_csv(lines, chunk_size=None):
+    reader = csv.DictReader(lines)
+    try:
+        with transaction.atomic():
+            return _import_rows(reader, chunk_size or settings.INVENTORY_IMPORT_CHUNK_SIZE)
+    except csv.Error as e:
+        raise ValueError('Unreadable CSV after line %d: %s' % (reader.line_num, e))
+
+
+def _import_rows(reader, chunk_size):
+    missing = [column for column in COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError('Missing column(s): %s' % ', '.join(missing))
+
+    # Clean with the fields of a single form: a bound form per row deep-copies
+    # its fields every time, which dominated large imports
+    fields = InventoryImportRowForm().fields
+    result = ImportResult()
+    rows = {}
+    for row in reader:
+        data, errors = {}, []
+        for name, form_field in fields.items():
+            try:
+                data[name] = form_field.clean((row[name] or '').strip())
+            except ValidationError as e:
+                errors.append('%s: %s' % (name, ' '.join(e.messages)))
+        if errors:
+            result.errors.append((reader.line_num, '; '.join(errors)))
+            continue
+        rows[data['item_name']] = data
+        if len(rows) >= chunk_size:
+            _flush(rows, result)
+            rows = {}
+    if rows:
+        _flush(rows, result)
+    return result
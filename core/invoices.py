@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import zipfile
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.template.loader import get_template
+
+from .exports import _date_filters
+from .metrics import registry
+from .models import Billing
+
+logger = logging.getLogger(__name__)
+
+# Invoices: one self-contained HTML document per bill, rendered in bulk into
+# a zip archive. Bills are read in chunks of INVOICE_CHUNK_SIZE and rendered
+# by a pool of INVOICE_PROCESSES worker processes, with at most two chunks
+# per process in flight, so memory stays flat whatever the date range.
+# Rendered invoices are kept under INVOICE_CACHE_DIR, named after the bill
+# id and a hash of everything the invoice shows (and of the template), so a
+# bill is only rendered again once it or the template changed; a deleted
+# bill's files go with it (bill_deleted), and prune_cache() sweeps files of
+# bills removed without signals. The archive is written to an unseekable
+# stream and handed out as it grows.
+
+FIELDS = [
+    'id', 'date', 'amount', 'description', 'patient_id', 'patient__user__first_name', 'patient__user__last_name',
+    'doctor_id', 'doctor__user__first_name', 'doctor__user__last_name', 'doctor__specialty',
+]
+
+registry.describe('hms_invoices_total', 'counter', 'Invoices put into archives, by whether they came from the cache')
+registry.describe('hms_invoice_archive_seconds', 'counter', 'Time spent building invoice archives')
+
+
+class ArchiveStats:
+    def __init__(self):
+        self.invoices = 0
+        self.cached = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        return self.invoices / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return '%d invoices (%d from cache, %d rendered) in %.2fs: %.1f invoices/s, %.1f KiB archive' % (
+            self.invoices, self.cached, self.invoices - self.cached, self.seconds, self.rate, self.bytes / 1024,
+        )
+
+
+def invoice_rows(date_from=None, date_to=None, doctor=None, chunk_size=None):
+    queryset = Billing.objects.filter(**_date_filters(Billing, 'date', date_from, date_to))
+    if doctor is not None:
+        queryset = queryset.filter(doctor=doctor)
+    return queryset.order_by('id').values(*FIELDS).iterator(chunk_size=chunk_size or settings.INVOICE_CHUNK_SIZE)
+
+
+@lru_cache(maxsize=None)
+def template_digest():
+    return hashlib.sha256(get_template('invoice.html').template.source.encode()).hexdigest()
+
+
+def content_hash(row):
+    document = json.dumps(row, sort_keys=True, default=str) + template_digest()
+    return hashlib.sha256(document.encode()).hexdigest()[:20]
+
+
+def cache_path(bill_id, digest):
+    # Spread over 256 directories so none grows too large to list
+    return Path(settings.INVOICE_CACHE_DIR) / ('%02x' % (bill_id % 256)) / ('%d-%s.html' % (bill_id, digest))
+
+
+def _cached_versions(directory, bill_id):
+    prefix = '%d-' % bill_id
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return []
+    return [Path(entry.path) for entry in entries if entry.name.startswith(prefix) and entry.name.endswith('.html')]
+
+
+def bill_deleted(bill_id):
+    for path in _cached_versions(cache_path(bill_id, '').parent, bill_id):
+        path.unlink(missing_ok=True)
+
+
+def prune_cache(chunk_size=None):
+    # Removes the cached invoices of bills that no longer exist; returns how many
+    removed = 0
+    size = chunk_size or settings.INVOICE_CHUNK_SIZE
+    root = Path(settings.INVOICE_CACHE_DIR)
+    if not root.is_dir():
+        return 0
+    for directory in sorted(root.iterdir()):
+        if not directory.is_dir():
+            continue
+        files = {}
+        for path in directory.glob('*.html'):
+            bill_id, _, _ = path.name.partition('-')
+            if bill_id.isdigit():
+                files.setdefault(int(bill_id), []).append(path)
+        ids = sorted(files)
+        existing = set()
+        for start in range(0, len(ids), size):
+            existing.update(Billing.objects.filter(id__in=ids[start:start + size]).values_list('id', flat=True))
+        for bill_id in set(ids) - existing:
+            for path in files[bill_id]:
+                path.unlink(missing_ok=True)
+                removed += 1
+    return removed
+
+
+def render_invoice(row):
+    return get_template('invoice.html').render({'bill': row})
+
+
+def _write_atomically(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def render_chunk(rows):
+    # Runs in the worker processes: [(bill id, cached file, from cache)]
+    done = []
+    for row in rows:
+        path = cache_path(row['id'], content_hash(row))
+        cached = path.exists()
+        if not cached:
+            _write_atomically(path, render_invoice(row))
+            # Drop the versions rendered before the bill changed
+            for stale in _cached_versions(path.parent, row['id']):
+                if stale != path:
+                    stale.unlink(missing_ok=True)
+        done.append((row['id'], str(path), cached))
+    return done
+
+
+def render_bill(bill_id):
+    # Renders one bill's invoice into the cache unless it is there already
+    rows = list(Billing.objects.filter(pk=bill_id).values(*FIELDS))
+    return render_chunk(rows)[0] if rows else None
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def rendered_invoices(processes=None, chunk_size=None, **filters):
+    # (bill id, cached file, from cache) for each bill matching `filters`, by id
+    processes = processes or settings.INVOICE_PROCESSES
+    chunk_size = chunk_size or settings.INVOICE_CHUNK_SIZE
+    if processes <= 1:
+        for chunk in _chunks(invoice_rows(chunk_size=chunk_size, **filters), chunk_size):
+            yield from render_chunk(chunk)
+        return
+    # Forked workers must not share the parent's database connection; they
+    # only render, so the rows are read before handing them out
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        pending = deque()
+        for chunk in _chunks(invoice_rows(chunk_size=chunk_size, **filters), chunk_size):
+            pending.append(pool.apply_async(render_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+class ArchiveBuffer:
+    # Write-only file object for ZipFile; take() hands over what was written
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def invoice_archive(stats=None, **options):
+    # Yields the bytes of a zip of the invoices; `options` go to
+    # rendered_invoices(). Fills in `stats` (an ArchiveStats) as it goes.
+    stats = stats if stats is not None else ArchiveStats()
+    started = time.perf_counter()
+    buffer = ArchiveBuffer()
+    try:
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for bill_id, path, cached in rendered_invoices(**options):
+                archive.write(path, 'invoice-%d.html' % bill_id)
+                stats.invoices += 1
+                stats.cached += cached
+                if buffer.size >= settings.INVOICE_ARCHIVE_CHUNK_BYTES:
+                    stats.bytes += buffer.size
+                    yield buffer.take()
+        stats.bytes += buffer.size
+        yield buffer.take()
+    finally:
+        stats.seconds = time.perf_counter() - started
+        registry.increment('hms_invoices_total', (('cached', 'true'),), stats.cached)
+        registry.increment('hms_invoices_total', (('cached', 'false'),), stats.invoices - stats.cached)
+        registry.increment('hms_invoice_archive_seconds', (), stats.seconds)
+        logger.info('Invoice archive: %s', stats)
@@ -0,0 +1,144 @@
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Background jobs kept in the Job table. enqueue() adds a row, in the
+# caller's transaction, so a job exists exactly when the change it follows
+# up on was committed. Workers (manage.py run_workers) claim due jobs with a
+# conditional UPDATE, which only one of them can win, and run the handler
+# registered under the job's name. A handler that raises is retried after
+# JOB_RETRY_DELAY seconds, doubling each time, until the job's max_attempts
+# are used up; a job still running after JOB_TIMEOUT seconds is taken to
+# have lost its worker and queued again. Handlers can therefore run more
+# than once and must be idempotent.
+
+handlers = {}
+
+
+def job(name):
+    # Registers the decorated function as the handler of `name`; it is
+    # called with the job's payload as keyword arguments
+    def decorator(func):
+        handlers[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, key=None, run_at=None, max_attempts=None, **payload):
+    # Adds a job, or returns the one already enqueued under `key`
+    if name not in handlers:
+        raise ValueError('No job handler named %r' % name)
+    fields = {
+        'name': name,
+        'payload': payload,
+        'run_at': run_at or timezone.now(),
+        'max_attempts': max_attempts or settings.JOB_MAX_ATTEMPTS,
+    }
+    if key is None:
+        return Job.objects.create(**fields)
+    existing = Job.objects.filter(key=key).first()
+    if existing is not None:
+        return existing
+    try:
+        with transaction.atomic():
+            return Job.objects.create(key=key, **fields)
+    except IntegrityError:
+        # Enqueued by another request since the lookup
+        return Job.objects.get(key=key)
+
+
+def worker_name():
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+
+def requeue_stale():
+    # Jobs whose worker died mid-run; they are retried like a failure would be
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_TIMEOUT)
+    stale = Job.objects.filter(status=Job.RUNNING, started_at__lt=cutoff)
+    requeued = stale.filter(attempts__lt=F('max_attempts')).update(
+        status=Job.QUEUED, run_at=timezone.now(), last_error='Timed out after %ds' % settings.JOB_TIMEOUT,
+    )
+    stale.update(status=Job.FAILED, finished_at=timezone.now(), last_error='Timed out after %ds' % settings.JOB_TIMEOUT)
+    return requeued
+
+
+def claim(worker, names=None):
+    # The next due job, marked as running for `worker`, or None
+    while True:
+        now = timezone.now()
+        due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now)
+        if names:
+            due = due.filter(name__in=names)
+        pk = due.order_by('run_at', 'id').values_list('id', flat=True).first()
+        if pk is None:
+            return None
+        claimed = Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker, started_at=now, attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Job.objects.get(pk=pk)
+        # Another worker won this one; look again
+
+
+def run(job):
+    handler = handlers.get(job.name)
+    try:
+        if handler is None:
+            raise LookupError('No job handler named %r' % job.name)
+        handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        finished = Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker)
+        if job.attempts < job.max_attempts and handler is not None:
+            delay = settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            finished.update(status=Job.QUEUED, run_at=timezone.now() + timedelta(seconds=delay), last_error=error)
+            logger.warning('Job %s #%d failed (attempt %d of %d), retrying in %ds\n%s', job.name, job.pk, job.attempts, job.max_attempts, delay, error)
+            return Job.QUEUED
+        finished.update(status=Job.FAILED, finished_at=timezone.now(), last_error=error)
+        logger.error('Job %s #%d failed for good after %d attempts\n%s', job.name, job.pk, job.attempts, error)
+        return Job.FAILED
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(status=Job.SUCCEEDED, finished_at=timezone.now())
+    return Job.SUCCEEDED
+
+
+def run_pending(worker=None, names=None, limit=None):
+    # Runs due jobs one after another until none is left (or `limit` ran);
+    # returns {status: count}
+    worker = worker or worker_name()
+    counts = {}
+    while limit is None or sum(counts.values()) < limit:
+        job = claim(worker, names)
+        if job is None:
+            break
+        status = run(job)
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def work(stop, names=None):
+    # Worker thread loop: runs jobs until `stop` (a threading.Event) is set,
+    # polling every JOB_POLL_INTERVAL seconds while the queue is empty
+    worker = worker_name()
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            ran = run_pending(worker, names, limit=100)
+        except Exception:
+            # E.g. the database went away; keep the thread alive and retry
+            logger.exception('Job worker %s failed to claim a job', worker)
+            ran = {}
+        if not ran:
+            stop.wait(settings.JOB_POLL_INTERVAL)
+    close_old_connections()
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from core.revenue import rebuild_revenue
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the DailyRevenue rollup from Billing, one window of days per transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', help='First day to rebuild (default: first bill)')
+        parser.add_argument('--date-to', help='Last day to rebuild (default: last bill)')
+        parser.add_argument('--chunk-days', type=int, default=31, help='Days rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        bounds = {}
+        for name in ('date_from', 'date_to'):
+            value = options[name]
+            if value is not None:
+                bounds[name] = parse_date(value)
+                if bounds[name] is None:
+                    raise CommandError('Invalid date %r; use YYYY-MM-DD' % value)
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days must be at least 1')
+
+        def progress(start, end, rows):
+            if options['verbosity'] > 1:
+                self.stdout.write('%s..%s: %d row(s)' % (start, end, rows))
+
+        written = rebuild_revenue(chunk_days=options['chunk_days'], progress=progress, **bounds)
+        self.stdout.write(self.style.SUCCESS('Wrote %d daily revenue row(s)' % written))
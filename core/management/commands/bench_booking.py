@@ -0,0 +1,114 @@
+import logging
+import statistics
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from core.availability import free_slots
+from core.models import Appointment, Doctor, Patient
+
+
+def run_bookings(client, url, posts, barrier, results):
+    # Runs in a worker thread, with its own database connection
+    try:
+        barrier.wait()
+        for data in posts:
+            start = time.perf_counter()
+            response = client.post(url, data)
+            results.append((response.status_code, time.perf_counter() - start))
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Fire concurrent bookings at a few free slots of one doctor and check none is booked twice'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=400, help='Booking attempts in total')
+        parser.add_argument('--threads', type=int, default=16, help='Threads posting bookings at the same time')
+        parser.add_argument('--slots', type=int, default=10, help='Free slots the bookings compete for')
+        parser.add_argument('--doctor-user', help='Username of the doctor to book; defaults to the first doctor')
+        parser.add_argument('--host', default='localhost', help='Host header; must be in ALLOWED_HOSTS')
+        parser.add_argument('--keep', action='store_true', help='Keep the booked appointments')
+
+    def handle(self, *args, **options):
+        doctor = self.doctor(options['doctor_user'])
+        patients = list(Patient.objects.select_related('user').order_by('id')[:options['threads']])
+        if not patients:
+            raise CommandError('No patient found; run seed_hospital first')
+        slots = free_slots([doctor.pk], timezone.now() + timedelta(days=1), timezone.now() + timedelta(days=365), options['slots'])
+        if not slots:
+            raise CommandError('Doctor %s has no free slot in the coming year' % doctor.user.username)
+        # Lost races are expected; the slow request log would bury the report
+        logging.getLogger('core.metrics.slow').setLevel(logging.CRITICAL)
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+        url = reverse('book_appointment')
+        posts = [
+            {'doctor': doctor.pk, 'date': timezone.localtime(slots[i % len(slots)].start).strftime('%Y-%m-%dT%H:%M')}
+            for i in range(options['bookings'])
+        ]
+        threads = []
+        results = []
+        barrier = threading.Barrier(options['threads'] + 1)
+        last_id = Appointment.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for index in range(options['threads']):
+            client = Client(HTTP_HOST=options['host'], raise_request_exception=False)
+            client.force_login(patients[index % len(patients)].user)
+            thread = threading.Thread(target=run_bookings, args=(client, url, posts[index::options['threads']], barrier, results))
+            thread.start()
+            threads.append(thread)
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        created = Appointment.objects.filter(id__gt=last_id, doctor=doctor, date__in=[slot.start for slot in slots])
+        try:
+            self.report(options, slots, results, elapsed, created)
+        finally:
+            if not options['keep']:
+                created.delete()
+
+    def doctor(self, username):
+        doctors = Doctor.objects.select_related('user')
+        if username:
+            try:
+                return doctors.get(user__username=username)
+            except Doctor.DoesNotExist:
+                raise CommandError('%s is not a doctor' % username)
+        doctor = doctors.order_by('id').first()
+        if doctor is None:
+            raise CommandError('No doctor found; run seed_hospital first')
+        return doctor
+
+    def report(self, options, slots, results, elapsed, created):
+        statuses = [status for status, _ in results]
+        booked = statuses.count(302)
+        conflicts = statuses.count(409)
+        failed = len(statuses) - booked - conflicts
+        timings = sorted(seconds for _, seconds in results)
+        self.stdout.write('%d bookings of %d slots from %d threads' % (len(results), len(slots), options['threads']))
+        self.stdout.write('booked         %8d' % booked)
+        self.stdout.write('conflicts      %8d' % conflicts)
+        self.stdout.write('failed         %8d' % failed)
+        self.stdout.write('booking p50    %8.1fms' % (statistics.median(timings) * 1000))
+        self.stdout.write('booking p95    %8.1fms' % (timings[int(len(timings) * 0.95) - 1] * 1000 if len(timings) > 1 else timings[0] * 1000))
+        self.stdout.write('throughput     %8.1f bookings/s' % (len(results) / elapsed))
+
+        doubled = created.exclude(status='Canceled').values('date').annotate(n=Count('id')).filter(n__gt=1)
+        if doubled.exists() or created.count() != booked or booked > len(slots):
+            raise CommandError('Double bookings: %d appointments for %d slots, %d bookings accepted' % (
+                created.count(), len(slots), booked,
+            ))
+        if failed:
+            raise CommandError('%d bookings failed with an unexpected status' % failed)
+        self.stdout.write(self.style.SUCCESS('No double bookings'))
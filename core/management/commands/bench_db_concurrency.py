@@ -0,0 +1,143 @@
+import random
+import statistics
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, close_old_connections, connection, connections, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from core.models import Appointment, Doctor, Patient
+
+# Connection settings compared by --compare. 'defaults' is what the project
+# shipped with: SQLite's own journal and sync modes, a new connection per
+# request and sqlite3's 5 second busy timeout. The journal mode is stored in
+# the database file, so it is switched once per run, not by the per-connection
+# pragmas, and the file's own mode is put back afterwards.
+DEFAULTS = {'journal_mode': 'DELETE', 'pragmas': {'synchronous': 'FULL'}, 'conn_max_age': 0, 'timeout': 5}
+
+
+def journal_mode(mode=None):
+    # The database's journal mode, after switching it to `mode` if given
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode' if mode is None else 'PRAGMA journal_mode = %s' % mode)
+        return cursor.fetchone()[0].upper()
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput of concurrent dashboard reads and booking writes on the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10, help='Duration of each run')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of operations that book an appointment')
+        parser.add_argument('--compare', action='store_true', help='Run with the pre-profile defaults first, then with the configured profile')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        patients = list(Patient.objects.order_by('id').values_list('id', flat=True)[:1000])
+        doctors = list(Doctor.objects.order_by('id').values_list('id', flat=True)[:1000])
+        if not patients or not doctors:
+            raise CommandError('Need patients and doctors; run seed_hospital first')
+
+        db = connections.settings[DEFAULT_DB_ALIAS]
+        configured = {
+            'journal_mode': settings.SQLITE_JOURNAL_MODE,
+            'pragmas': getattr(settings, 'SQLITE_PRAGMAS', {}),
+            'conn_max_age': db['CONN_MAX_AGE'],
+            'timeout': db.get('OPTIONS', {}).get('timeout', 5),
+        }
+        profiles = [('defaults', DEFAULTS), ('configured', configured)] if options['compare'] else [('configured', configured)]
+        self.stdout.write('%s database, %d threads, %.0f%% writes, %ss per run' % (
+            connection.vendor, options['threads'], options['write_ratio'] * 100, options['seconds'],
+        ))
+        results = {}
+        for name, profile in profiles:
+            results[name] = self.run(profile, patients, doctors, options)
+            self.stdout.write(self.format_result(name, results[name]))
+        if options['compare']:
+            self.stdout.write('Throughput gain: %.1fx' % (results['configured']['ops'] / max(results['defaults']['ops'], 1)))
+
+    def run(self, profile, patients, doctors, options):
+        db = connections.settings[DEFAULT_DB_ALIAS]
+        saved = db['CONN_MAX_AGE'], dict(db.get('OPTIONS', {}))
+        connections.close_all()
+        db['CONN_MAX_AGE'] = profile['conn_max_age']
+        original_mode = None
+        if connection.vendor == 'sqlite':
+            db.setdefault('OPTIONS', {})['timeout'] = profile['timeout']
+            original_mode = journal_mode()
+            journal_mode(profile['journal_mode'])
+            connection.close()
+        created = []
+        stats = {'reads': [], 'writes': [], 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['seconds']
+
+        def worker(index):
+            rng = random.Random(options['seed'] + index)
+            reads, writes, errors, ids = [], [], 0, []
+            try:
+                while time.perf_counter() < deadline:
+                    # What the request_started/finished signals do around a view
+                    close_old_connections()
+                    start = time.perf_counter()
+                    try:
+                        if rng.random() < options['write_ratio']:
+                            with transaction.atomic():
+                                ids.append(Appointment.objects.create(
+                                    patient_id=rng.choice(patients), doctor_id=rng.choice(doctors),
+                                    date=timezone.now() + timedelta(days=rng.randint(1, 60)),
+                                ).pk)
+                            writes.append(time.perf_counter() - start)
+                        else:
+                            list(Appointment.objects.filter(doctor_id=rng.choice(doctors)).select_related('patient__user')[:50])
+                            reads.append(time.perf_counter() - start)
+                    except OperationalError:
+                        errors += 1
+                    close_old_connections()
+            finally:
+                connection.close()
+                with lock:
+                    stats['reads'] += reads
+                    stats['writes'] += writes
+                    stats['errors'] += errors
+                    created.extend(ids)
+
+        try:
+            with override_settings(SQLITE_PRAGMAS=profile['pragmas']):
+                started = time.perf_counter()
+                threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+        finally:
+            db['CONN_MAX_AGE'], db['OPTIONS'] = saved
+            connections.close_all()
+            Appointment.objects.filter(pk__in=created).delete()
+            if original_mode is not None:
+                journal_mode(original_mode)
+
+        ops = len(stats['reads']) + len(stats['writes'])
+        return {
+            'ops': ops / elapsed,
+            'writes': len(stats['writes']) / elapsed,
+            'read_p95_ms': self.p95(stats['reads']),
+            'write_p95_ms': self.p95(stats['writes']),
+            'errors': stats['errors'],
+        }
+
+    def p95(self, timings):
+        if len(timings) < 2:
+            return timings[0] * 1000 if timings else 0.0
+        return statistics.quantiles(timings, n=20)[-1] * 1000
+
+    def format_result(self, name, result):
+        return '%-10s %8.1f ops/s  %7.1f writes/s  read p95 %7.2fms  write p95 %7.2fms  %d locked' % (
+            name, result['ops'], result['writes'], result['read_p95_ms'], result['write_p95_ms'], result['errors'],
+        )
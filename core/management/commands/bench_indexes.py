@@ -0,0 +1,112 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import RequestFactory
+from django.utils import timezone
+
+from core.models import Appointment, Billing, Doctor, Inventory, Patient, Prescription
+from core.pagination import keyset_paginate
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Show query plans and latencies of the dashboard access paths with and without the core indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per query')
+        parser.add_argument('--doctor', type=int, help='Doctor id to use (default: busiest doctor)')
+        parser.add_argument('--patient', type=int, help='Patient id to use (default: busiest patient)')
+        parser.add_argument('--no-plans', action='store_true', help='Only print latencies')
+
+    def handle(self, *args, **options):
+        doctor = self.pick(Doctor, options['doctor'], 'appointment')
+        patient = self.pick(Patient, options['patient'], 'appointment')
+        queries = self.access_paths(doctor, patient)
+
+        self.stdout.write('Using doctor %s and patient %s' % (doctor.pk, patient.pk))
+        # DDL is transactional on SQLite and PostgreSQL, so the indexes come
+        # back when the rollback undoes the DROP INDEX statements
+        try:
+            with transaction.atomic():
+                self.drop_indexes()
+                self.stdout.write('\n== Without core indexes ==')
+                before = self.run(queries, options)
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write('\n== With core indexes ==')
+        after = self.run(queries, options)
+
+        self.stdout.write('\n%-32s %12s %12s %9s' % ('query', 'before (ms)', 'after (ms)', 'speedup'))
+        for name in queries:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            self.stdout.write('%-32s %12.3f %12.3f %8.1fx' % (name, before[name], after[name], speedup))
+
+    def pick(self, model, pk, related):
+        if pk is not None:
+            try:
+                return model.objects.get(pk=pk)
+            except model.DoesNotExist:
+                raise CommandError('%s %s does not exist' % (model.__name__, pk))
+        obj = model.objects.annotate(n=Count(related)).order_by('-n').first()
+        if obj is None:
+            raise CommandError('No %s rows; seed the database first' % model.__name__)
+        return obj
+
+    def access_paths(self, doctor, patient):
+        # The querysets the views issue, in the form they issue them
+        request = RequestFactory().get('/')
+        return {
+            'doctor appointments': lambda: list(Appointment.objects.filter(doctor=doctor).select_related('patient__user')),
+            'doctor upcoming': lambda: list(Appointment.objects.filter(doctor=doctor, date__gte=timezone.now()).order_by('date')[:20]),
+            'doctor scheduled': lambda: list(Appointment.objects.filter(doctor=doctor, status='Scheduled')),
+            'patient appointments': lambda: list(Appointment.objects.filter(patient=patient).select_related('doctor__user')),
+            'patient bills': lambda: list(Billing.objects.filter(patient=patient)),
+            'patient prescriptions by doctor': lambda: list(Prescription.objects.filter(patient=patient, doctor=doctor)),
+            'inventory by name': lambda: list(Inventory.objects.filter(item_name='Bandages')),
+            'inventory page': lambda: list(keyset_paginate(request, Inventory.objects.all(), ('date', 'id'))),
+            'prescriptions page': lambda: list(keyset_paginate(request, Prescription.objects.all(), ('created_at', 'id'))),
+            'bills page': lambda: list(keyset_paginate(request, Billing.objects.all(), ('date', 'id'))),
+        }
+
+    def drop_indexes(self):
+        with connection.cursor() as cursor:
+            for model in (Appointment, Billing, Inventory, Prescription):
+                for index in model._meta.indexes:
+                    cursor.execute('DROP INDEX %s' % connection.ops.quote_name(index.name))
+
+    def run(self, queries, options):
+        results = {}
+        for name, query in queries.items():
+            if not options['no_plans']:
+                self.stdout.write('-- %s' % name)
+                self.explain(query)
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                query()
+                timings.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(timings)
+        return results
+
+    def explain(self, query):
+        statements = []
+
+        def capture(execute, sql, params, many, context):
+            statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(capture):
+            query()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute(prefix + sql, params)
+                for row in cursor.fetchall():
+                    self.stdout.write('   ' + ' '.join(str(col) for col in row))
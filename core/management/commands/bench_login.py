@@ -0,0 +1,89 @@
+import logging
+import multiprocessing
+import os
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from core.models import Staff
+
+USERNAME = 'bench_login_user'
+
+
+def run_logins(args):
+    # Runs in a worker process; returns the duration of each login
+    host, password, count = args
+    client = Client(HTTP_HOST=host)
+    url = reverse('login')
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = client.post(url, {'username': USERNAME, 'password': password})
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 302:
+            raise RuntimeError('Login failed with status %d' % response.status_code)
+    return timings
+
+
+class Command(BaseCommand):
+    help = 'Measure login throughput through the login view, per core and in total'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=50, help='Logins per process')
+        parser.add_argument('--processes', type=int, default=1, help='Parallel login processes (at most one per core)')
+        parser.add_argument('--host', default='localhost', help='Host header; must be in ALLOWED_HOSTS')
+        parser.add_argument('--password', default='bench-login-pass')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username=USERNAME).exists():
+            raise CommandError('%s already exists; delete it or let an earlier run finish' % USERNAME)
+        # Every login is slow by design; the slow request log would bury the report
+        logging.getLogger('core.metrics.slow').setLevel(logging.CRITICAL)
+        user = User.objects.create_user(USERNAME, password=options['password'])
+        Staff.objects.create(user=user, role='Benchmark', phone='0')
+        try:
+            hasher = get_hasher()
+            hash_ms = self.hash_time(hasher, options['password'], user.password)
+            self.stdout.write('%s hasher (%s), %d process(es) x %d logins' % (
+                hasher.algorithm, settings.PASSWORD_HASHER, options['processes'], options['logins'],
+            ))
+            work = [(options['host'], options['password'], options['logins'])] * options['processes']
+            started = time.perf_counter()
+            if options['processes'] == 1:
+                results = [run_logins(work[0])]
+            else:
+                # Forked workers must not share the parent's database connection
+                connections.close_all()
+                with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                    results = pool.map(run_logins, work)
+            elapsed = time.perf_counter() - started
+        finally:
+            user.delete()
+
+        timings = [timing for result in results for timing in result]
+        login_ms = statistics.median(timings) * 1000
+        throughput = len(timings) / elapsed
+        cores = min(options['processes'], os.cpu_count() or 1)
+        self.stdout.write('password hash  %8.1fms' % hash_ms)
+        if options['processes'] == 1:
+            # Time of a login in password hashes; the rest is queries and the view
+            self.stdout.write('login (median) %8.1fms  = %.2f hashes' % (login_ms, login_ms / hash_ms))
+        else:
+            self.stdout.write('login (median) %8.1fms' % login_ms)
+        self.stdout.write('per core       %8.1f logins/s' % (throughput / cores))
+        self.stdout.write('total          %8.1f logins/s' % throughput)
+
+    def hash_time(self, hasher, password, encoded):
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            hasher.verify(password, encoded)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
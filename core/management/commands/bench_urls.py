@@ -0,0 +1,205 @@
+import json
+import logging
+import math
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+
+from core.models import Doctor, Inventory, Patient, Prescription, Staff
+
+# How each route is exercised: (role to log in as, function returning the URL
+# args from the sample objects). Routes that change data on GET (deletes,
+# logout) are listed in SKIPPED and never requested.
+SCENARIOS = {
+    'home': (None, None),
+    'register_patient': (None, None),
+    'register_doctor': (None, None),
+    'register_staff': (None, None),
+    'login': (None, None),
+    'patient_dashboard': ('patient', None),
+    'book_appointment': ('patient', None),
+    'view_prescriptions': ('patient', None),
+    'doctor_dashboard': ('doctor', None),
+    'manage_appointments': ('doctor', None),
+    'manage_prescriptions': ('doctor', lambda s: [s['patient'].pk]),
+    'update_prescription': ('doctor', lambda s: [s['prescription'].pk]),
+    'generate_bill': ('staff', lambda s: [s['prescription'].pk]),
+    'staff_dashboard': ('staff', None),
+    'view_prescriptions_and_bills': ('staff', None),
+    'add_inventory': ('staff', None),
+    'update_inventory': ('staff', lambda s: [s['inventory'].pk]),
+    'add_doctor': ('staff', None),
+    'add_staff': ('staff', None),
+    'export_bills': ('staff', None),
+    'export_prescriptions': ('staff', None),
+    'export_inventory': ('staff', None),
+    'import_inventory': ('staff', None),
+    'revenue_report': ('staff', None),
+    'invoice_archive': ('staff', None),
+    'low_stock': ('staff', None),
+    'search_records': ('staff', None),
+    'api_patient_dashboard': ('patient', None),
+    'api_doctor_dashboard': ('doctor', None),
+    'api_manage_appointments': ('doctor', None),
+    'api_free_slots': ('patient', None),
+    'metrics': (None, None),
+}
+SKIPPED = {
+    'logout', 'delete_appointment', 'delete_prescription', 'delete_bill', 'delete_inventory',
+    'delete_doctor', 'delete_staff', 'api_batch_appointments',
+}
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def route_names(resolver=None):
+    resolver = resolver or get_resolver()
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.app_name == 'admin':
+                continue
+            yield from route_names(pattern)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            yield pattern.name
+
+
+class Command(BaseCommand):
+    help = 'Measure latency, SQL queries and response size of every core URL, optionally against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Timed requests per route')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per route')
+        parser.add_argument('--patient-user', help='Username to log in as for patient routes')
+        parser.add_argument('--doctor-user', help='Username to log in as for doctor routes')
+        parser.add_argument('--staff-user', help='Username to log in as for staff routes')
+        parser.add_argument('--host', default='localhost', help='Host header; must be in ALLOWED_HOSTS')
+        parser.add_argument('--only', nargs='*', default=None, help='Only benchmark these route names')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='JSON file from an earlier --output run to compare against')
+        parser.add_argument(
+            '--latency-threshold', type=float, default=0.2,
+            help='Allowed relative p95 latency increase over the baseline (0.2 = 20%%)',
+        )
+        parser.add_argument('--query-threshold', type=int, default=0, help='Allowed extra SQL queries over the baseline')
+
+    def handle(self, *args, **options):
+        samples = self.samples(options)
+        # Failing routes show up as a non-200 status in the report; one
+        # traceback per request would bury it
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        clients = {}
+        results = {}
+        for name in route_names():
+            if name in SKIPPED or (options['only'] is not None and name not in options['only']):
+                continue
+            if name not in SCENARIOS:
+                self.stderr.write('No benchmark scenario for route %r; skipping' % name)
+                continue
+            role, get_args = SCENARIOS[name]
+            if role not in clients:
+                clients[role] = Client(HTTP_HOST=options['host'], raise_request_exception=False)
+                if role is not None:
+                    clients[role].force_login(samples[role + '_user'])
+            url = reverse(name, args=get_args(samples) if get_args else None)
+            results[name] = self.measure(clients[role], url, options)
+            self.stdout.write(self.format_row(name, results[name]))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if options['baseline']:
+            self.compare(results, options)
+
+    def samples(self, options):
+        patient = self.profile(Patient, options['patient_user'])
+        doctor = self.profile(Doctor, options['doctor_user'])
+        staff = self.profile(Staff, options['staff_user'])
+        prescription = (
+            Prescription.objects.filter(doctor=doctor, patient__isnull=False).order_by('id').first()
+            or Prescription.objects.filter(patient__isnull=False).order_by('id').first()
+        )
+        inventory = Inventory.objects.order_by('id').first()
+        if prescription is None or inventory is None:
+            raise CommandError('Need at least one prescription and inventory item; run seed_hospital first')
+        return {
+            'patient_user': patient.user,
+            'doctor_user': doctor.user,
+            'staff_user': staff.user,
+            'patient': prescription.patient,
+            'prescription': prescription,
+            'inventory': inventory,
+        }
+
+    def profile(self, model, username):
+        queryset = model.objects.select_related('user')
+        if username:
+            try:
+                return queryset.get(user__username=username)
+            except model.DoesNotExist:
+                raise CommandError('%s is not a %s' % (username, model.__name__.lower()))
+        profile = queryset.order_by('id').first()
+        if profile is None:
+            raise CommandError('No %s found; run seed_hospital first' % model.__name__.lower())
+        return profile
+
+    def measure(self, client, url, options):
+        for _ in range(options['warmup']):
+            client.get(url)
+        timings = []
+        query_counts = []
+        for _ in range(options['iterations']):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = client.get(url)
+                # Streaming responses only run their queries as they are read
+                body = b''.join(response.streaming_content) if response.streaming else response.content
+                timings.append((time.perf_counter() - start) * 1000)
+            query_counts.append(len(queries))
+        # The most queries any request took (e.g. on a cold cache), which is
+        # what the baseline comparison checks
+        return {
+            'url': url,
+            'status': response.status_code,
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'queries': max(query_counts),
+            'queries_min': min(query_counts),
+            'bytes': len(body),
+        }
+
+    def format_row(self, name, result):
+        queries = '%d' % result['queries']
+        if result['queries_min'] != result['queries']:
+            queries = '%d-%s' % (result['queries_min'], queries)
+        return '%-30s %4d  p50 %9.2fms  p95 %9.2fms  p99 %9.2fms  %5s queries  %9d bytes' % (
+            name, result['status'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            queries, result['bytes'],
+        )
+
+    def compare(self, results, options):
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in sorted(results.items()):
+            before = baseline.get(name)
+            if before is None:
+                continue
+            allowed_ms = before['p95_ms'] * (1 + options['latency_threshold'])
+            if result['p95_ms'] > allowed_ms:
+                regressions.append('%s: p95 %.2fms > %.2fms (baseline %.2fms)' % (name, result['p95_ms'], allowed_ms, before['p95_ms']))
+            allowed_queries = before['queries'] + options['query_threshold']
+            if result['queries'] > allowed_queries:
+                regressions.append('%s: %d queries > %d (baseline %d)' % (name, result['queries'], allowed_queries, before['queries']))
+        if regressions:
+            raise CommandError('Regressions against %s:\n  %s' % (options['baseline'], '\n  '.join(regressions)))
+        self.stdout.write(self.style.SUCCESS('No regressions against %s' % options['baseline']))
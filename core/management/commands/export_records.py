@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exports import EXPORTS, FORMATS, export_stream
+from core.forms import ExportFilterForm
+
+
+class Command(BaseCommand):
+    help = 'Stream the bill, prescription or inventory history as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--date-from', help='First day to include (YYYY-MM-DD)')
+        parser.add_argument('--date-to', help='Last day to include (YYYY-MM-DD)')
+        parser.add_argument('--doctor', type=int, help='Only rows for this doctor id')
+        parser.add_argument('--chunk-size', type=int, help='Rows per database fetch (default: EXPORT_CHUNK_SIZE)')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        form = ExportFilterForm({
+            'format': options['format'],
+            'date_from': options['date_from'],
+            'date_to': options['date_to'],
+            'doctor': options['doctor'],
+        }, kind=options['kind'])
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        filters = form.cleaned_data
+        output_format = filters.pop('format')
+        chunks = export_stream(
+            options['kind'], output_format, batch_size=options['chunk_size'],
+            chunk_size=options['chunk_size'], **filters
+        )
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
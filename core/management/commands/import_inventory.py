@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.inventory_import import import_inventory_csv
+
+
+class Command(BaseCommand):
+    help = 'Upsert inventory items by item_name from a CSV file (item_name, quantity, date)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import')
+        parser.add_argument('--chunk-size', type=int, help='Rows per bulk write (default: INVENTORY_IMPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as f:
+                result = import_inventory_csv(f, options['chunk_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        for line, error in result.errors:
+            self.stderr.write('Line %d: %s' % (line, error))
+        self.stdout.write(self.style.SUCCESS(
+            '%d created, %d updated, %d skipped' % (result.created, result.updated, len(result.errors))
+        ))
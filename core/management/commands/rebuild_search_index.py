@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.search import rebuild_index, search_available
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from the patient, doctor, staff, prescription and bill tables'
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError('Full-text search needs the SQLite database')
+        started = time.perf_counter()
+        count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Indexed %d document(s) in %.1fs' % (count, time.perf_counter() - started)))
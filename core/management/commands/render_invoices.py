@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.forms import DateRangeForm
+from core.invoices import ArchiveStats, invoice_archive, prune_cache
+
+
+class Command(BaseCommand):
+    help = 'Render the invoices of the bills in a date range into a zip archive and report the throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the zip archive to write')
+        parser.add_argument('--date-from', help='First day to include (YYYY-MM-DD)')
+        parser.add_argument('--date-to', help='Last day to include (YYYY-MM-DD)')
+        parser.add_argument('--doctor', type=int, help='Only bills of this doctor id')
+        parser.add_argument('--processes', type=int, help='Rendering processes (default: INVOICE_PROCESSES; 1 renders inline)')
+        parser.add_argument('--chunk-size', type=int, help='Bills per database fetch and worker task (default: INVOICE_CHUNK_SIZE)')
+        parser.add_argument('--prune', action='store_true', help='First remove cached invoices of bills that no longer exist')
+
+    def handle(self, *args, **options):
+        form = DateRangeForm({
+            'date_from': options['date_from'],
+            'date_to': options['date_to'],
+            'doctor': options['doctor'],
+        })
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        if options['prune']:
+            self.stdout.write('Removed %d cached invoice(s) of deleted bills' % prune_cache(options['chunk_size']))
+        stats = ArchiveStats()
+        chunks = invoice_archive(stats, processes=options['processes'], chunk_size=options['chunk_size'], **form.cleaned_data)
+        with open(options['output'], 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        self.stdout.write(self.style.SUCCESS('Wrote %s: %s' % (options['output'], stats)))
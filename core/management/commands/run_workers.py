@@ -0,0 +1,76 @@
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.jobs import requeue_stale, run_pending, work
+from core.models import Job
+
+
+def drain(names, totals, lock):
+    # Runs in a worker thread, with its own database connection
+    try:
+        counts = run_pending(names=names)
+        with lock:
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs (bill follow-ups and the like) until stopped with Ctrl-C or SIGTERM'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2, help='Jobs run at the same time')
+        parser.add_argument('--name', action='append', dest='names', help='Only run jobs of this name; may be repeated')
+        parser.add_argument('--burst', action='store_true', help='Run the jobs that are due, then exit')
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale()
+        if requeued:
+            self.stdout.write('Requeued %d abandoned job(s)' % requeued)
+        if options['burst']:
+            self.burst(options)
+        else:
+            self.serve(options)
+
+    def burst(self, options):
+        totals = {}
+        lock = threading.Lock()
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=drain, args=(options['names'], totals, lock), name='jobs-%d' % index)
+            for index in range(options['threads'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        ran = sum(totals.values())
+        self.stdout.write('Ran %d job(s) in %.2fs: %d succeeded, %d to retry, %d failed' % (
+            ran, elapsed, totals.get(Job.SUCCEEDED, 0), totals.get(Job.QUEUED, 0), totals.get(Job.FAILED, 0),
+        ))
+
+    def serve(self, options):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        threads = [
+            threading.Thread(target=work, args=(stop, options['names']), name='jobs-%d' % index)
+            for index in range(options['threads'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write('Running %d job worker thread(s); stop with Ctrl-C' % len(threads))
+        try:
+            while not stop.wait(min(60, settings.JOB_TIMEOUT)):
+                requeue_stale()
+        except KeyboardInterrupt:
+            stop.set()
+        self.stdout.write('Stopping after the running jobs finish')
+        for thread in threads:
+            thread.join()
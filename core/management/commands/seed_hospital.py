@@ -0,0 +1,365 @@
+import random
+import time
+from array import array
+from datetime import date, time as clock, timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import OPEN_STATUSES, Appointment, Billing, Doctor, DoctorSchedule, Inventory, Patient, Prescription, Staff
+from core.inventory import take_snapshots
+from core.revenue import rebuild_revenue
+from core.search import rebuild_index, search_available
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Priya', 'Rahul',
+    'Ananya', 'Arjun', 'Wei', 'Mei', 'Carlos', 'Lucia', 'Ahmed', 'Fatima', 'Kwame', 'Amara',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee',
+    'Perampalli', 'Sharma', 'Reddy', 'Chen', 'Wang', 'Kim', 'Nguyen', 'Okafor', 'Mensah', 'Haddad',
+]
+# (specialty, relative share of doctors)
+SPECIALTIES = [
+    ('General Medicine', 30), ('Pediatrics', 12), ('Cardiology', 8), ('Orthopedics', 8), ('Gynecology', 8),
+    ('Dermatology', 6), ('Neurology', 5), ('Psychiatry', 5), ('Ophthalmology', 5), ('ENT', 5),
+    ('Oncology', 4), ('Radiology', 4),
+]
+# Working weeks handed out to doctors: (relative share, weekdays, shifts,
+# slot minutes)
+WORK_WEEKS = [
+    (60, range(5), [('09:00', '17:00')], 30),
+    (25, range(5), [('08:00', '12:00'), ('13:00', '17:00')], 20),
+    (15, range(6), [('10:00', '16:00')], 15),
+]
+# Open appointments are booked over the next UPCOMING_DAYS. Doctor k's n-th
+# one takes quarter hour (offset_k + n * UPCOMING_STRIDE) mod the quarter
+# hours in that span; the stride is coprime with their number, so a doctor's
+# open appointments never share a start time until every one is taken
+UPCOMING_DAYS = 90
+UPCOMING_STRIDE = 7919
+STAFF_ROLES = [('Nurse', 60), ('Receptionist', 15), ('Pharmacist', 10), ('Lab Technician', 10), ('Administrator', 5)]
+CONDITIONS = [
+    'None', 'Hypertension', 'Type 2 diabetes', 'Asthma', 'Hypothyroidism', 'Migraine', 'Arthritis',
+    'Seasonal allergies', 'Anemia', 'Coronary artery disease', 'Chronic kidney disease', 'Depression',
+]
+# (medicine, dosage, duration)
+MEDICINES = [
+    ('Paracetamol 500mg', '1 tablet every 6 hours', '5 days'),
+    ('Amoxicillin 500mg', '1 capsule three times daily', '7 days'),
+    ('Ibuprofen 400mg', '1 tablet twice daily', '5 days'),
+    ('Metformin 500mg', '1 tablet twice daily', '90 days'),
+    ('Amlodipine 5mg', '1 tablet daily', '30 days'),
+    ('Atorvastatin 20mg', '1 tablet at night', '90 days'),
+    ('Omeprazole 20mg', '1 capsule before breakfast', '14 days'),
+    ('Salbutamol inhaler', '2 puffs as needed', '30 days'),
+    ('Cetirizine 10mg', '1 tablet daily', '10 days'),
+    ('Levothyroxine 50mcg', '1 tablet before breakfast', '90 days'),
+    ('Azithromycin 500mg', '1 tablet daily', '3 days'),
+    ('Sertraline 50mg', '1 tablet daily', '60 days'),
+]
+SUPPLIES = [
+    'Bandages', 'Gauze pads', 'Syringes 5ml', 'Syringes 10ml', 'Surgical gloves', 'Face masks', 'Thermometers',
+    'IV cannulas', 'Saline 500ml', 'Cotton rolls', 'Adhesive tape', 'Alcohol swabs', 'Catheters', 'Suture kits',
+]
+
+
+def full_name(role, index):
+    # Names are a pure function of the row index so bills can be described
+    # without reading users back from the database
+    first = FIRST_NAMES[(index * 7 + len(role)) % len(FIRST_NAMES)]
+    last = LAST_NAMES[(index // len(FIRST_NAMES) + index) % len(LAST_NAMES)]
+    return first, last
+
+
+def chunks(total, size):
+    for start in range(0, total, size):
+        yield start, min(size, total - start)
+
+
+def bulk_insert(model, field_names, rows):
+    # bulk_create builds a model instance and compiles every value through the
+    # field API, which dominates at millions of rows. Rows without reverse
+    # lookups needed (no pks, no signals) go through executemany instead.
+    fields = [model._meta.get_field(name) for name in field_names]
+    adapters = []
+    for field in fields:
+        internal_type = field.get_internal_type()
+        if internal_type == 'DateTimeField':
+            adapters.append(connection.ops.adapt_datetimefield_value)
+        elif internal_type == 'DateField':
+            adapters.append(connection.ops.adapt_datefield_value)
+        elif internal_type == 'TimeField':
+            adapters.append(connection.ops.adapt_timefield_value)
+        elif internal_type == 'DecimalField':
+            adapters.append(lambda value, f=field: connection.ops.adapt_decimalfield_value(value, f.max_digits, f.decimal_places))
+        else:
+            adapters.append(None)
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = [
+        [value if adapt is None else adapt(value) for adapt, value in zip(adapters, row)]
+        for row in rows
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic hospital data for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=10000)
+        parser.add_argument('--doctors', type=int, default=200)
+        parser.add_argument('--staff', type=int, default=100)
+        parser.add_argument('--appointments', type=int, default=100000)
+        parser.add_argument('--prescriptions', type=int, default=50000)
+        parser.add_argument('--bills', type=int, default=50000)
+        parser.add_argument('--inventory', type=int, default=2000)
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per insert batch and per transaction')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of doctor popularity')
+        parser.add_argument('--history-days', type=int, default=730, help='How far back generated activity goes')
+        parser.add_argument('--prefix', default='seed', help='Username prefix of generated users')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible data')
+        parser.add_argument(
+            '--keep-indexes', action='store_true',
+            help='Maintain the composite indexes while inserting instead of rebuilding them at the end',
+        )
+
+    def handle(self, *args, **options):
+        if options['doctors'] < 1 or options['patients'] < 1:
+            raise CommandError('At least one doctor and one patient are needed')
+        self.prefix = options['prefix']
+        if User.objects.filter(username__startswith=self.prefix + '_').exists():
+            raise CommandError('Users prefixed "%s_" already exist; pass a different --prefix' % self.prefix)
+
+        self.random = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.history = timedelta(days=options['history_days'])
+        self.now = timezone.now()
+        # Hashing once instead of per user keeps seeding I/O bound
+        self.password = make_password(options['password'])
+
+        if connection.vendor == 'sqlite':
+            # Only affects this connection; a crash mid-seed may lose the seed
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous=OFF')
+
+        started = time.perf_counter()
+        doctor_ids = self.seed_doctors(options['doctors'])
+        self.seed_schedules(doctor_ids)
+        patient_ids = self.seed_patients(options['patients'])
+        self.seed_staff(options['staff'])
+
+        # Cumulative Zipf weights: doctor k gets a share proportional to 1/k^s
+        weights = [1 / (rank ** options['zipf']) for rank in range(1, len(doctor_ids) + 1)]
+        self.doctor_weights = list(accumulate(weights))
+        self.doctor_ids = doctor_ids
+        self.patient_ids = patient_ids
+
+        fact_tables = [Appointment, Prescription, Billing, Inventory]
+        if not options['keep_indexes']:
+            # Building an index once over sorted data is far cheaper than
+            # updating it for every randomly ordered row
+            self.drop_indexes(fact_tables)
+        try:
+            self.seed_appointments(options['appointments'])
+            self.seed_prescriptions(options['prescriptions'])
+            self.seed_bills(options['bills'])
+            self.seed_inventory(options['inventory'])
+        finally:
+            if not options['keep_indexes']:
+                self.create_indexes(fact_tables)
+        # Baseline the inventory ledger at the seeded stock
+        take_snapshots()
+        # The bills went in without signals, so roll them up in one pass
+        rollup_started = time.perf_counter()
+        self.report('daily revenue', rebuild_revenue(), rollup_started)
+        if search_available():
+            search_started = time.perf_counter()
+            self.report('search index', rebuild_index(), search_started)
+        self.stdout.write(self.style.SUCCESS('Seeded in %.1fs' % (time.perf_counter() - started)))
+
+    def drop_indexes(self, models):
+        with connection.schema_editor() as schema_editor:
+            for model in models:
+                for index in model._meta.indexes:
+                    schema_editor.remove_index(model, index)
+
+    def create_indexes(self, models):
+        started = time.perf_counter()
+        with connection.schema_editor() as schema_editor:
+            for model in models:
+                for index in model._meta.indexes:
+                    schema_editor.add_index(model, index)
+        self.stdout.write('%-14s %24.1fs' % ('indexes', time.perf_counter() - started))
+
+    def report(self, label, count, started):
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0
+        self.stdout.write('%-14s %10d rows %8.1fs %10.0f rows/s' % (label, count, elapsed, rate))
+
+    def pick_doctors(self, k):
+        # Returns (index, id) pairs; the index gives the doctor's name
+        indexes = self.random.choices(range(len(self.doctor_ids)), cum_weights=self.doctor_weights, k=k)
+        return [(i, self.doctor_ids[i]) for i in indexes]
+
+    def pick_patients(self, k):
+        indexes = self.random.choices(range(len(self.patient_ids)), k=k)
+        return [(i, self.patient_ids[i]) for i in indexes]
+
+    def past_datetime(self):
+        return self.now - self.history * self.random.random()
+
+    def create_users(self, role, start, count):
+        users = []
+        for index in range(start, start + count):
+            first, last = full_name(role, index)
+            users.append(User(
+                username='%s_%s_%d' % (self.prefix, role, index),
+                first_name=first,
+                last_name=last,
+                email='%s.%s%d@example.com' % (first.lower(), last.lower(), index),
+                password=self.password,
+                date_joined=self.past_datetime(),
+            ))
+        return [user.pk for user in User.objects.bulk_create(users)]
+
+    def seed_people(self, role, total, build):
+        started = time.perf_counter()
+        ids = array('q')
+        for start, count in chunks(total, self.chunk_size):
+            with transaction.atomic():
+                user_ids = self.create_users(role, start, count)
+                profiles = [build(user_id) for user_id in user_ids]
+                ids.extend(profile.pk for profile in type(profiles[0]).objects.bulk_create(profiles))
+        self.report(role, total, started)
+        return ids
+
+    def seed_doctors(self, total):
+        specialties, shares = zip(*SPECIALTIES)
+        return self.seed_people('doctor', total, lambda user_id: Doctor(
+            user_id=user_id,
+            specialty=self.random.choices(specialties, shares)[0],
+            phone=self.phone(),
+        ))
+
+    def seed_schedules(self, doctor_ids):
+        started = time.perf_counter()
+        shares = [share for share, _, _, _ in WORK_WEEKS]
+        rows = []
+        for doctor_id in doctor_ids:
+            _, weekdays, shifts, minutes = self.random.choices(WORK_WEEKS, shares)[0]
+            for weekday in weekdays:
+                for start, end in shifts:
+                    rows.append((doctor_id, weekday, clock.fromisoformat(start), clock.fromisoformat(end), minutes))
+        with transaction.atomic():
+            bulk_insert(DoctorSchedule, ['doctor', 'weekday', 'start_time', 'end_time', 'slot_minutes'], rows)
+        self.report('schedule', len(rows), started)
+
+    def seed_patients(self, total):
+        earliest = date.today() - timedelta(days=90 * 365)
+
+        def build(user_id):
+            conditions = self.random.sample(CONDITIONS, self.random.choice((1, 1, 1, 2, 3)))
+            return Patient(
+                user_id=user_id,
+                dob=earliest + timedelta(days=self.random.randrange(90 * 365)),
+                address='%d %s Street, Ward %d' % (self.random.randrange(1, 999), self.random.choice(LAST_NAMES), self.random.randrange(1, 40)),
+                phone=self.phone(),
+                medical_history=', '.join(conditions),
+            )
+        return self.seed_people('patient', total, build)
+
+    def seed_staff(self, total):
+        if not total:
+            return array('q')
+        roles, shares = zip(*STAFF_ROLES)
+        return self.seed_people('staff', total, lambda user_id: Staff(
+            user_id=user_id,
+            role=self.random.choices(roles, shares)[0],
+            phone=self.phone(),
+        ))
+
+    def phone(self):
+        return '9%09d' % self.random.randrange(10 ** 9)
+
+    def seed_appointments(self, total):
+        started = time.perf_counter()
+        quarter = timedelta(minutes=15)
+        quarters = UPCOMING_DAYS * 24 * 4
+        # The first quarter hour from now
+        origin = self.now.replace(minute=self.now.minute - self.now.minute % 15, second=0, microsecond=0) + quarter
+        offsets = array('q', (self.random.randrange(quarters) for _ in self.doctor_ids))
+        booked = array('q', [0]) * len(self.doctor_ids)
+        for start, count in chunks(total, self.chunk_size):
+            rows = []
+            for (doctor_index, doctor_id), (_, patient_id) in zip(self.pick_doctors(count), self.pick_patients(count)):
+                # Mostly history, with a quarter of bookings still upcoming
+                if self.random.random() < 0.75:
+                    when = self.past_datetime()
+                    status = self.random.choices(('Completed', 'Canceled'), (85, 15))[0]
+                else:
+                    when = origin + quarter * self.random.randrange(quarters)
+                    status = self.random.choices(('Scheduled', 'Accepted', 'Rescheduled', 'Canceled'), (55, 30, 10, 5))[0]
+                    if status in OPEN_STATUSES:
+                        taken = booked[doctor_index]
+                        if taken < quarters:
+                            when = origin + quarter * ((offsets[doctor_index] + taken * UPCOMING_STRIDE) % quarters)
+                            booked[doctor_index] = taken + 1
+                        else:
+                            # The doctor is booked solid
+                            status = 'Canceled'
+                # Appointments start on the quarter hour
+                when = when.replace(minute=when.minute - when.minute % 15, second=0, microsecond=0)
+                rows.append((patient_id, doctor_id, when, status))
+            with transaction.atomic():
+                bulk_insert(Appointment, ['patient', 'doctor', 'date', 'status'], rows)
+        self.report('appointment', total, started)
+
+    def seed_prescriptions(self, total):
+        started = time.perf_counter()
+        for start, count in chunks(total, self.chunk_size):
+            rows = []
+            for (_, doctor_id), (_, patient_id) in zip(self.pick_doctors(count), self.pick_patients(count)):
+                medicine, dosage, duration = self.random.choice(MEDICINES)
+                rows.append((patient_id, doctor_id, medicine, dosage, duration, self.past_datetime()))
+            with transaction.atomic():
+                bulk_insert(Prescription, ['patient', 'doctor', 'medicine', 'dosage', 'duration', 'created_at'], rows)
+        self.report('prescription', total, started)
+
+    def seed_bills(self, total):
+        started = time.perf_counter()
+        for start, count in chunks(total, self.chunk_size):
+            rows = []
+            for (doctor_index, doctor_id), (patient_index, patient_id) in zip(self.pick_doctors(count), self.pick_patients(count)):
+                # Log-normal amounts: many small consultations, a long tail of procedures
+                amount = Decimal(min(self.random.lognormvariate(6, 1), 99999999)).quantize(Decimal('0.01'))
+                description = 'Bill generated for %s %s by Dr. %s %s' % (full_name('patient', patient_index) + full_name('doctor', doctor_index))
+                rows.append((patient_id, doctor_id, amount, self.past_datetime().date(), description))
+            with transaction.atomic():
+                bulk_insert(Billing, ['patient', 'doctor', 'amount', 'date', 'description'], rows)
+        self.report('billing', total, started)
+
+    def seed_inventory(self, total):
+        started = time.perf_counter()
+        for start, count in chunks(total, self.chunk_size):
+            rows = [
+                ('%s #%d' % (SUPPLIES[index % len(SUPPLIES)], index // len(SUPPLIES) + 1), self.random.randrange(0, 1000), self.past_datetime().date())
+                for index in range(start, start + count)
+            ]
+            with transaction.atomic():
+                bulk_insert(Inventory, ['item_name', 'quantity', 'date'], rows)
+        self.report('inventory', total, started)
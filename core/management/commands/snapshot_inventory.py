@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from core.inventory import take_snapshots, with_ledger_quantity
+
+
+class Command(BaseCommand):
+    help = 'Snapshot every inventory quantity against the movement ledger (run periodically, e.g. nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='First check each quantity against its last snapshot plus later movements; fail on drift',
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            drifted = with_ledger_quantity().exclude(quantity=F('ledger_quantity')).order_by('id')
+            drifted = list(drifted.values_list('id', 'item_name', 'quantity', 'ledger_quantity'))
+            for pk, item_name, quantity, ledger_quantity in drifted:
+                self.stderr.write('%s (id %d): quantity %d, ledger says %d' % (item_name, pk, quantity, ledger_quantity))
+            if drifted:
+                raise CommandError('%d item(s) changed outside the ledger; not snapshotting' % len(drifted))
+        count = take_snapshots()
+        self.stdout.write(self.style.SUCCESS('Snapshotted %d item(s)' % count))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+
+
+class Command(BaseCommand):
+    help = 'Switch the SQLite database to a journal mode (default: SQLITE_JOURNAL_MODE); run once per deployment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('mode', nargs='?', type=str.upper, choices=MODES, help='Journal mode to set')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The journal mode only applies to SQLite databases')
+        mode = options['mode'] or settings.SQLITE_JOURNAL_MODE.upper()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = %s' % mode)
+            current = cursor.fetchone()[0].upper()
+        if current != mode:
+            raise CommandError('SQLite kept journal mode %s instead of %s' % (current, mode))
+        self.stdout.write(self.style.SUCCESS('Journal mode of %s is %s' % (connection.settings_dict['NAME'], current)))
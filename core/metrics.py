@@ -0,0 +1,208 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connection
+from django.template.backends import django as django_backend
+
+slow_logger = logging.getLogger('core.metrics.slow')
+
+# In-process request metrics, exported in the Prometheus text format by the
+# metrics view. MetricsMiddleware times each request; SQL is timed by an
+# execute_wrapper and template rendering by the DjangoTemplates backend
+# below. Every process keeps its own numbers, so with several workers each
+# one must be scraped (or run a single worker).
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 200
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # bisect_left so a value equal to a bound lands in that bucket (le)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def observe(self, name, labels, value, buckets):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def export(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines += self._header(name)
+                for labels, value in sorted(self.counters[name].items()):
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+            for name in sorted(self.histograms):
+                lines += self._header(name)
+                for labels, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _format_value(bound)
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', le),)), cumulative))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(histogram.sum)))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name):
+        kind, text = self.help.get(name, ('untyped', ''))
+        return ['# HELP %s %s' % (name, text), '# TYPE %s %s' % (name, kind)]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+registry.describe('hms_requests_total', 'counter', 'Requests served, by view, method and status code')
+registry.describe('hms_request_duration_seconds', 'histogram', 'Wall time spent handling a request')
+registry.describe('hms_request_sql_queries', 'histogram', 'SQL queries issued per request')
+registry.describe('hms_request_sql_duration_seconds', 'histogram', 'Time spent in SQL per request')
+registry.describe('hms_request_template_duration_seconds', 'histogram', 'Time spent rendering templates per request')
+registry.describe('hms_response_size_bytes', 'histogram', 'Response body size (streaming responses are not counted)')
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.queries += 1
+                self.sql_seconds += elapsed
+                if len(self.statements) < MAX_LOGGED_STATEMENTS:
+                    self.statements.append((elapsed, sql))
+
+
+# Metrics of the request being handled; copied into the worker threads of
+# async views along with the rest of the context
+_current = ContextVar('request_metrics', default=None)
+
+
+@contextmanager
+def recording_request():
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        with connection.execute_wrapper(metrics):
+            yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def recording_queries():
+    # For threads that run a request's queries on their own connection
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with connection.execute_wrapper(metrics):
+        yield
+
+
+def record_response(view, method, response, elapsed, metrics, slow_threshold):
+    labels = (('view', view),)
+    registry.increment('hms_requests_total', labels + (('method', method), ('status', response.status_code)))
+    registry.observe('hms_request_duration_seconds', labels, elapsed, DURATION_BUCKETS)
+    registry.observe('hms_request_sql_queries', labels, metrics.queries, QUERY_BUCKETS)
+    registry.observe('hms_request_sql_duration_seconds', labels, metrics.sql_seconds, DURATION_BUCKETS)
+    registry.observe('hms_request_template_duration_seconds', labels, metrics.template_seconds, DURATION_BUCKETS)
+    if not response.streaming:
+        registry.observe('hms_response_size_bytes', labels, len(response.content), SIZE_BUCKETS)
+    if slow_threshold is not None and elapsed * 1000 >= slow_threshold:
+        statements = '\n'.join('  %8.2fms  %s' % (seconds * 1000, sql) for seconds, sql in metrics.statements)
+        slow_logger.warning(
+            'Slow request: %s %s (%s) took %.1fms, %d queries in %.1fms, templates %.1fms\n%s',
+            method, view, response.status_code, elapsed * 1000, metrics.queries, metrics.sql_seconds * 1000,
+            metrics.template_seconds * 1000, statements,
+        )
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    # The stock backend, with render() timed into the current request's
+    # metrics. Includes and extends render inside the outer template, so
+    # they are counted once.
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.wrapped = template
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return self.wrapped.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self.wrapped.render(context, request)
+        finally:
+            elapsed = time.perf_counter() - start
+            with metrics.lock:
+                metrics.template_seconds += elapsed
@@ -0,0 +1,138 @@
+import time
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import record_response, recording_request
+from .roles import resolve_role
+from .user_cache import get_profile, get_user
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing; images, archives and the like already are
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml')
+
+
+def cached_user(request):
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = get_user(request)
+    return request._cached_user
+
+
+async def acached_user(request):
+    return await sync_to_async(cached_user)(request)
+
+
+class AuthenticationMiddleware(auth_middleware.AuthenticationMiddleware):
+    # Django's, with request.user looked up through the per-process user
+    # cache (see core.user_cache)
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: cached_user(request))
+        request.auser = partial(acached_user, request)
+
+
+class RoleMiddleware:
+    # Sets request.role ('patient', 'doctor', 'staff' or None),
+    # request.profile_id and request.profile (the Patient/Doctor/Staff row,
+    # only fetched when used). Must come after AuthenticationMiddleware.
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        role, profile_id = resolve_role(request.user)
+        request.role = role
+        request.profile_id = profile_id
+        if role is None:
+            request.profile = None
+        else:
+            request.profile = SimpleLazyObject(lambda: get_profile(request.user, role, profile_id))
+        return self.get_response(request)
+
+
+class MetricsMiddleware:
+    # Records per-view timings, SQL and template time and response size (see
+    # core.metrics) and logs requests slower than SLOW_REQUEST_MS with their
+    # SQL. Put it first so the whole middleware stack is timed.
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with recording_request() as metrics:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match else '<unresolved>'
+        record_response(view, request.method, response, elapsed, metrics, settings.SLOW_REQUEST_MS)
+        return response
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.partition(';')
+        if params.replace(' ', '').lower() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def brotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in sequence:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # Django's GZipMiddleware (random padding against BREACH included) with a
+    # size threshold and content type filter, preferring brotli when the
+    # brotli package is installed and the client accepts it. Put it right
+    # after MetricsMiddleware so the recorded sizes are the bytes sent.
+    def __init__(self, get_response):
+        if not settings.COMPRESSION_ENABLED:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '')
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        encodings = accepted_encodings(request)
+        if brotli is None or (response.streaming and response.is_async) or 'br' not in encodings:
+            if 'gzip' in encodings:
+                return super().process_response(request, response)
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if response.streaming:
+            response.streaming_content = brotli_sequence(response.streaming_content, settings.BROTLI_QUALITY)
+            del response.headers['Content-Length']
+        else:
+            compressed = brotli.compress(response.content, quality=settings.BROTLI_QUALITY)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = 'br'
+        return response
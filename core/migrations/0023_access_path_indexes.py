@@ -0,0 +1,57 @@
+# Generated by Django 5.0.14 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_prescription_created_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'date'], name='appointment_doctor_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'status', 'date'], name='appointment_doctor_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['patient', 'date'], name='appointment_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='billing',
+            index=models.Index(fields=['patient', 'date'], name='billing_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='billing',
+            index=models.Index(fields=['date', 'id'], name='billing_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(fields=['item_name'], name='inventory_item_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(fields=['date', 'id'], name='inventory_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['patient', 'doctor', 'created_at'], name='prescription_patient_doc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['created_at', 'id'], name='prescription_created_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='billing',
+            constraint=models.CheckConstraint(check=models.Q(('amount__gte', 0)), name='billing_amount_non_negative'),
+        ),
+        migrations.AddConstraint(
+            model_name='inventory',
+            constraint=models.CheckConstraint(check=models.Q(('quantity__gte', 0)), name='inventory_quantity_non_negative'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.0.14 on 2026-10-18 17:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill(apps, schema_editor):
+    Billing = apps.get_model('core', 'Billing')
+    DailyRevenue = apps.get_model('core', 'DailyRevenue')
+    totals = (
+        Billing.objects.values('doctor_id', 'date')
+        .annotate(bill_count=Count('id'), total_amount=Sum('amount'))
+        .order_by()
+    )
+    DailyRevenue.objects.bulk_create((DailyRevenue(**row) for row in totals.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('bill_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('doctor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='core.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='daily_revenue_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailyrevenue',
+            constraint=models.UniqueConstraint(fields=('doctor', 'date'), name='daily_revenue_doctor_date_uniq'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
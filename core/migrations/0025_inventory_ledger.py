@@ -0,0 +1,73 @@
+# Generated by Django 5.0.14 on 2026-10-18 17:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def baseline_snapshots(apps, schema_editor):
+    # Existing stock predates the ledger; record it as each item's baseline
+    Inventory = apps.get_model('core', 'Inventory')
+    InventorySnapshot = apps.get_model('core', 'InventorySnapshot')
+    InventorySnapshot.objects.bulk_create(
+        (InventorySnapshot(inventory_id=pk, quantity=quantity) for pk, quantity in Inventory.objects.values_list('pk', 'quantity').iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_daily_revenue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receipt', 'Receipt'), ('dispense', 'Dispense'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('quantity_change', models.IntegerField()),
+                ('note', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('last_movement_id', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(fields=['quantity', 'id'], name='inventory_quantity_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='inventorymovement',
+            name='created_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='inventorymovement',
+            name='inventory',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='core.inventory'),
+        ),
+        migrations.AddField(
+            model_name='inventorysnapshot',
+            name='inventory',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='core.inventory'),
+        ),
+        migrations.AddIndex(
+            model_name='inventorymovement',
+            index=models.Index(fields=['inventory', 'id'], name='inventory_movement_item_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inventorysnapshot',
+            index=models.Index(fields=['inventory', 'taken_at'], name='inventory_snapshot_item_idx'),
+        ),
+        migrations.RunPython(baseline_snapshots, migrations.RunPython.noop),
+    ]
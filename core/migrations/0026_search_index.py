@@ -0,0 +1,48 @@
+from django.db import migrations
+
+# FTS5 table behind core.search. SQLite only: on other databases the
+# migration does nothing and search is unavailable.
+
+CREATE = """
+CREATE VIRTUAL TABLE core_search USING fts5(
+    kind UNINDEXED, object_id UNINDEXED, patient_id UNINDEXED, title, body,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+)
+"""
+
+NAMES = "coalesce(u.first_name, '') || ' ' || coalesce(u.last_name, '')"
+POPULATE = [
+    "SELECT o.id * 8 + 1, 'patient', o.id, o.id, %s, u.username || ' ' || coalesce(o.address, '') || ' ' || coalesce(o.medical_history, '') "
+    "FROM core_patient o JOIN auth_user u ON u.id = o.user_id" % NAMES,
+    "SELECT o.id * 8 + 2, 'doctor', o.id, NULL, %s, u.username || ' ' || coalesce(o.specialty, '') "
+    "FROM core_doctor o JOIN auth_user u ON u.id = o.user_id" % NAMES,
+    "SELECT o.id * 8 + 3, 'staff', o.id, NULL, %s, u.username || ' ' || coalesce(o.role, '') "
+    "FROM core_staff o JOIN auth_user u ON u.id = o.user_id" % NAMES,
+    "SELECT o.id * 8 + 4, 'prescription', o.id, o.patient_id, '', coalesce(o.medicine, '') || ' ' || coalesce(o.dosage, '') "
+    "FROM core_prescription o",
+    "SELECT o.id * 8 + 5, 'bill', o.id, o.patient_id, '', coalesce(o.description, '') FROM core_billing o",
+]
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE)
+    for select in POPULATE:
+        schema_editor.execute('INSERT INTO core_search (rowid, kind, object_id, patient_id, title, body) ' + select)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0025_inventory_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
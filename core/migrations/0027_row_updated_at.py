@@ -0,0 +1,45 @@
+# Generated by Django 5.0.14 on 2026-10-18 17:50
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_default=django.db.models.functions.datetime.Now()),
+        ),
+        migrations.AddField(
+            model_name='billing',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_default=django.db.models.functions.datetime.Now()),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_default=django.db.models.functions.datetime.Now()),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'updated_at'], name='appointment_doctor_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['patient', 'updated_at'], name='appointment_patient_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='billing',
+            index=models.Index(fields=['patient', 'updated_at'], name='billing_patient_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['patient', 'updated_at'], name='prescription_patient_upd_idx'),
+        ),
+    ]
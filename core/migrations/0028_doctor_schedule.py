@@ -0,0 +1,36 @@
+# Generated by Django 5.0.14 on 2026-10-18 18:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_row_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('slot_minutes', models.PositiveSmallIntegerField(default=30)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='core.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'weekday'], name='doctor_schedule_day_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='doctorschedule',
+            constraint=models.CheckConstraint(check=models.Q(('end_time__gt', models.F('start_time'))), name='doctor_schedule_hours_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='doctorschedule',
+            constraint=models.CheckConstraint(check=models.Q(('slot_minutes__gte', 5)), name='doctor_schedule_slot_minimum'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-18 18:14
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Now
+
+OPEN_STATUSES = ['Scheduled', 'Accepted', 'Rescheduled']
+
+
+def cancel_double_bookings(apps, schema_editor):
+    # The old booking form accepted any time; of open appointments sharing a
+    # doctor and start time only the first booked is kept
+    Appointment = apps.get_model('core', 'Appointment')
+    open_appointments = Appointment.objects.filter(status__in=OPEN_STATUSES)
+    earlier = open_appointments.filter(doctor_id=OuterRef('doctor_id'), date=OuterRef('date'), id__lt=OuterRef('id'))
+    open_appointments.filter(Exists(earlier)).update(status='Canceled', updated_at=Now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_doctor_schedule'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_double_bookings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['Scheduled', 'Accepted', 'Rescheduled'])), fields=('doctor', 'date'), name='appointment_doctor_slot_uniq'),
+        ),
+    ]
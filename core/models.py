@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.functions import Now
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 class Patient(models.Model):
@@ -30,6 +32,9 @@ class Staff(models.Model):
     def __str__(self):
         return f"{self.user.username} - Staff ({self.role})"
 
+# Statuses of appointments that are still to take place
+OPEN_STATUSES = ['Scheduled', 'Accepted', 'Rescheduled']
+
 class Appointment(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE)
@@ -41,28 +46,153 @@ class Appointment(models.Model):
         ('Canceled', 'Canceled'),
         ('Completed', 'Completed'),
     ])
+    # Change marker for the dashboard API ETags; the database default covers
+    # rows inserted without the ORM
+    updated_at = models.DateTimeField(auto_now=True, db_default=Now())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'date'], name='appointment_doctor_date_idx'),
+            models.Index(fields=['doctor', 'status', 'date'], name='appointment_doctor_status_idx'),
+            models.Index(fields=['patient', 'date'], name='appointment_patient_date_idx'),
+            models.Index(fields=['doctor', 'updated_at'], name='appointment_doctor_upd_idx'),
+            models.Index(fields=['patient', 'updated_at'], name='appointment_patient_upd_idx'),
+        ]
+        constraints = [
+            # A doctor's open appointments never share a start time, however
+            # many bookings race for it (see core.availability.book_slot)
+            models.UniqueConstraint(
+                fields=['doctor', 'date'], condition=models.Q(status__in=OPEN_STATUSES), name='appointment_doctor_slot_uniq',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.patient.user.username} - {self.doctor.user.username} on {self.date}"
 
+# A doctor's working hours on one weekday (0 = Monday), cut into slots of
+# slot_minutes; several rows on a day make a split shift. Doctors without
+# any rows work settings.DEFAULT_WORKING_HOURS (see core.availability).
+class DoctorSchedule(models.Model):
+    WEEKDAY_CHOICES = [
+        (0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday'),
+    ]
+
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='schedules')
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAY_CHOICES)
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    slot_minutes = models.PositiveSmallIntegerField(default=30)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'weekday'], name='doctor_schedule_day_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(check=models.Q(end_time__gt=models.F('start_time')), name='doctor_schedule_hours_order'),
+            models.CheckConstraint(check=models.Q(slot_minutes__gte=5), name='doctor_schedule_slot_minimum'),
+        ]
+
+    def __str__(self):
+        return f"Doctor {self.doctor_id} on {self.get_weekday_display()}: {self.start_time}-{self.end_time}"
+
 class Billing(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE,null=True)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE,null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date = models.DateField()
     description = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True, db_default=Now())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'date'], name='billing_patient_date_idx'),
+            models.Index(fields=['date', 'id'], name='billing_date_id_idx'),
+            models.Index(fields=['patient', 'updated_at'], name='billing_patient_upd_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(check=models.Q(amount__gte=0), name='billing_amount_non_negative'),
+        ]
 
     def __str__(self):
         return f"Billing for {self.patient.user.username} on {self.date}"
 
+# Per doctor and day totals of Billing, kept up to date by core.revenue so
+# revenue reports never scan the bills themselves
+class DailyRevenue(models.Model):
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, null=True)
+    date = models.DateField()
+    bill_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'date'], name='daily_revenue_doctor_date_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='daily_revenue_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"Revenue for doctor {self.doctor_id} on {self.date}: {self.total_amount}"
+
 class Inventory(models.Model):
     item_name = models.CharField(max_length=100)
     quantity = models.IntegerField()
     date = models.DateField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['item_name'], name='inventory_item_name_idx'),
+            models.Index(fields=['date', 'id'], name='inventory_date_id_idx'),
+            models.Index(fields=['quantity', 'id'], name='inventory_quantity_id_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(check=models.Q(quantity__gte=0), name='inventory_quantity_non_negative'),
+        ]
+
     def __str__(self):
         return f"{self.item_name} - {self.quantity} items"
 
+# Append-only stock ledger. Inventory.quantity is the running total of an
+# item's movements (see core.inventory); quantity_change is signed.
+class InventoryMovement(models.Model):
+    RECEIPT = 'receipt'
+    DISPENSE = 'dispense'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [
+        (RECEIPT, 'Receipt'),
+        (DISPENSE, 'Dispense'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, related_name='movements')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity_change = models.IntegerField()
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['inventory', 'id'], name='inventory_movement_item_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} of {self.quantity_change} for item {self.inventory_id}"
+
+# Stock of an item as of a ledger position: replaying the movements after
+# last_movement_id on top of quantity gives the stock at any later time
+class InventorySnapshot(models.Model):
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, related_name='snapshots')
+    quantity = models.IntegerField()
+    last_movement_id = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['inventory', 'taken_at'], name='inventory_snapshot_item_idx'),
+        ]
+
 class Prescription(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='prescriptions',null=True)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE,null=True)
@@ -70,6 +200,46 @@ class Prescription(models.Model):
     dosage = models.CharField(max_length=100, default='')
     duration = models.CharField(max_length=50, default='')
     created_at = models.DateTimeField(auto_now_add=True,null=True) 
+    updated_at = models.DateTimeField(auto_now=True, db_default=Now())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'doctor', 'created_at'], name='prescription_patient_doc_idx'),
+            models.Index(fields=['created_at', 'id'], name='prescription_created_id_idx'),
+            models.Index(fields=['patient', 'updated_at'], name='prescription_patient_upd_idx'),
+        ]
 
     def __str__(self):
         return f"Prescription for {self.patient.user.get_full_name()} by Dr. {self.doctor.user.get_full_name()}"
+
+# A unit of background work: the handler registered under `name` in
+# core.jobs, run by `manage.py run_workers` with `payload` as its arguments.
+# Failed runs are retried until max_attempts; a job enqueued under a key that
+# is already taken is not added again.
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (SUCCEEDED, 'Succeeded'), (FAILED, 'Failed')]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
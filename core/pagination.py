@@ -0,0 +1,167 @@
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+
+# Keyset (cursor) pagination. Rows are listed newest first (or in ascending
+# order with descending=False), ordered by a tuple of keys ending in a unique
+# column (e.g. ('created_at', 'id')). A
+# cursor holds the key values of the row at the edge of the current page, so
+# fetching any page is an indexed range scan instead of an OFFSET scan.
+# Nullable keys sort last.
+
+
+def _json_default(value):
+    # Full isoformat: DjangoJSONEncoder truncates microseconds, which would
+    # break equality on datetime keys
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(direction, values):
+    data = json.dumps({'d': direction, 'k': values}, default=_json_default)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    # (direction, key values converted by their model fields), or None for
+    # anything that is not a cursor we could have issued
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        direction, values = data['d'], data['k']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+    if direction not in ('next', 'previous') or not isinstance(values, list) or len(values) != len(fields):
+        return None
+    converted = []
+    for field, value in zip(fields, values):
+        if value is None:
+            if not field.null:
+                return None
+            converted.append(None)
+            continue
+        if isinstance(value, (list, dict, bool)):
+            return None
+        try:
+            converted.append(field.to_python(value))
+        except (ValidationError, TypeError, ValueError):
+            return None
+    return direction, converted
+
+
+def _after(keys, nullable, values):
+    # Rows that come after `values` in (key DESC NULLS LAST, ...) order
+    condition = Q(pk__in=[])
+    equal = Q()
+    for key, null, value in zip(keys, nullable, values):
+        if value is None:
+            step = Q(pk__in=[])
+        else:
+            step = Q(**{key + '__lt': value})
+            if null:
+                step |= Q(**{key + '__isnull': True})
+        condition |= equal & step
+        equal &= Q(**{key + '__isnull': True}) if value is None else Q(**{key: value})
+    return condition
+
+
+def _before(keys, nullable, values):
+    condition = Q(pk__in=[])
+    equal = Q()
+    for key, null, value in zip(keys, nullable, values):
+        if value is None:
+            step = Q(**{key + '__isnull': False})
+        else:
+            step = Q(**{key + '__gt': value})
+        condition |= equal & step
+        equal &= Q(**{key + '__isnull': True}) if value is None else Q(**{key: value})
+    return condition
+
+
+def _ordering(keys, nullable, descending):
+    # Only spell out NULLS FIRST/LAST on nullable keys so the ordering of the
+    # other keys can still be served straight from an index
+    ordering = []
+    for key, null in zip(keys, nullable):
+        if descending:
+            ordering.append(F(key).desc(nulls_last=True) if null else F(key).desc())
+        else:
+            ordering.append(F(key).asc(nulls_first=True) if null else F(key).asc())
+    return ordering
+
+
+def get_page_size(request):
+    default = getattr(settings, 'KEYSET_PAGE_SIZE', 25)
+    maximum = getattr(settings, 'KEYSET_MAX_PAGE_SIZE', 200)
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except ValueError:
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+
+class KeysetPage:
+    def __init__(self, request, param, object_list, keys, has_next, has_previous):
+        self.request = request
+        self.param = param
+        self.object_list = object_list
+        self.keys = keys
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _key_values(self, obj):
+        return [getattr(obj, key) for key in self.keys]
+
+    def _querystring(self, cursor):
+        query = self.request.GET.copy()
+        query[self.param] = cursor
+        return query.urlencode()
+
+    @property
+    def next_querystring(self):
+        if not self.has_next or not self.object_list:
+            return ''
+        return self._querystring(encode_cursor('next', self._key_values(self.object_list[-1])))
+
+    @property
+    def previous_querystring(self):
+        if not self.has_previous or not self.object_list:
+            return ''
+        return self._querystring(encode_cursor('previous', self._key_values(self.object_list[0])))
+
+
+def keyset_paginate(request, queryset, keys, param='cursor', page_size=None, descending=True):
+    if page_size is None:
+        page_size = get_page_size(request)
+    fields = [queryset.model._meta.get_field(key) for key in keys]
+    nullable = [field.null for field in fields]
+    # Ascending listings walk the same order backwards
+    forward, backward = (_after, _before) if descending else (_before, _after)
+    forward_order = _ordering(keys, nullable, descending)
+    backward_order = _ordering(keys, nullable, not descending)
+
+    cursor = decode_cursor(request.GET.get(param, ''), fields)
+    if cursor is None:
+        rows = list(queryset.order_by(*forward_order)[:page_size + 1])
+        return KeysetPage(request, param, rows[:page_size], keys, len(rows) > page_size, False)
+
+    direction, values = cursor
+    if direction == 'next':
+        rows = list(queryset.filter(forward(keys, nullable, values)).order_by(*forward_order)[:page_size + 1])
+        return KeysetPage(request, param, rows[:page_size], keys, len(rows) > page_size, True)
+
+    rows = list(queryset.filter(backward(keys, nullable, values)).order_by(*backward_order)[:page_size + 1])
+    has_previous = len(rows) > page_size
+    rows = rows[:page_size]
+    rows.reverse()
+    return KeysetPage(request, param, rows, keys, True, has_previous)
@@ -0,0 +1,100 @@
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+# Counter of the async view being run, if any. Async views run their queries
+# in worker threads, each with its own connection, so the counter is
+# installed there by counting_queries() rather than around the view.
+_active_counter = ContextVar('query_budget_counter', default=None)
+
+
+@contextmanager
+def counting_queries():
+    counter = _active_counter.get()
+    if counter is None:
+        yield
+        return
+    with connection.execute_wrapper(counter):
+        yield
+
+
+def _check_budget(view_func, request, counter, max_queries):
+    request.query_count = counter.count
+    if counter.count > max_queries:
+        message = '%s issued %d queries (budget %d)' % (view_func.__name__, counter.count, max_queries)
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    else:
+        logger.debug('%s issued %d queries', view_func.__name__, counter.count)
+
+
+# Declare how many SQL queries a view may issue (template rendering included).
+# The count is stored on request.query_count. Going over budget is logged, or
+# raises QueryBudgetExceeded when settings.QUERY_BUDGET_STRICT is on.
+def query_budget(max_queries):
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def wrapper(request, *args, **kwargs):
+                counter = QueryCounter()
+                token = _active_counter.set(counter)
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                finally:
+                    _active_counter.reset(token)
+                _check_budget(view_func, request, counter, max_queries)
+                return response
+        else:
+            @wraps(view_func)
+            def wrapper(request, *args, **kwargs):
+                counter = QueryCounter()
+                with connection.execute_wrapper(counter):
+                    response = view_func(request, *args, **kwargs)
+                _check_budget(view_func, request, counter, max_queries)
+                return response
+
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
+
+
+# Test helper: mix into a TestCase to check responses against the budget
+# declared on the view that produced them.
+class QueryBudgetTestMixin:
+    def assertWithinQueryBudget(self, response):
+        view = response.resolver_match.func
+        budget = getattr(view, 'query_budget', None)
+        if budget is None:
+            self.fail('%s does not declare a query budget' % response.resolver_match.view_name)
+        request = response.asgi_request if hasattr(response, 'asgi_request') else response.wsgi_request
+        query_count = request.query_count
+        self.assertLessEqual(
+            query_count, budget,
+            '%s issued %d queries (budget %d)' % (response.resolver_match.view_name, query_count, budget),
+        )
+        return query_count
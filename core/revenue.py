@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, Sum
+
+from .models import Billing, DailyRevenue
+
+# DailyRevenue holds one row per (doctor, day) with the number and total of
+# that day's bills. Billing signals apply each change as a delta, so the
+# rollup stays exact without rescanning bills; rebuild_revenue() recomputes
+# it from Billing for bills written without signals (bulk loads, raw SQL).
+
+
+def _day(value):
+    # Billing.date may still hold the datetime it was assigned before saving
+    return value.date() if isinstance(value, datetime) else value
+
+
+def apply_delta(doctor_id, day, bill_count, amount):
+    if not bill_count and not amount:
+        return
+    rows = DailyRevenue.objects.filter(doctor_id=doctor_id, date=day)
+    changes = {'bill_count': F('bill_count') + bill_count, 'total_amount': F('total_amount') + amount}
+    if rows.update(**changes) or bill_count < 0:
+        # A removal with no row to take it from means the row went with its
+        # doctor (cascade delete); never create negative totals
+        return
+    try:
+        with transaction.atomic():
+            DailyRevenue.objects.create(doctor_id=doctor_id, date=day, bill_count=bill_count, total_amount=amount)
+    except IntegrityError:
+        # Another writer created the row first
+        rows.update(**changes)
+
+
+def billing_pre_save(instance):
+    # Remember what the row held before this save so post_save can move it
+    instance._revenue_previous = None
+    if instance.pk is not None:
+        instance._revenue_previous = (
+            Billing.objects.filter(pk=instance.pk).values_list('doctor_id', 'date', 'amount').first()
+        )
+
+
+def billing_saved(instance):
+    with transaction.atomic():
+        previous = getattr(instance, '_revenue_previous', None)
+        if previous is not None:
+            doctor_id, day, amount = previous
+            apply_delta(doctor_id, day, -1, -amount)
+        apply_delta(instance.doctor_id, _day(instance.date), 1, Decimal(instance.amount))
+    instance._revenue_previous = None
+
+
+def billing_deleted(instance):
+    apply_delta(instance.doctor_id, _day(instance.date), -1, -Decimal(instance.amount))
+
+
+def rebuild_revenue(date_from=None, date_to=None, chunk_days=31, progress=None):
+    # Recompute the rollup from Billing one window of days at a time, each in
+    # its own transaction, so a long history never holds one big lock
+    bounds = Billing.objects.aggregate(first=Min('date'), last=Max('date'))
+    if bounds['first'] is None:
+        DailyRevenue.objects.filter(**_range(date_from, date_to)).delete()
+        return 0
+    # Open ends cover every bill, and drop rollup rows beyond the last one
+    if date_from is None:
+        date_from = bounds['first']
+        DailyRevenue.objects.filter(date__lt=date_from).delete()
+    if date_to is None:
+        date_to = bounds['last']
+        DailyRevenue.objects.filter(date__gt=date_to).delete()
+
+    written = 0
+    start = date_from
+    while start <= date_to:
+        end = min(start + timedelta(days=chunk_days - 1), date_to)
+        totals = (
+            Billing.objects.filter(date__range=(start, end))
+            .values('doctor_id', 'date')
+            .annotate(bill_count=Count('id'), total_amount=Sum('amount'))
+            .order_by()
+        )
+        with transaction.atomic():
+            DailyRevenue.objects.filter(date__range=(start, end)).delete()
+            rows = DailyRevenue.objects.bulk_create([DailyRevenue(**row) for row in totals])
+        written += len(rows)
+        if progress:
+            progress(start, end, len(rows))
+        start = end + timedelta(days=1)
+    return written
+
+
+def _range(date_from, date_to):
+    filters = {}
+    if date_from:
+        filters['date__gte'] = date_from
+    if date_to:
+        filters['date__lte'] = date_to
+    return filters
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .models import Patient, Doctor, Staff
+
+# Checked in this order, matching the dashboard login redirects to
+ROLE_MODELS = {
+    'patient': Patient,
+    'doctor': Doctor,
+    'staff': Staff,
+}
+DASHBOARDS = {
+    'patient': 'patient_dashboard',
+    'doctor': 'doctor_dashboard',
+    'staff': 'staff_dashboard',
+}
+
+
+def role_cache_key(user_id):
+    return 'core:role:%s' % user_id
+
+
+def invalidate_role(user_id):
+    cache.delete(role_cache_key(user_id))
+
+
+def resolve_role(user):
+    # Returns (role, profile id), or (None, None) for users without a profile.
+    # One query with a join per profile table replaces a hasattr() probe per
+    # role, and the answer is cached until the user or a profile changes.
+    if not user.is_authenticated:
+        return None, None
+    key = role_cache_key(user.pk)
+    cached = cache.get(key)
+    if cached is not None:
+        return tuple(cached)
+    profile_ids = User.objects.filter(pk=user.pk).values_list(*ROLE_MODELS).first() or ()
+    resolved = (None, None)
+    for role, profile_id in zip(ROLE_MODELS, profile_ids):
+        if profile_id is not None:
+            resolved = (role, profile_id)
+            break
+    cache.set(key, resolved, getattr(settings, 'ROLE_CACHE_TIMEOUT', 300))
+    return resolved
+
+
+def remember_role(user):
+    # For a user fetched with select_related(*ROLE_MODELS) (as the login
+    # backend does): resolves and caches the role without a query
+    resolved = (None, None)
+    for role in ROLE_MODELS:
+        profile = getattr(user, role, None)
+        if profile is not None:
+            resolved = (role, profile.pk)
+            break
+    cache.set(role_cache_key(user.pk), resolved, getattr(settings, 'ROLE_CACHE_TIMEOUT', 300))
+    return resolved
+
+
+def load_profile(user, role, profile_id):
+    profile = ROLE_MODELS[role].objects.filter(pk=profile_id).first()
+    if profile is None:
+        # The cached role outlived the profile (e.g. deleted by another process)
+        invalidate_role(user.pk)
+        role, profile_id = resolve_role(user)
+        if role is None:
+            return None
+        profile = ROLE_MODELS[role].objects.get(pk=profile_id)
+    profile.user = user
+    return profile
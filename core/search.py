@@ -0,0 +1,187 @@
+import re
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Billing, Doctor, Patient, Prescription, Staff
+
+# Full-text search over patients, doctors, staff, prescriptions and bills,
+# backed by the SQLite FTS5 table core_search (created by migration 0026;
+# other databases have no search). Each record is one row whose rowid packs
+# the record's kind and id, so signals can upsert or delete a single
+# document by rowid. Only title and body are indexed; the other columns are
+# carried along to build results.
+
+TABLE = 'core_search'
+KINDS = {'patient': 1, 'doctor': 2, 'staff': 3, 'prescription': 4, 'bill': 5}
+MODELS = {'patient': Patient, 'doctor': Doctor, 'staff': Staff, 'prescription': Prescription, 'bill': Billing}
+KIND_OF = {model: kind for kind, model in MODELS.items()}
+PEOPLE = ('patient', 'doctor', 'staff')
+# User fields that end up in the index; saves touching none of them (e.g.
+# last_login on every login) leave it alone
+USER_FIELDS = {'username', 'first_name', 'last_name'}
+
+# Names score well above free text (weights follow the column order:
+# kind, object_id, patient_id, title, body)
+RANKING = 'bm25(%s, 0, 0, 0, 10.0, 1.0)' % TABLE
+
+NAMES = "coalesce(u.first_name, '') || ' ' || coalesce(u.last_name, '')"
+
+
+def _source(kind):
+    # SELECT producing (rowid, kind, object_id, patient_id, title, body) for
+    # every record of a kind; the record's table is aliased o
+    table = MODELS[kind]._meta.db_table
+    code = KINDS[kind]
+    people = 'FROM %s o JOIN auth_user u ON u.id = o.user_id' % table
+    columns = {
+        'patient': ("o.id", NAMES, "u.username || ' ' || coalesce(o.address, '') || ' ' || coalesce(o.medical_history, '')", people),
+        'doctor': ("NULL", NAMES, "u.username || ' ' || coalesce(o.specialty, '')", people),
+        'staff': ("NULL", NAMES, "u.username || ' ' || coalesce(o.role, '')", people),
+        'prescription': ("o.patient_id", "''", "coalesce(o.medicine, '') || ' ' || coalesce(o.dosage, '')", 'FROM %s o' % table),
+        'bill': ("o.patient_id", "''", "coalesce(o.description, '')", 'FROM %s o' % table),
+    }[kind]
+    patient_id, title, body, source = columns
+    return "SELECT o.id * 8 + %d, '%s', o.id, %s, %s, %s %s" % (code, kind, patient_id, title, body, source)
+
+
+def search_available():
+    return connection.vendor == 'sqlite'
+
+
+def index_document(kind, object_id):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT OR REPLACE INTO %s (rowid, kind, object_id, patient_id, title, body) %s WHERE o.id = %%s'
+            % (TABLE, _source(kind)),
+            [object_id],
+        )
+
+
+def remove_document(kind, object_id):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % TABLE, [object_id * 8 + KINDS[kind]])
+
+
+def index_user(user_id):
+    # Re-index whichever profile belongs to the user
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        for kind in PEOPLE:
+            cursor.execute(
+                'INSERT OR REPLACE INTO %s (rowid, kind, object_id, patient_id, title, body) %s WHERE o.user_id = %%s'
+                % (TABLE, _source(kind)),
+                [user_id],
+            )
+
+
+def document_saved(instance):
+    index_document(KIND_OF[type(instance)], instance.pk)
+
+
+def document_deleted(instance):
+    remove_document(KIND_OF[type(instance)], instance.pk)
+
+
+def user_saved(instance, update_fields=None):
+    if update_fields is not None and not USER_FIELDS & set(update_fields):
+        return
+    index_user(instance.pk)
+
+
+def rebuild_index():
+    # Repopulate from scratch with one INSERT ... SELECT per kind; returns
+    # the number of documents
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s' % TABLE)
+        for kind in KINDS:
+            cursor.execute('INSERT INTO %s (rowid, kind, object_id, patient_id, title, body) %s' % (TABLE, _source(kind)))
+        cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (TABLE, TABLE))
+        cursor.execute('SELECT count(*) FROM %s' % TABLE)
+        return cursor.fetchone()[0]
+
+
+def match_expression(text):
+    # Every word must match, as a prefix; quoting each token keeps FTS5
+    # query syntax (AND, NEAR, column filters, ...) out of user input
+    tokens = re.findall(r'\w+', text)
+    return ' '.join('"%s"*' % token for token in tokens)
+
+
+def _highlight(snippet):
+    return mark_safe(escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+
+class SearchPage:
+    def __init__(self, request, results, number, has_next):
+        self.request = request
+        self.results = results
+        self.number = number
+        self.has_next = has_next
+        self.has_previous = number > 1
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def _querystring(self, number):
+        query = self.request.GET.copy()
+        query['page'] = number
+        return query.urlencode()
+
+    @property
+    def next_querystring(self):
+        return self._querystring(self.number + 1) if self.has_next else ''
+
+    @property
+    def previous_querystring(self):
+        return self._querystring(self.number - 1) if self.has_previous else ''
+
+
+def search(request, text, kind=None, page_size=25):
+    try:
+        number = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        number = 1
+    expression = match_expression(text)
+    if not expression:
+        return SearchPage(request, [], 1, False)
+    sql = (
+        "SELECT kind, object_id, patient_id, title, snippet(%s, 4, char(2), char(3), '...', 12) FROM %s WHERE %s MATCH %%s"
+        % (TABLE, TABLE, TABLE)
+    )
+    params = [expression]
+    if kind:
+        sql += ' AND kind = %s'
+        params.append(kind)
+    sql += ' ORDER BY %s, rowid LIMIT %%s OFFSET %%s' % RANKING
+    params += [page_size + 1, (number - 1) * page_size]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    # Name the patient of each prescription and bill with one more query
+    patient_ids = {row[2] for row in rows if row[0] in ('prescription', 'bill') and row[2]}
+    patients = {}
+    if patient_ids:
+        names = Patient.objects.filter(id__in=patient_ids).values_list('id', 'user__first_name', 'user__last_name')
+        patients = {pk: ('%s %s' % (first, last)).strip() for pk, first, last in names}
+    results = [
+        {
+            'kind': kind,
+            'object_id': object_id,
+            'patient_id': patient_id,
+            'name': title.strip() or patients.get(patient_id, ''),
+            'snippet': _highlight(snippet),
+        }
+        for kind, object_id, patient_id, title, snippet in rows[:page_size]
+    ]
+    return SearchPage(request, results, number, len(rows) > page_size)
@@ -0,0 +1,137 @@
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Patient, Doctor, Staff, Appointment, Prescription, Billing
+from . import doctor_choices, invoices, revenue, search
+from .dashboard_cache import bump_counterpart_dashboards, bump_dashboard_version
+from .roles import invalidate_role
+from .user_cache import users
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    users.invalidate(instance.pk)
+    # Logins save last_login only, which cannot change the role
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    invalidate_role(instance.pk)
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, user, **kwargs):
+    if user is not None:
+        users.invalidate(user.pk)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    doctor_choices.user_saved(instance, update_fields)
+
+
+@receiver(post_save, sender=User)
+def user_renamed(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    # A new user has no appointments yet
+    if created or raw or (update_fields is not None and not {'first_name', 'last_name'} & set(update_fields)):
+        return
+    patient_id, doctor_id = User.objects.filter(pk=instance.pk).values_list('patient', 'doctor').first() or (None, None)
+    bump_counterpart_dashboards('patient', patient_id)
+    bump_counterpart_dashboards('doctor', doctor_id)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Doctor)
+def dashboard_profile_saved(sender, instance, created=False, raw=False, **kwargs):
+    # The profile may have been moved to another user, with another name
+    if not created and not raw:
+        bump_counterpart_dashboards('patient' if sender is Patient else 'doctor', instance.pk)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_save, sender=Staff)
+@receiver(post_delete, sender=Staff)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_role(instance.user_id)
+    users.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Doctor)
+def doctor_saved(sender, instance, **kwargs):
+    doctor_choices.doctor_saved(instance)
+
+
+@receiver(post_delete, sender=Doctor)
+def doctor_deleted(sender, instance, **kwargs):
+    doctor_choices.doctor_deleted(instance)
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+@receiver(post_save, sender=Prescription)
+@receiver(post_delete, sender=Prescription)
+@receiver(post_save, sender=Billing)
+@receiver(post_delete, sender=Billing)
+def dashboard_row_changed(sender, instance, **kwargs):
+    bump_dashboard_version('patient', instance.patient_id)
+    bump_dashboard_version('doctor', instance.doctor_id)
+
+
+@receiver(pre_save, sender=Billing)
+def billing_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        revenue.billing_pre_save(instance)
+
+
+@receiver(post_save, sender=Billing)
+def billing_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        revenue.billing_saved(instance)
+
+
+@receiver(post_delete, sender=Billing)
+def billing_deleted(sender, instance, **kwargs):
+    revenue.billing_deleted(instance)
+    # Once committed: a rolled back delete keeps its bill, and its invoice
+    transaction.on_commit(partial(invoices.bill_deleted, instance.pk))
+
+
+@receiver(post_save, sender=User)
+def user_search_document(sender, instance, update_fields=None, **kwargs):
+    search.user_saved(instance, update_fields)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Doctor)
+@receiver(post_save, sender=Staff)
+@receiver(post_save, sender=Prescription)
+@receiver(post_save, sender=Billing)
+def search_document_saved(sender, instance, **kwargs):
+    search.document_saved(instance)
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Staff)
+@receiver(post_delete, sender=Prescription)
+@receiver(post_delete, sender=Billing)
+def search_document_deleted(sender, instance, **kwargs):
+    search.document_deleted(instance)
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -1,3 +1,1433 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from unittest import skipIf
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Sum
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from .models import Patient, Doctor, Staff, Appointment, Billing, Inventory, Prescription, DailyRevenue, InventoryMovement, DoctorSchedule, Job
+from .pagination import encode_cursor, keyset_paginate
+from .query_budget import QueryBudgetTestMixin
+from .roles import resolve_role
+from .doctor_choices import get_doctor_choices
+from .forms import AppointmentForm
+from .inventory import InsufficientStock, record_movement, take_snapshots, with_ledger_quantity
+from .inventory_import import import_inventory_csv
+from .hashers import PBKDF2PasswordHasher
+from .metrics import Registry, registry
+from .middleware import brotli
+from .user_cache import users
+from .search import match_expression
+from .availability import SlotTaken, book_slot, free_slots
+from . import invoices, jobs
+from . import views
+
+
+def make_patient(username):
+    user = User.objects.create_user(username, first_name=username.title(), last_name='Patient')
+    return Patient.objects.create(user=user, dob=date(1980, 1, 1), address='1 Ward Street', phone='555', medical_history='')
+
+
+def make_doctor(username, specialty='Cardiology'):
+    user = User.objects.create_user(username, first_name=username.title(), last_name='Doctor')
+    return Doctor.objects.create(user=user, specialty=specialty, phone='555')
+
+
+def make_staff(username, role='Nurse'):
+    user = User.objects.create_user(username, first_name=username.title(), last_name='Staff')
+    return Staff.objects.create(user=user, role=role, phone='555')
+
+
+def populate(patient, doctor, rows, prefix='extra'):
+    start = timezone.now()
+    for i in range(rows):
+        name = '%s%d' % (prefix, i)
+        other_patient = make_patient(name + '_patient')
+        other_doctor = make_doctor(name + '_doctor')
+        make_staff(name + '_staff')
+        Appointment.objects.create(patient=patient, doctor=other_doctor, date=start + timedelta(days=i))
+        Appointment.objects.create(patient=other_patient, doctor=doctor, date=start + timedelta(days=i))
+        Prescription.objects.create(patient=patient, doctor=other_doctor, medicine='Aspirin %d' % i)
+        Billing.objects.create(patient=patient, doctor=other_doctor, amount=Decimal('10.00'), date=date.today(), description='Bill %d' % i)
+        Inventory.objects.create(item_name='Item ' + name, quantity=i, date=date.today())
+
+
+# Dashboard fragments are not cached here so the full render is counted
+@override_settings(QUERY_BUDGET_STRICT=True, DASHBOARD_CACHE_TIMEOUT=0)
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.staff = make_staff('carol')
+
+    def assertConstantQueries(self, user, url):
+        # The query count must not grow with the number of rows listed
+        self.client.force_login(user)
+        counts = []
+        for prefix, rows in (('small', 1), ('large', 5)):
+            populate(self.patient, self.doctor, rows, prefix)
+            self.client.get(url)  # warm the caches, which the new rows dropped
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts.append(self.assertWithinQueryBudget(response))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_patient_dashboard(self):
+        self.assertConstantQueries(self.patient.user, reverse('patient_dashboard'))
+
+    def test_doctor_dashboard(self):
+        self.assertConstantQueries(self.doctor.user, reverse('doctor_dashboard'))
+
+    def test_manage_appointments(self):
+        self.assertConstantQueries(self.doctor.user, reverse('manage_appointments'))
+
+    def test_staff_dashboard(self):
+        self.assertConstantQueries(self.staff.user, reverse('staff_dashboard'))
+
+    def test_view_prescriptions_and_bills(self):
+        self.assertConstantQueries(self.staff.user, reverse('view_prescriptions_and_bills'))
+
+    def test_view_prescriptions(self):
+        self.assertConstantQueries(self.patient.user, reverse('view_prescriptions'))
+
+    def test_view_prescriptions_as_staff(self):
+        self.assertConstantQueries(self.staff.user, reverse('view_prescriptions'))
+
+    def test_book_appointment(self):
+        self.assertConstantQueries(self.patient.user, reverse('book_appointment'))
+
+    def test_manage_prescriptions(self):
+        self.assertConstantQueries(self.doctor.user, reverse('manage_prescriptions', args=[self.patient.id]))
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.staff = make_staff('carol')
+        patient = make_patient('alice')
+        doctor = make_doctor('bob')
+        same_day = date(2024, 1, 1)
+        for i in range(7):
+            Inventory.objects.create(item_name='Item %d' % i, quantity=i, date=same_day if i < 4 else date(2024, 1, i))
+        for i in range(5):
+            Prescription.objects.create(patient=patient, doctor=doctor, medicine='Medicine %d' % i)
+        # Rows from before created_at existed sort last
+        Prescription.objects.filter(medicine__in=['Medicine 1', 'Medicine 3']).update(created_at=None)
+
+    def walk(self, queryset, keys):
+        factory = RequestFactory()
+        request = factory.get('/', {'page_size': 3})
+        pages = [keyset_paginate(request, queryset, keys, 'cursor')]
+        while pages[-1].has_next:
+            request = factory.get('/?' + pages[-1].next_querystring)
+            pages.append(keyset_paginate(request, queryset, keys, 'cursor'))
+        forward = [[obj.id for obj in page] for page in pages]
+
+        backward = []
+        page = pages[-1]
+        while page.has_previous:
+            page = keyset_paginate(factory.get('/?' + page.previous_querystring), queryset, keys, 'cursor')
+            backward.insert(0, [obj.id for obj in page])
+        self.assertEqual(backward, forward[:-1])
+        return [obj_id for page_ids in forward for obj_id in page_ids]
+
+    def test_walks_every_row_once_in_order(self):
+        ids = self.walk(Inventory.objects.all(), ('date', 'id'))
+        expected = list(Inventory.objects.order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_nullable_key(self):
+        ids = self.walk(Prescription.objects.all(), ('created_at', 'id'))
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+        tail = Prescription.objects.filter(id__in=ids[-2:])
+        self.assertTrue(all(p.created_at is None for p in tail))
+
+    def test_invalid_cursor_returns_first_page(self):
+        for cursor in ('not-a-cursor', encode_cursor('next', ['garbage', 'x']), encode_cursor('next', [None, 1]),
+                       encode_cursor('next', ['2024-01-01', [1]]), encode_cursor('next', ['2024-13-01', 1])):
+            request = RequestFactory().get('/', {'cursor': cursor, 'page_size': 3})
+            page = keyset_paginate(request, Inventory.objects.all(), ('date', 'id'), 'cursor')
+            self.assertFalse(page.has_previous)
+            self.assertTrue(page.has_next)
+            self.assertEqual(len(page), 3)
+        self.client.force_login(self.staff.user)
+        response = self.client.get(reverse('staff_dashboard'), {'inventory': encode_cursor('next', ['garbage', 'x'])})
+        self.assertEqual(response.status_code, 200)
+
+    def test_staff_dashboard_links(self):
+        self.client.force_login(self.staff.user)
+        response = self.client.get(reverse('staff_dashboard'), {'page_size': 2})
+        self.assertEqual(len(response.context['inventories']), 2)
+        self.assertContains(response, 'inventory=')
+
+    def test_prescription_listing_pages(self):
+        self.client.force_login(self.staff.user)
+        response = self.client.get(reverse('view_prescriptions'), {'page_size': 2})
+        self.assertEqual(len(response.context['prescriptions']), 2)
+        self.assertContains(response, 'prescriptions=')
+        response = self.client.get(reverse('view_prescriptions') + '?' + response.context['prescriptions'].next_querystring)
+        self.assertContains(response, 'Previous')
+
+
+class BenchUrlsCommandTests(TestCase):
+    def setUp(self):
+        caches['dashboard'].clear()
+        patient = make_patient('alice')
+        doctor = make_doctor('bob')
+        make_staff('carol')
+        populate(patient, doctor, 2)
+
+    def test_reports_every_safe_route_and_compares_baseline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'baseline.json')
+            call_command('bench_urls', iterations=2, warmup=0, host='testserver', output=output, stdout=StringIO(), stderr=StringIO())
+            with open(output) as f:
+                results = json.load(f)
+            self.assertIn('staff_dashboard', results)
+            self.assertNotIn('delete_bill', results)
+            self.assertEqual(results['patient_dashboard']['status'], 200)
+            self.assertGreater(results['patient_dashboard']['bytes'], 0)
+            # The cold first render counts, not just the cached last one
+            self.assertGreater(results['patient_dashboard']['queries'], results['patient_dashboard']['queries_min'])
+
+            # A baseline faster than today is a regression
+            results['patient_dashboard']['p95_ms'] = 0.0
+            with open(output, 'w') as f:
+                json.dump(results, f)
+            with self.assertRaisesMessage(CommandError, 'patient_dashboard'):
+                call_command('bench_urls', iterations=2, warmup=0, host='testserver', only=['patient_dashboard'],
+                             baseline=output, stdout=StringIO(), stderr=StringIO())
+
+
+class RoleResolutionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_role_is_resolved_once_and_cached(self):
+        staff = make_staff('carol')
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_role(staff.user), ('staff', staff.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_role(staff.user), ('staff', staff.id))
+
+    def test_profile_changes_invalidate_cache(self):
+        user = User.objects.create_user('dave')
+        self.assertEqual(resolve_role(user), (None, None))
+        doctor = Doctor.objects.create(user=user, specialty='Neurology', phone='555')
+        self.assertEqual(resolve_role(user), ('doctor', doctor.id))
+        doctor.delete()
+        self.assertEqual(resolve_role(user), (None, None))
+
+    def test_request_role_and_profile(self):
+        patient = make_patient('alice')
+        self.client.force_login(patient.user)
+        response = self.client.get(reverse('patient_dashboard'))
+        request = response.wsgi_request
+        self.assertEqual(request.role, 'patient')
+        self.assertEqual(request.profile_id, patient.id)
+        self.assertEqual(request.profile.pk, patient.pk)
+
+    def test_login_redirects_to_role_dashboard(self):
+        doctor = make_doctor('bob')
+        doctor.user.set_password('s3cret-pass')
+        doctor.user.save()
+        response = self.client.post(reverse('login'), {'username': 'bob', 'password': 's3cret-pass'})
+        self.assertRedirects(response, reverse('doctor_dashboard'))
+
+
+class DoctorChoiceCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cardiologist = make_doctor('bob', 'Cardiology')
+        self.neurologist = make_doctor('dan', 'Neurology')
+
+    def test_form_renders_without_queries_once_cached(self):
+        get_doctor_choices()
+        with self.assertNumQueries(0):
+            html = AppointmentForm().as_p()
+        self.assertIn('Bob Doctor - Doctor (Cardiology)', html)
+
+    def test_cache_follows_doctor_and_user_changes(self):
+        get_doctor_choices()
+        with self.assertNumQueries(0):
+            self.assertEqual([c[0] for c in get_doctor_choices()], [self.cardiologist.id, self.neurologist.id])
+        new = make_doctor('amy', 'Cardiology')
+        self.neurologist.user.first_name = 'Zed'
+        self.neurologist.user.save()
+        self.cardiologist.delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_doctor_choices(), [
+                (new.id, 'Amy Doctor', 'Cardiology'),
+                (self.neurologist.id, 'Zed Doctor', 'Neurology'),
+            ])
+        # Saving a patient, or a doctor's login, keeps the cached choices
+        make_patient('alice').user.save()
+        new.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            get_doctor_choices()
+
+    def test_specialty_filter(self):
+        form = AppointmentForm(specialty='Neurology')
+        self.assertNotIn('Cardiology', form.as_p())
+        form = AppointmentForm({'doctor': self.cardiologist.id, 'date': '2030-01-01T10:00'}, specialty='Neurology')
+        self.assertIn('doctor', form.errors)
+        form = AppointmentForm({'doctor': self.neurologist.id, 'date': '2030-01-01T10:00'}, specialty='Neurology')
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['doctor'], self.neurologist)
+
+
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        caches['dashboard'].clear()
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.other_doctor = make_doctor('dan')
+        Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=timezone.now())
+
+    def test_repeat_view_is_served_from_cache(self):
+        self.client.force_login(self.doctor.user)
+        url = reverse('doctor_dashboard')
+        Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=timezone.now())
+        first = self.client.get(url)
+        self.assertGreater(first.wsgi_request.query_count, 0)
+        self.assertContains(first, 'Alice Patient')
+        # Another session, with its own CSRF token, shares the fragment
+        other = Client()
+        other.force_login(self.doctor.user)
+        second = other.get(url)
+        self.assertEqual(second.wsgi_request.query_count, 0)
+        self.assertContains(second, 'Alice Patient')
+        self.assertContains(second, 'csrfmiddlewaretoken')
+        self.assertNotEqual(first.cookies['csrftoken'].value, second.cookies['csrftoken'].value)
+
+    def test_renaming_a_patient_refreshes_their_doctors_dashboards(self):
+        self.client.force_login(self.doctor.user)
+        self.client.get(reverse('doctor_dashboard'))
+        self.patient.user.first_name = 'Alicia'
+        self.patient.user.save()
+        response = self.client.get(reverse('doctor_dashboard'))
+        self.assertContains(response, 'Alicia Patient')
+        # Logins only save last_login and leave the fragments alone
+        self.patient.user.save(update_fields=['last_login'])
+        response = self.client.get(reverse('doctor_dashboard'))
+        self.assertEqual(response.wsgi_request.query_count, 0)
+
+    def test_changes_invalidate_only_the_affected_users(self):
+        self.client.force_login(self.patient.user)
+        self.client.get(reverse('patient_dashboard'))
+        self.client.force_login(self.other_doctor.user)
+        self.client.get(reverse('doctor_dashboard'))
+
+        Billing.objects.create(patient=self.patient, doctor=self.doctor, amount=Decimal('42.00'), date=date.today(), description='Checkup')
+        self.client.force_login(self.patient.user)
+        response = self.client.get(reverse('patient_dashboard'))
+        self.assertContains(response, 'Checkup')
+        self.client.force_login(self.other_doctor.user)
+        response = self.client.get(reverse('doctor_dashboard'))
+        self.assertEqual(response.wsgi_request.query_count, 0)
+
+        Appointment.objects.filter(doctor=self.doctor).delete()
+        self.client.force_login(self.doctor.user)
+        response = self.client.get(reverse('doctor_dashboard'))
+        self.assertContains(response, 'No appointments found.')
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.staff = make_staff('carol')
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.other_doctor = make_doctor('dan')
+        for i, doctor in enumerate((self.doctor, self.other_doctor, self.doctor)):
+            Billing.objects.create(patient=self.patient, doctor=doctor, amount=Decimal('10.50'), date=date(2024, 1, i + 1), description='Bill, %d' % i)
+            Prescription.objects.create(patient=self.patient, doctor=doctor, medicine='Medicine %d' % i)
+
+    def export(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_csv_with_filters(self):
+        self.client.force_login(self.staff.user)
+        body = self.export('export_bills', doctor=self.doctor.id, date_from='2024-01-02')
+        self.assertEqual(body.splitlines(), [
+            'id,date,patient,doctor,amount,description',
+            '%d,2024-01-03,Alice Patient,Bob Doctor,10.50,"Bill, 2"' % Billing.objects.get(date=date(2024, 1, 3)).id,
+        ])
+
+    def test_ndjson(self):
+        self.client.force_login(self.staff.user)
+        rows = [json.loads(line) for line in self.export('export_prescriptions', format='ndjson').splitlines()]
+        self.assertEqual([row['medicine'] for row in rows], ['Medicine 0', 'Medicine 1', 'Medicine 2'])
+        self.assertEqual(rows[1]['doctor'], 'Dan Doctor')
+
+    def test_staff_only_and_validation(self):
+        self.client.force_login(self.patient.user)
+        self.assertRedirects(self.client.get(reverse('export_bills')), reverse('home'), fetch_redirect_response=False)
+        self.client.force_login(self.staff.user)
+        response = self.client.get(reverse('export_bills'), {'date_from': '2024-02-01', 'date_to': '2024-01-01'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_records', 'bills', '--doctor', str(self.other_doctor.id), '--chunk-size', '1', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+        with self.assertRaises(CommandError):
+            call_command('export_records', 'bills', '--date-from', 'yesterday', stdout=out)
+
+
+class InventoryImportTests(TestCase):
+    CSV = (
+        'item_name,quantity,date\n'
+        'Bandages,40,2024-03-01\n'
+        'Gloves,-1,2024-03-01\n'
+        'Syringes,100,2024-03-02\n'
+        'Masks,ten,2024-03-02\n'
+        'Bandages,45,2024-03-03\n'
+    )
+
+    def setUp(self):
+        self.staff = make_staff('carol')
+        Inventory.objects.create(item_name='Syringes', quantity=5, date=date(2024, 1, 1))
+
+    def test_upload_upserts_and_reports_errors(self):
+        self.client.force_login(self.staff.user)
+        upload = SimpleUploadedFile('inventory.csv', self.CSV.encode())
+        response = self.client.post(reverse('import_inventory'), {'file': upload})
+        result = response.context['result']
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual([line for line, error in result.errors], [3, 5])
+        self.assertEqual(
+            sorted(Inventory.objects.values_list('item_name', 'quantity')),
+            [('Bandages', 45), ('Syringes', 100)],
+        )
+
+    def test_command_round_trips_the_export(self):
+        Inventory.objects.create(item_name='Gauze', quantity=7, date=date(2024, 1, 2))
+        self.client.force_login(self.staff.user)
+        exported = b''.join(self.client.get(reverse('export_inventory')).streaming_content)
+        Inventory.objects.update(quantity=0)
+        with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as f:
+            f.write(exported)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('import_inventory', f.name, '--chunk-size', '1', stdout=out)
+        self.assertIn('0 created, 2 updated, 0 skipped', out.getvalue())
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [5, 7])
+
+    @override_settings(INVENTORY_IMPORT_CHUNK_SIZE=1)
+    def test_unreadable_file_imports_nothing(self):
+        self.client.force_login(self.staff.user)
+        for content, error in (
+            (b'item_name,quantity,date\nBandages,40,2024-03-01\nGloves,5,' + b'9' * 200000 + b'\n', 'Unreadable CSV after line 2: field larger than field limit'),
+            (b'item_name,quantity,date\nBandages,40,2024-03-01\nGloves,5,\xff\n', 'can&#x27;t decode byte 0xff'),
+        ):
+            upload = SimpleUploadedFile('inventory.csv', content)
+            response = self.client.post(reverse('import_inventory'), {'file': upload})
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, error)
+            self.assertFalse(Inventory.objects.filter(item_name='Bandages').exists())
+
+    def test_missing_columns(self):
+        self.client.force_login(self.staff.user)
+        upload = SimpleUploadedFile('inventory.csv', b'name,quantity\nBandages,1\n')
+        response = self.client.post(reverse('import_inventory'), {'file': upload})
+        self.assertContains(response, 'Missing column(s): item_name, date')
+        self.assertEqual(
+            self.client.get(reverse('export_inventory'), {'doctor': make_doctor('bob').id}).status_code, 400
+        )
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_pragmas_applied_on_connect(self):
+        if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+            self.skipTest('SQLite pragmas not enabled')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -64 * 1024)
+
+
+# Seeding drops and rebuilds indexes, which SQLite cannot do inside the
+# transaction a TestCase wraps each test in
+class SeedHospitalTests(TransactionTestCase):
+    def test_chunked_seed(self):
+        call_command(
+            'seed_hospital', patients=7, doctors=3, staff=2, appointments=300, prescriptions=11, bills=13,
+            inventory=5, chunk_size=4, seed=1, stdout=StringIO(),
+        )
+        self.assertEqual(
+            [model.objects.count() for model in (Patient, Doctor, Staff, Appointment, Prescription, Billing, Inventory)],
+            [7, 3, 2, 300, 11, 13, 5],
+        )
+        self.assertEqual(User.objects.count(), 12)
+        patients = set(Patient.objects.values_list('id', flat=True))
+        doctors = set(Doctor.objects.values_list('id', flat=True))
+        for model in (Appointment, Prescription, Billing):
+            self.assertLessEqual(set(model.objects.values_list('patient_id', flat=True)), patients)
+            self.assertLessEqual(set(model.objects.values_list('doctor_id', flat=True)), doctors)
+        self.assertLessEqual(set(DoctorSchedule.objects.values_list('doctor_id', flat=True)), doctors)
+        self.assertEqual(Billing.objects.aggregate(total=Sum('amount'))['total'], DailyRevenue.objects.aggregate(total=Sum('total_amount'))['total'])
+        # No doctor has two open appointments at the same time
+        open_appointments = Appointment.objects.filter(status__in=['Scheduled', 'Accepted', 'Rescheduled'])
+        self.assertGreater(open_appointments.count(), 0)
+        self.assertFalse(open_appointments.values('doctor_id', 'date').annotate(n=Count('id')).filter(n__gt=1).exists())
+        self.assertFalse(open_appointments.filter(date__lt=timezone.now()).exists())
+
+
+class JournalModeTests(TransactionTestCase):
+    def test_journal_mode_is_switched_by_the_command_only(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'delete')
+        out = StringIO()
+        call_command('sqlite_journal_mode', 'wal', stdout=out)
+        self.addCleanup(call_command, 'sqlite_journal_mode', 'delete', stdout=StringIO())
+        self.assertIn('is WAL', out.getvalue())
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+
+    def test_concurrency_benchmark_restores_the_journal_mode(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        make_patient('alice')
+        make_doctor('bob')
+        out = StringIO()
+        call_command('bench_db_concurrency', '--compare', '--seconds', '0.2', '--threads', '1', stdout=out)
+        self.assertIn('Throughput gain', out.getvalue())
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'delete')
+        self.assertEqual(Appointment.objects.count(), 0)
+
+
+# URLconf routing the dashboards to their async views, as under ASGI
+urlpatterns = [
+    path('patient_dashboard/', views.patient_dashboard_async, name='patient_dashboard'),
+    path('staff_dashboard/', views.staff_dashboard_async, name='staff_dashboard'),
+    path('', include('core.urls')),
+]
+
+
+# Sequential fallback: worker threads' connections would not see the test
+# transaction
+@override_settings(ROOT_URLCONF=__name__, DASHBOARD_CONCURRENT_QUERIES=False, QUERY_BUDGET_STRICT=True)
+class AsyncDashboardTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        caches['dashboard'].clear()
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.staff = make_staff('carol')
+        populate(self.patient, self.doctor, 3)
+
+    async def test_patient_dashboard(self):
+        await self.async_client.aforce_login(self.patient.user)
+        response = await self.async_client.get(reverse('patient_dashboard'))
+        self.assertContains(response, 'Bill 2')
+        self.assertContains(response, 'Extra0_Doctor Doctor')
+        self.assertEqual(self.assertWithinQueryBudget(response), 2)
+        response = await self.async_client.get(reverse('patient_dashboard'))
+        self.assertEqual(response.asgi_request.query_count, 0)  # fragment cached
+
+    async def test_staff_dashboard_and_fallbacks(self):
+        response = await self.async_client.get(reverse('staff_dashboard'))
+        self.assertRedirects(response, settings.LOGIN_URL + '?next=' + reverse('staff_dashboard'), fetch_redirect_response=False)
+        await self.async_client.aforce_login(self.staff.user)
+        response = await self.async_client.get(reverse('staff_dashboard'), {'page_size': 2})
+        self.assertContains(response, 'Item extra2')
+        self.assertNotContains(response, 'Item extra0')
+        self.assertContains(response, 'Extra2_Doctor Doctor')
+        await self.async_client.aforce_login(self.patient.user)
+        response = await self.async_client.get(reverse('staff_dashboard'))
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+
+
+@override_settings(ROOT_URLCONF=__name__, DASHBOARD_CACHE_TIMEOUT=0)
+class ConcurrentDashboardQueryTests(TransactionTestCase):
+    def test_queries_run_in_worker_threads(self):
+        patient = make_patient('alice')
+        populate(patient, make_doctor('bob'), 2)
+        self.client.force_login(patient.user)
+        response = self.client.get(reverse('patient_dashboard'))
+        self.assertContains(response, 'Bill 1')
+        self.assertEqual(response.wsgi_request.query_count, 2)
+
+
+class RevenueRollupTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.other_doctor = make_doctor('dan')
+
+    def bill(self, amount, day, doctor=None):
+        return Billing.objects.create(patient=self.patient, doctor=doctor or self.doctor, amount=Decimal(amount), date=day, description='')
+
+    def rollup(self):
+        return sorted(DailyRevenue.objects.filter(bill_count__gt=0).values_list('doctor_id', 'date', 'bill_count', 'total_amount'))
+
+    def expected(self):
+        return sorted(
+            (row['doctor_id'], row['date'], row['n'], row['total'])
+            for row in Billing.objects.values('doctor_id', 'date').annotate(n=Count('id'), total=Sum('amount'))
+        )
+
+    def test_signals_keep_rollup_exact(self):
+        day = date(2024, 5, 1)
+        first = self.bill('10.00', day)
+        second = self.bill('5.50', day)
+        self.bill('7.25', day, self.other_doctor)
+        self.assertEqual(self.rollup(), self.expected())
+        second.amount = Decimal('6.00')
+        second.date = date(2024, 5, 2)
+        second.save()
+        first.delete()
+        self.assertEqual(self.rollup(), self.expected())
+        self.other_doctor.delete()
+        self.assertEqual(self.rollup(), self.expected())
+
+    def test_backfill_and_report(self):
+        for i in range(40):
+            self.bill('1.50', date(2024, 1, 1) + timedelta(days=i))
+        Billing.objects.update(amount=Decimal('2.00'))  # bypasses signals
+        DailyRevenue.objects.create(doctor=self.doctor, date=date(2023, 1, 1), bill_count=3, total_amount=9)
+        call_command('backfill_revenue', '--chunk-days', '7', stdout=StringIO())
+        self.assertEqual(self.rollup(), self.expected())
+
+        staff = make_staff('carol')
+        self.client.force_login(staff.user)
+        get_doctor_choices()  # the doctor filter's choices are cached
+        response = self.client.get(reverse('revenue_report'), {'date_from': '2024-01-01', 'date_to': '2024-01-10', 'doctor': self.doctor.id})
+        self.assertEqual(response.context['totals'], {'bills': 10, 'amount': Decimal('20.00')})
+        self.assertEqual(len(response.context['by_day']), 10)
+        self.assertContains(response, 'Bob Doctor')
+        self.assertWithinQueryBudget(response)
+
+
+class InventoryLedgerTests(TestCase):
+    def setUp(self):
+        self.staff = make_staff('carol')
+        self.client.force_login(self.staff.user)
+        self.client.post(reverse('add_inventory'), {'item_name': 'Gauze', 'quantity': 20, 'date': '2024-01-01'})
+        self.item = Inventory.objects.get(item_name='Gauze')
+
+    def assertLedgerMatches(self):
+        for item in with_ledger_quantity():
+            self.assertEqual(item.quantity, item.ledger_quantity, item.item_name)
+
+    def test_movements_apply_atomically(self):
+        stale = Inventory.objects.get(pk=self.item.pk)
+        record_movement(self.item.pk, InventoryMovement.RECEIPT, 5)
+        response = self.client.post(reverse('update_inventory', args=[self.item.pk]), {'action': 'movement', 'kind': 'dispense', 'quantity': 8, 'note': 'Ward 3'})
+        self.assertRedirects(response, reverse('update_inventory', args=[self.item.pk]), fetch_redirect_response=False)
+        with self.assertRaises(InsufficientStock):
+            record_movement(self.item.pk, InventoryMovement.DISPENSE, 18)
+        # Editing the details from a stale copy keeps the stock
+        response = self.client.post(reverse('update_inventory', args=[stale.pk]), {'action': 'details', 'item_name': 'Sterile gauze', 'date': '2024-02-01'})
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.item_name, self.item.quantity), ('Sterile gauze', 17))
+        self.assertEqual(list(self.item.movements.order_by('id').values_list('quantity_change', flat=True)), [20, 5, -8])
+        self.assertLedgerMatches()
+
+    def test_snapshots_and_drift(self):
+        self.assertEqual(take_snapshots(), Inventory.objects.count())
+        snapshot = self.item.snapshots.get()
+        self.assertEqual(
+            (snapshot.quantity, snapshot.last_movement_id),
+            (self.item.quantity, self.item.movements.order_by('-id').values_list('id', flat=True).first()),
+        )
+        self.assertIsNotNone(snapshot.taken_at)
+        record_movement(self.item.pk, InventoryMovement.ADJUSTMENT, -3)
+        import_inventory_csv(['item_name,quantity,date', 'Gauze,30,2024-01-02', 'Swabs,4,2024-01-02'])
+        self.assertEqual(Inventory.objects.get(item_name='Gauze').quantity, 30)
+        self.assertLedgerMatches()
+        call_command('snapshot_inventory', '--verify', stdout=StringIO())
+        Inventory.objects.filter(pk=self.item.pk).update(quantity=99)
+        with self.assertRaises(CommandError):
+            call_command('snapshot_inventory', '--verify', stdout=StringIO(), stderr=StringIO())
+
+    def test_low_stock_lists_lowest_first(self):
+        for quantity in (12, 3, 0, 7):
+            Inventory.objects.create(item_name='Item %d' % quantity, quantity=quantity, date=date.today())
+        response = self.client.get(reverse('low_stock'), {'page_size': 2})
+        self.assertEqual([item.quantity for item in response.context['items']], [0, 3])
+        response = self.client.get(reverse('low_stock') + '?' + response.context['items'].next_querystring)
+        self.assertEqual([item.quantity for item in response.context['items']], [7])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.staff = make_staff('carol')
+        self.client.force_login(self.staff.user)
+        self.patient = make_patient('margaret')
+        self.patient.medical_history = 'Type 2 diabetes, managed with metformin'
+        self.patient.save()
+        self.doctor = make_doctor('greg', specialty='Diabetology')
+
+    def search(self, q, **params):
+        return self.client.get(reverse('search_records'), {'q': q, **params}).context['results']
+
+    def test_ranked_prefix_matches(self):
+        other = make_patient('walter')
+        prescription = Prescription.objects.create(patient=other, doctor=self.doctor, medicine='Metformin', dosage='500mg twice daily')
+        results = list(self.search('metf'))
+        self.assertEqual([(r['kind'], r['object_id']) for r in results][:2], [('prescription', prescription.pk), ('patient', self.patient.pk)])
+        # Prescriptions are named after their patient
+        self.assertEqual(results[0]['name'], 'Walter Patient')
+        self.assertIn('<mark>metformin</mark>', str(results[1]['snippet']))
+        # A match on the name outranks one in free text
+        self.assertEqual([r['kind'] for r in self.search('diab')], ['doctor', 'patient'])
+        self.assertEqual([r['kind'] for r in self.search('diab', kind='patient')], ['patient'])
+
+    def test_index_follows_edits_and_deletes(self):
+        bill = Billing.objects.create(patient=self.patient, doctor=self.doctor, amount=Decimal('40.00'), date=date.today(), description='Consultation')
+        self.assertEqual(len(self.search('consult')), 1)
+        bill.description = 'Blood panel'
+        bill.save()
+        self.assertEqual(len(self.search('consult')), 0)
+        self.assertEqual(len(self.search('blood')), 1)
+        # Renaming the user re-indexes the profile; logins do not touch it
+        self.patient.user.last_name = 'Hopper'
+        self.patient.user.save()
+        self.assertEqual([r['name'] for r in self.search('hopper')], ['Margaret Hopper'])
+        with self.assertNumQueries(1):
+            self.patient.user.save(update_fields=['last_login'])
+        self.patient.delete()
+        self.assertEqual(len(self.search('hopper')), 0)
+        self.assertEqual(len(self.search('blood')), 0)
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(match_expression('NEAR(body: "x") OR -y*'), '"NEAR"* "body"* "x"* "OR"* "y"*')
+        self.assertEqual(len(self.search('margaret AND')), 0)
+        self.assertEqual(len(self.search('margaret ward')), 1)
+        self.assertEqual(len(self.search('  ** ')), 0)
+
+    def test_pagination(self):
+        for i in range(5):
+            make_patient('ward%d' % i)
+        page = self.search('ward', page_size=2)
+        self.assertEqual(len(page), 6)
+        with override_settings(SEARCH_PAGE_SIZE=4):
+            first = self.search('ward')
+            second = self.client.get(reverse('search_records') + '?' + first.next_querystring).context['results']
+        self.assertTrue(first.has_next)
+        self.assertFalse(second.has_next)
+        self.assertEqual(len({r['object_id'] for r in first} | {r['object_id'] for r in second}), 6)
+
+
+class DashboardApiTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        populate(self.patient, self.doctor, 3)
+
+    def poll(self, name, etag=None, **params):
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.client.get(reverse(name), params, headers=headers)
+        self.assertWithinQueryBudget(response)
+        return response
+
+    def test_patient_dashboard_conditional_get(self):
+        self.client.force_login(self.patient.user)
+        response = self.poll('api_patient_dashboard')
+        data = response.json()
+        self.assertEqual([len(data[key]) for key in ('appointments', 'prescriptions', 'bills')], [3, 3, 3])
+        self.assertEqual(data['bills'][0]['amount'], '10.00')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        # An unchanged poll is answered after the one aggregate query
+        response = self.poll('api_patient_dashboard', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.wsgi_request.query_count, 1)
+        self.assertEqual(response.content, b'')
+
+        bill = Billing.objects.filter(patient=self.patient).first()
+        bill.description = 'Corrected'
+        bill.save()
+        changed = self.poll('api_patient_dashboard', etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        bill.delete()
+        deleted = self.poll('api_patient_dashboard', changed['ETag'])
+        self.assertEqual(len(deleted.json()['bills']), 2)
+        self.assertNotEqual(deleted['ETag'], changed['ETag'])
+
+    def test_doctor_endpoints(self):
+        self.client.force_login(self.doctor.user)
+        appointment = Appointment.objects.filter(doctor=self.doctor).first()
+        appointment.status = 'Accepted'
+        appointment.save()
+        response = self.poll('api_doctor_dashboard')
+        self.assertEqual(len(response.json()['appointments']), 3)
+        self.assertEqual(response.json()['appointments'][0]['last_name'], 'Patient')
+        response = self.poll('api_manage_appointments', status='Accepted')
+        self.assertEqual([a['id'] for a in response.json()['appointments']], [appointment.pk])
+        self.assertEqual(self.poll('api_manage_appointments', response['ETag'], status='Accepted').status_code, 304)
+        # Changes outside the filter still revalidate the dashboard listing
+        etag = self.poll('api_doctor_dashboard')['ETag']
+        Appointment.objects.filter(doctor=self.doctor, status='Scheduled').first().save()
+        self.assertEqual(self.poll('api_doctor_dashboard', etag).status_code, 200)
+        self.assertEqual(self.poll('api_patient_dashboard').status_code, 403)
+
+    def test_renames_revalidate(self):
+        self.client.force_login(self.doctor.user)
+        etag = self.poll('api_doctor_dashboard')['ETag']
+        self.assertEqual(self.poll('api_doctor_dashboard', etag).status_code, 304)
+        user = Appointment.objects.filter(doctor=self.doctor).first().patient.user
+        user.last_name = 'Renamed'
+        user.save()
+        response = self.poll('api_doctor_dashboard', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Renamed', [a['last_name'] for a in response.json()['appointments']])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.staff = make_staff('carol')
+        self.client.force_login(self.staff.user)
+
+    def series(self, text, prefix):
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(prefix)}
+
+    def test_requests_are_recorded_and_exported(self):
+        self.client.get(reverse('low_stock'))
+        self.client.get(reverse('low_stock'))
+        self.client.get('/no-such-page/')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertIn('# TYPE hms_request_duration_seconds histogram', text)
+        requests = self.series(text, 'hms_requests_total')
+        self.assertEqual(requests['hms_requests_total{view="low_stock",method="GET",status="200"}'], 2)
+        self.assertEqual(requests['hms_requests_total{view="<unresolved>",method="GET",status="404"}'], 1)
+        self.assertEqual(self.series(text, 'hms_request_duration_seconds_count{view="low_stock"}'), {'hms_request_duration_seconds_count{view="low_stock"}': 2})
+        # Every request ran queries (session and user lookups count too)
+        queries = self.series(text, 'hms_request_sql_queries_bucket{view="low_stock"')
+        self.assertEqual(queries['hms_request_sql_queries_bucket{view="low_stock",le="0"}'], 0)
+        self.assertEqual(queries['hms_request_sql_queries_bucket{view="low_stock",le="+Inf"}'], 2)
+        self.assertGreater(self.series(text, 'hms_request_template_duration_seconds_sum{view="low_stock"}').popitem()[1], 0)
+        self.assertGreater(self.series(text, 'hms_response_size_bytes_sum{view="low_stock"}').popitem()[1], 500)
+
+    def test_slow_request_log_and_access(self):
+        with override_settings(SLOW_REQUEST_MS=0), self.assertLogs('core.metrics.slow', 'WARNING') as logs:
+            self.client.get(reverse('low_stock'))
+        self.assertIn('Slow request: GET low_stock (200)', logs.output[0])
+        self.assertIn('FROM "core_inventory"', logs.output[0])
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 403)
+
+    def test_export_format(self):
+        metrics = Registry()
+        metrics.describe('x_seconds', 'histogram', 'X')
+        for value in (0.1, 0.5, 3):
+            metrics.observe('x_seconds', (('view', 'a"b'),), value, (0.1, 1.0))
+        self.assertEqual(metrics.export(), '\n'.join([
+            '# HELP x_seconds X',
+            '# TYPE x_seconds histogram',
+            'x_seconds_bucket{view="a\\"b",le="0.1"} 1',
+            'x_seconds_bucket{view="a\\"b",le="1.0"} 2',
+            'x_seconds_bucket{view="a\\"b",le="+Inf"} 3',
+            'x_seconds_sum{view="a\\"b"} 3.6',
+            'x_seconds_count{view="a\\"b"} 3',
+        ]) + '\n')
+
+
+class CountingHasher(PBKDF2PasswordHasher):
+    verified = 0
+
+    def verify(self, password, encoded):
+        CountingHasher.verified += 1
+        return super().verify(password, encoded)
+
+
+@override_settings(PASSWORD_HASHERS=['core.tests.CountingHasher'], PASSWORD_PBKDF2_ITERATIONS=1000)
+class LoginTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        CountingHasher.verified = 0
+        self.doctor = make_doctor('bob')
+        self.doctor.user.set_password('s3cret-pass')
+        self.doctor.user.save()
+
+    def test_login_hashes_once_and_knows_the_role(self):
+        response = self.client.post(reverse('login'), {'username': 'bob', 'password': 's3cret-pass'})
+        self.assertRedirects(response, reverse('doctor_dashboard'), fetch_redirect_response=False)
+        self.assertEqual(CountingHasher.verified, 1)
+        # Saving last_login left the role the login cached in place
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_role(self.doctor.user), ('doctor', self.doctor.pk))
+
+    def test_wrong_password_and_unknown_user(self):
+        response = self.client.post(reverse('login'), {'username': 'bob', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].is_valid())
+        response = self.client.post(reverse('login'), {'username': 'nobody', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CountingHasher.verified, 1)
+
+    def test_iterations_are_configurable(self):
+        self.assertTrue(self.doctor.user.password.startswith('pbkdf2_sha256$1000$'))
+        with override_settings(PASSWORD_PBKDF2_ITERATIONS=2000):
+            self.client.post(reverse('login'), {'username': 'bob', 'password': 's3cret-pass'})
+        self.doctor.user.refresh_from_db()
+        self.assertTrue(self.doctor.user.password.startswith('pbkdf2_sha256$2000$'))
+
+    def test_bench_login_command(self):
+        out = StringIO()
+        call_command('bench_login', logins=2, host='testserver', stdout=out)
+        self.assertIn('hashes', out.getvalue())
+        self.assertFalse(User.objects.filter(username='bench_login_user').exists())
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        users.clear()
+        self.staff = make_staff('carol')
+        self.staff.user.set_password('s3cret-pass')
+        self.staff.user.save()
+        self.client.login(username='carol', password='s3cret-pass')
+        # First request caches the session, user, role and profile
+        self.client.get(reverse('low_stock'))
+
+    def test_steady_state_requests_query_only_in_the_view(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('low_stock'))
+        self.assertEqual(response.wsgi_request.user, self.staff.user)
+        self.assertEqual(response.wsgi_request.profile.pk, self.staff.pk)
+
+    def test_changes_and_logout_invalidate(self):
+        other = self.client_class()
+        other.login(username='carol', password='s3cret-pass')
+        other.get(reverse('low_stock'))
+        # A password change ends the other sessions at once
+        self.staff.user.set_password('n3w-pass-word')
+        self.staff.user.save()
+        response = other.get(reverse('low_stock'))
+        self.assertRedirects(response, settings.LOGIN_URL + '?next=' + reverse('low_stock'), fetch_redirect_response=False)
+
+        self.staff.user.first_name = 'Caroline'
+        self.staff.user.save()
+        self.client.login(username='carol', password='n3w-pass-word')
+        self.assertEqual(self.client.get(reverse('low_stock')).wsgi_request.user.first_name, 'Caroline')
+        self.client.get(reverse('logout'))
+        self.assertIsNone(users.get(self.staff.user.pk))
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions(self):
+        # A new client, as middleware picks the session engine when loaded
+        client = self.client_class()
+        client.login(username='carol', password='s3cret-pass')
+        client.get(reverse('low_stock'))
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(reverse('low_stock')).status_code, 200)
+
+
+@override_settings(COMPRESSION_ENABLED=True, COMPRESSION_MIN_SIZE=1024)
+class CompressionTests(TestCase):
+    def setUp(self):
+        self.staff = make_staff('carol')
+        populate(make_patient('alice'), make_doctor('bob'), 30)
+        # A new client, as middleware is set up when the client first uses it
+        self.client = self.client_class()
+        self.client.force_login(self.staff.user)
+
+    def test_gzip_over_threshold_only(self):
+        plain = self.client.get(reverse('staff_dashboard'))
+        response = self.client.get(reverse('staff_dashboard'), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Cookie, Accept-Encoding')
+        self.assertLess(len(response.content), len(plain.content) / 3)
+        # Same page; only the masked CSRF tokens differ between renders
+        self.assertEqual(len(gzip.decompress(response.content)), len(plain.content))
+        small = self.client.get(reverse('api_patient_dashboard'), headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse(small.has_header('Content-Encoding'))
+        refused = self.client.get(reverse('staff_dashboard'), headers={'Accept-Encoding': 'gzip;q=0, br;q=0'})
+        self.assertFalse(refused.has_header('Content-Encoding'))
+
+    def test_streaming_export(self):
+        response = self.client.get(reverse('export_bills'), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'Bill 29', gzip.decompress(b''.join(response.streaming_content)))
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli_preferred(self):
+        plain = self.client.get(reverse('staff_dashboard'))
+        response = self.client.get(reverse('staff_dashboard'), headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(len(brotli.decompress(response.content)), len(plain.content))
+
+
+class StaticCssTests(TestCase):
+    def test_templates_link_hashed_css(self):
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root, STORAGES={
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'},
+        }):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            response = self.client.get(reverse('home'))
+            self.assertNotContains(response, '<style>')
+            href = response.content.decode().split('<link rel="stylesheet" href="/static/')[1].split('"')[0]
+            self.assertRegex(href, r'^core/css/home\.[0-9a-f]{12}\.css$')
+
+            request = RequestFactory().get('/static/' + href)
+            response = views.static_file(request, href)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=%d, immutable' % settings.STATIC_MAX_AGE)
+            response = views.static_file(request, 'core/css/home.css')
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+
+
+def at(day, hour, minute=0):
+    return timezone.make_aware(datetime.combine(day, time(hour, minute)))
+
+
+class AvailabilityTests(QueryBudgetTestMixin, TestCase):
+    monday = date(2030, 1, 7)
+
+    def setUp(self):
+        cache.clear()
+        self.patient = make_patient('alice')
+        self.cardiologist = make_doctor('bob', 'Cardiology')
+        self.neurologist = make_doctor('dan', 'Neurology')
+
+    def starts(self, doctor_ids, start, end, limit=None):
+        return [(slot.doctor_id, slot.start) for slot in free_slots(doctor_ids, start, end, limit)]
+
+    def test_default_hours_skip_booked_slots(self):
+        bob = self.cardiologist
+        Appointment.objects.create(patient=self.patient, doctor=bob, date=at(self.monday, 9, 30))
+        # Off the slot grid: takes up parts of the 10:00 and 10:30 slots
+        Appointment.objects.create(patient=self.patient, doctor=bob, date=at(self.monday, 10, 15))
+        Appointment.objects.create(patient=self.patient, doctor=bob, date=at(self.monday, 11), status='Canceled')
+        starts = self.starts([bob.id], at(self.monday, 0), at(self.monday, 12))
+        self.assertEqual(starts, [(bob.id, at(self.monday, 9)), (bob.id, at(self.monday, 11)), (bob.id, at(self.monday, 11, 30))])
+        # Weekends are off by default; a search from Saturday finds Monday 9:00
+        self.assertEqual(self.starts([bob.id], at(self.monday - timedelta(days=2), 8), at(self.monday, 23), 1), [(bob.id, at(self.monday, 9))])
+        # A search starting mid-slot begins at the next slot
+        self.assertEqual(self.starts([bob.id], at(self.monday, 11, 5), at(self.monday, 23), 1), [(bob.id, at(self.monday, 11, 30))])
+
+    def test_schedules_and_merge_across_doctors(self):
+        bob, dan = self.cardiologist, self.neurologist
+        DoctorSchedule.objects.create(doctor=dan, weekday=0, start_time=time(8), end_time=time(9), slot_minutes=20)
+        DoctorSchedule.objects.create(doctor=dan, weekday=0, start_time=time(13), end_time=time(13, 40), slot_minutes=20)
+        Appointment.objects.create(patient=self.patient, doctor=dan, date=at(self.monday, 8, 20))
+        self.assertEqual(self.starts([bob.id, dan.id], at(self.monday, 0), at(self.monday, 10)), [
+            (dan.id, at(self.monday, 8)), (dan.id, at(self.monday, 8, 40)), (bob.id, at(self.monday, 9)), (bob.id, at(self.monday, 9, 30)),
+        ])
+        self.assertEqual(self.starts([dan.id], at(self.monday, 10), at(self.monday + timedelta(days=7), 8, 10)), [
+            (dan.id, at(self.monday, 13)), (dan.id, at(self.monday, 13, 20)), (dan.id, at(self.monday + timedelta(days=7), 8)),
+        ])
+        # Slots past the first window are still found, in order
+        starts = self.starts([bob.id], at(self.monday, 0), at(self.monday + timedelta(days=14), 0))
+        self.assertEqual(len(starts), 10 * 16)
+        self.assertEqual(starts, sorted(starts))
+
+    def test_appointment_form_only_accepts_free_slots(self):
+        bob = self.cardiologist
+        Appointment.objects.create(patient=self.patient, doctor=bob, date=at(self.monday, 9))
+        cases = {
+            '2030-01-07T09:00': 'already booked',
+            '2030-01-07T09:10': 'no appointment slot',
+            '2030-01-05T10:00': 'no appointment slot',
+            '2020-01-06T10:00': 'in the future',
+        }
+        for when, error in cases.items():
+            form = AppointmentForm({'doctor': bob.id, 'date': when})
+            self.assertFalse(form.is_valid())
+            self.assertIn(error, form.errors['date'][0])
+            self.assertEqual(list(form.errors), ['date'])
+        self.assertTrue(AppointmentForm({'doctor': bob.id, 'date': '2030-01-07T09:30'}).is_valid())
+
+    def test_free_slots_api(self):
+        self.client.force_login(self.patient.user)
+        response = self.client.get(reverse('api_free_slots'), {'specialty': 'Cardiology', 'date_from': '2030-01-05', 'limit': 3})
+        self.assertWithinQueryBudget(response)
+        slots = response.json()['slots']
+        self.assertEqual([slot['start'] for slot in slots], ['2030-01-07T09:00:00Z', '2030-01-07T09:30:00Z', '2030-01-07T10:00:00Z'])
+        self.assertEqual(slots[0], {
+            'doctor_id': self.cardiologist.id, 'doctor': 'Bob Doctor', 'specialty': 'Cardiology',
+            'start': '2030-01-07T09:00:00Z', 'end': '2030-01-07T09:30:00Z',
+        })
+        response = self.client.get(reverse('api_free_slots'), {'doctor': self.neurologist.id, 'date_from': '2030-01-05', 'days': 2})
+        self.assertEqual(response.json()['slots'], [])
+        self.assertEqual(self.client.get(reverse('api_free_slots'), {'limit': 0}).status_code, 400)
+
+    def test_booking_page_offers_free_slots(self):
+        self.client.force_login(self.patient.user)
+        response = self.client.get(reverse('book_appointment'), {'specialty': 'Neurology'})
+        self.assertWithinQueryBudget(response)
+        self.assertContains(response, 'with Dan Doctor')
+        self.assertNotContains(response, 'with Bob Doctor')
+        response = self.client.post(reverse('book_appointment'), {'doctor': self.cardiologist.id, 'date': '2030-01-07T09:00'})
+        self.assertRedirects(response, reverse('patient_dashboard'), fetch_redirect_response=False)
+        response = self.client.post(reverse('book_appointment'), {'doctor': self.cardiologist.id, 'date': '2030-01-07T09:00'})
+        self.assertContains(response, 'already booked', status_code=409)
+        self.assertEqual(Appointment.objects.filter(doctor=self.cardiologist).count(), 1)
+
+    @override_settings(AVAILABILITY_PAGE_DOCTORS=1)
+    def test_booking_page_searches_only_once_narrowed(self):
+        self.client.force_login(self.patient.user)
+        get_doctor_choices()
+        response = self.client.get(reverse('book_appointment'))
+        self.assertEqual(response.wsgi_request.query_count, 0)
+        self.assertContains(response, 'Choose a specialty, doctor or date')
+        self.assertNotContains(response, 'class="slot"')
+        # Only the first doctors by name are searched
+        response = self.client.get(reverse('book_appointment'), {'date_from': '2030-01-07'})
+        self.assertWithinQueryBudget(response)
+        self.assertContains(response, 'with Bob Doctor')
+        self.assertNotContains(response, 'with Dan Doctor')
+        self.assertContains(response, 'choose a doctor to see the others')
+        response = self.client.get(reverse('book_appointment'), {'doctor': self.neurologist.id, 'date_from': '2030-01-07'})
+        self.assertContains(response, 'with Dan Doctor')
+        self.assertNotContains(response, 'with Bob Doctor')
+
+
+class BookingConflictTests(TestCase):
+    monday = date(2030, 1, 7)
+
+    def setUp(self):
+        cache.clear()
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.booked = Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=at(self.monday, 9))
+
+    def test_open_appointments_cannot_share_a_start(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Appointment.objects.create(patient=make_patient('erin'), doctor=self.doctor, date=at(self.monday, 9))
+        Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=at(self.monday, 9), status='Canceled')
+
+    def test_book_slot_refuses_taken_slots(self):
+        for when in (at(self.monday, 9), at(self.monday, 8, 45)):
+            Appointment.objects.filter(pk=self.booked.pk).update(date=when)
+            with self.assertRaises(SlotTaken):
+                book_slot(Appointment(patient=self.patient, doctor=self.doctor, date=at(self.monday, 9)))
+        self.assertEqual(Appointment.objects.count(), 1)
+        book_slot(Appointment(patient=self.patient, doctor=self.doctor, date=at(self.monday, 9, 30)))
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_reschedule(self):
+        other = Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=at(self.monday, 10))
+        self.client.force_login(self.doctor.user)
+        url = reverse('manage_appointments')
+        response = self.client.post(url, {'appointment_id': other.pk, 'action': 'Reschedule', 'new_date': '2030-01-07T09:00'})
+        self.assertIn('already booked', str(list(get_messages(response.wsgi_request))[0]))
+        other.refresh_from_db()
+        self.assertEqual((other.date, other.status), (at(self.monday, 10), 'Scheduled'))
+        # Moving within its own slot's neighbourhood does not conflict with itself
+        self.client.post(url, {'appointment_id': other.pk, 'action': 'Reschedule', 'new_date': '2030-01-07T10:30'})
+        other.refresh_from_db()
+        self.assertEqual((other.date, other.status), (at(self.monday, 10, 30), 'Rescheduled'))
+        # A canceled appointment cannot be reopened over a newer booking
+        canceled = Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=at(self.monday, 9), status='Canceled')
+        response = self.client.post(url, {'appointment_id': canceled.pk, 'action': 'Accept'})
+        self.assertIn('already booked', str(list(get_messages(response.wsgi_request))[0]))
+        canceled.refresh_from_db()
+        self.assertEqual(canceled.status, 'Canceled')
+        # Doctors only act on their own appointments
+        self.client.force_login(make_doctor('dan').user)
+        response = self.client.post(url, {'appointment_id': other.pk, 'action': 'Cancel'})
+        self.assertEqual(response.status_code, 404)
+
+
+class BatchActionTests(QueryBudgetTestMixin, TestCase):
+    monday = date(2030, 1, 7)
+
+    def setUp(self):
+        cache.clear()
+        self.patient = make_patient('alice')
+        self.doctor = make_doctor('bob')
+        self.client.force_login(self.doctor.user)
+
+    def book(self, hour, minute=0, doctor=None, **kwargs):
+        return Appointment.objects.create(patient=self.patient, doctor=doctor or self.doctor, date=at(self.monday, hour, minute), **kwargs)
+
+    def post(self, data):
+        response = self.client.post(reverse('api_batch_appointments'), data)
+        self.assertWithinQueryBudget(response)
+        return response
+
+    def results(self, response):
+        return [(row['id'], row['result']) for row in response.json()['results']]
+
+    def test_status_actions_take_one_update(self):
+        counts = []
+        for hours in (range(9, 11), range(11, 17)):
+            ids = [self.book(hour).pk for hour in hours]
+            response = self.post({'action': 'Accept', 'appointment_ids': ids})
+            self.assertEqual(self.results(response), [(pk, 'ok') for pk in ids])
+            counts.append(response.wsgi_request.query_count)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(set(Appointment.objects.values_list('status', flat=True)), {'Accepted'})
+
+    def test_ownership_and_outcomes(self):
+        mine = self.book(9)
+        theirs = self.book(9, doctor=make_doctor('dan'))
+        response = self.post({'action': 'Cancel', 'appointment_ids': [theirs.pk, mine.pk, 999, mine.pk]})
+        self.assertEqual(self.results(response), [(theirs.pk, 'not_found'), (mine.pk, 'ok'), (999, 'not_found')])
+        theirs.refresh_from_db()
+        self.assertEqual(theirs.status, 'Scheduled')
+        # Reopening over a newer booking, or twice at the same time, conflicts
+        self.book(9)
+        again = self.book(9, status='Canceled')
+        response = self.post({'action': 'Accept', 'appointment_ids': [mine.pk, again.pk]})
+        self.assertEqual(self.results(response), [(mine.pk, 'conflict'), (again.pk, 'conflict')])
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor, status='Canceled').count(), 2)
+        # An open appointment overlapping the slot at another start time
+        # conflicts as well, like it would for a booking
+        self.book(10, 10)
+        overlapped = self.book(10, status='Canceled')
+        free = self.book(11, status='Completed')
+        response = self.post({'action': 'Accept', 'appointment_ids': [overlapped.pk, free.pk]})
+        self.assertEqual(self.results(response), [(overlapped.pk, 'conflict'), (free.pk, 'ok')])
+
+    def test_reschedule(self):
+        self.book(9)
+        moved, clash, later, weekend, undated = (self.book(hour) for hour in (11, 12, 13, 14, 15))
+        response = self.post({
+            'action': 'Reschedule',
+            'appointment_ids': [moved.pk, clash.pk, later.pk, weekend.pk, undated.pk],
+            'new_date_%d' % moved.pk: '2030-01-07T10:00',
+            'new_date_%d' % clash.pk: '2030-01-07T10:00',
+            # Into the time `moved` gives up
+            'new_date_%d' % later.pk: '2030-01-07T11:00',
+            'new_date_%d' % weekend.pk: '2030-01-05T10:00',
+        })
+        self.assertEqual(self.results(response), [
+            (moved.pk, 'ok'), (clash.pk, 'conflict'), (later.pk, 'ok'), (weekend.pk, 'invalid'), (undated.pk, 'invalid'),
+        ])
+        rows = dict(Appointment.objects.values_list('id', 'date'))
+        self.assertEqual([rows[pk] for pk in (moved.pk, clash.pk, later.pk)], [at(self.monday, 10), at(self.monday, 12), at(self.monday, 11)])
+        self.assertEqual(Appointment.objects.get(pk=moved.pk).status, 'Rescheduled')
+
+    def test_invalid_requests(self):
+        url = reverse('api_batch_appointments')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url, {'action': 'Delete', 'appointment_ids': [1]}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'action': 'Accept'}).status_code, 400)
+        with override_settings(BATCH_ACTION_MAX_APPOINTMENTS=2):
+            self.assertEqual(self.client.post(url, {'action': 'Accept', 'appointment_ids': [1, 2, 3]}).status_code, 400)
+        self.client.force_login(self.patient.user)
+        self.assertEqual(self.client.post(url, {'action': 'Accept', 'appointment_ids': [1]}).status_code, 403)
+
+    def test_dashboard_batch_form(self):
+        first, second = self.book(9), self.book(10)
+        url = reverse('manage_appointments')
+        self.client.get(url)
+        response = self.client.post(url, {'action': 'Complete', 'appointment_ids': [first.pk, second.pk, 999]}, follow=True)
+        self.assertContains(response, 'Completed 2 appointments.')
+        self.assertContains(response, 'Appointment #999: No such appointment of yours.')
+        # The cached list is re-rendered for the doctor and the patient
+        self.assertNotContains(response, 'Scheduled')
+        response = self.client.post(url, {'action': 'Cancel:%d' % first.pk}, follow=True)
+        self.assertContains(response, 'Canceled 1 appointment.')
+        self.client.force_login(self.patient.user)
+        self.assertContains(self.client.get(reverse('patient_dashboard')), 'Canceled')
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    def test_no_double_bookings(self):
+        make_doctor('bob')
+        for index in range(8):
+            make_patient('patient%d' % index)
+        out = StringIO()
+        call_command('bench_booking', bookings=200, threads=8, slots=4, host='testserver', stdout=out)
+        self.assertIn('booked                4', out.getvalue())
+        self.assertIn('No double bookings', out.getvalue())
+        self.assertEqual(Appointment.objects.count(), 0)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.failures = 0
+        jobs.job('test_job')(self.handler)
+        self.addCleanup(jobs.handlers.pop, 'test_job')
+
+    def handler(self, value):
+        self.calls.append(value)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Flaky')
+
+    def test_generate_bill_renders_the_invoice_in_a_job(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.enterContext(override_settings(INVOICE_CACHE_DIR=cache_dir.name))
+        patient, doctor = make_patient('alice'), make_doctor('bob')
+        prescription = Prescription.objects.create(patient=patient, doctor=doctor, medicine='Aspirin')
+        self.client.force_login(make_staff('carol').user)
+        response = self.client.post(reverse('generate_bill', args=[prescription.pk]), {
+            'billing_amount': '42.00', 'date': '2030-01-07', 'description': 'Checkup',
+        })
+        self.assertRedirects(response, reverse('view_prescriptions_and_bills'))
+        # The bill is complete without a worker
+        bill = Billing.objects.get()
+        self.assertEqual((bill.description, bill.date), ('Bill generated for Alice Patient by Dr. Bob Doctor', timezone.localdate()))
+        self.assertEqual(DailyRevenue.objects.get().total_amount, Decimal('42.00'))
+        results = self.client.get(reverse('search_records'), {'q': 'generated', 'kind': 'bill'}).context['results']
+        self.assertEqual([r['object_id'] for r in results], [bill.pk])
+        job = Job.objects.get()
+        self.assertEqual((job.name, job.key, job.status), ('render_invoice', 'render_invoice:%d' % bill.pk, Job.QUEUED))
+        self.assertEqual(list(Path(cache_dir.name).rglob('*.html')), [])
+        self.assertEqual(jobs.run_pending(), {Job.SUCCEEDED: 1})
+        [invoice] = Path(cache_dir.name).rglob('*.html')
+        self.assertIn('Alice Patient', invoice.read_text())
+
+    def test_idempotency_keys(self):
+        first = jobs.enqueue('test_job', key='once', value=1)
+        self.assertEqual(jobs.enqueue('test_job', key='once', value=2), first)
+        jobs.enqueue('test_job', value=3)
+        jobs.run_pending()
+        self.assertEqual(self.calls, [1, 3])
+        with self.assertRaises(ValueError):
+            jobs.enqueue('no_such_job')
+
+    def test_retries_with_backoff(self):
+        self.failures = 2
+        job = jobs.enqueue('test_job', max_attempts=3, value=1)
+        with self.assertLogs('core.jobs', 'WARNING'):
+            self.assertEqual(jobs.run_pending(), {Job.QUEUED: 1})
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('RuntimeError: Flaky', job.last_error)
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=settings.JOB_RETRY_DELAY - 1))
+        # Not due yet
+        self.assertEqual(jobs.run_pending(), {})
+        for expected in (Job.QUEUED, Job.SUCCEEDED):
+            Job.objects.update(run_at=timezone.now())
+            with self.assertNoLogs('core.jobs', 'ERROR'):
+                self.assertEqual(jobs.run_pending(), {expected: 1})
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, len(self.calls)), (Job.SUCCEEDED, 3, 3))
+
+        self.failures = 1
+        job = jobs.enqueue('test_job', max_attempts=1, value=2)
+        with self.assertLogs('core.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), {Job.FAILED: 1})
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+
+    def test_abandoned_jobs_are_requeued(self):
+        job = jobs.enqueue('test_job', max_attempts=2, value=1)
+        self.assertEqual(jobs.claim('lost-worker').pk, job.pk)
+        self.assertIsNone(jobs.claim('other-worker'))
+        Job.objects.update(started_at=timezone.now() - timedelta(seconds=settings.JOB_TIMEOUT + 1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        jobs.claim('lost-worker')
+        Job.objects.update(started_at=timezone.now() - timedelta(seconds=settings.JOB_TIMEOUT + 1))
+        self.assertEqual(jobs.requeue_stale(), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+
+class JobWorkerTests(TransactionTestCase):
+    def test_each_job_runs_once(self):
+        calls = []
+        lock = threading.Lock()
+
+        def handler(value):
+            with lock:
+                calls.append(value)
+        jobs.job('test_job')(handler)
+        self.addCleanup(jobs.handlers.pop, 'test_job')
+        for value in range(40):
+            jobs.enqueue('test_job', value=value)
+        out = StringIO()
+        call_command('run_workers', burst=True, threads=4, stdout=out)
+        self.assertIn('Ran 40 job(s)', out.getvalue())
+        self.assertEqual(sorted(calls), list(range(40)))
+        self.assertEqual(Job.objects.filter(status=Job.SUCCEEDED).count(), 40)
+
+
+class InvoiceArchiveTests(TransactionTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.enterContext(override_settings(INVOICE_CACHE_DIR=cache_dir.name, INVOICE_PROCESSES=1))
+        self.patient, self.doctor = make_patient('alice'), make_doctor('bob')
+        self.bills = [
+            Billing.objects.create(patient=self.patient, doctor=self.doctor, amount=Decimal('10.50') + day, date=date(2030, 1, day), description='Visit %d' % day)
+            for day in range(1, 6)
+        ]
+
+    def archive(self, **options):
+        stats = invoices.ArchiveStats()
+        with zipfile.ZipFile(io.BytesIO(b''.join(invoices.invoice_archive(stats, **options)))) as archive:
+            return {name: archive.read(name).decode() for name in archive.namelist()}, stats
+
+    def test_archive_and_cache(self):
+        documents, stats = self.archive(date_from=date(2030, 1, 2), date_to=date(2030, 1, 4), chunk_size=2)
+        self.assertEqual(sorted(documents), ['invoice-%d.html' % bill.pk for bill in self.bills[1:4]])
+        self.assertIn('Alice Patient', documents['invoice-%d.html' % self.bills[1].pk])
+        self.assertIn('12.50', documents['invoice-%d.html' % self.bills[1].pk])
+        self.assertEqual((stats.invoices, stats.cached), (3, 0))
+        # Unchanged bills come from the cache; a changed one is rendered
+        # again and its old version dropped
+        self.bills[2].description = 'Follow-up'
+        self.bills[2].save()
+        documents, stats = self.archive(date_from=date(2030, 1, 2), date_to=date(2030, 1, 4))
+        self.assertEqual((stats.invoices, stats.cached), (3, 2))
+        self.assertIn('Follow-up', documents['invoice-%d.html' % self.bills[2].pk])
+        cached = sorted(path.name for path in Path(settings.INVOICE_CACHE_DIR).rglob('*.html'))
+        self.assertEqual([name.split('-')[0] for name in cached], sorted(str(bill.pk) for bill in self.bills[1:4]))
+
+    def test_cache_of_deleted_bills_is_evicted(self):
+        self.archive()
+        cached = lambda: sorted(int(path.name.split('-')[0]) for path in Path(settings.INVOICE_CACHE_DIR).rglob('*.html'))
+        self.assertEqual(cached(), [bill.pk for bill in self.bills])
+        self.bills[0].delete()
+        self.assertEqual(cached(), [bill.pk for bill in self.bills[1:]])
+        # Bills removed without signals are swept by prune_cache()
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE id = %%s' % Billing._meta.db_table, [self.bills[1].pk])
+        self.assertEqual(invoices.prune_cache(chunk_size=2), 1)
+        self.assertEqual(cached(), [bill.pk for bill in self.bills[2:]])
+
+    def test_command_renders_in_a_process_pool(self):
+        output = os.path.join(settings.INVOICE_CACHE_DIR, 'invoices.zip')
+        out = StringIO()
+        call_command('render_invoices', output, date_from='2030-01-01', processes=2, chunk_size=2, stdout=out)
+        self.assertIn('5 invoices (0 from cache, 5 rendered)', out.getvalue())
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(archive.namelist(), ['invoice-%d.html' % bill.pk for bill in self.bills])
+        with self.assertRaises(CommandError):
+            call_command('render_invoices', output, date_from='2030-01-05', date_to='2030-01-01')
+
+    def test_staff_view(self):
+        url = reverse('invoice_archive')
+        self.client.force_login(make_staff('carol').user)
+        self.assertContains(self.client.get(url), 'Download')
+        response = self.client.get(url, {'date_from': '2030-01-05', 'download': '1'})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['invoice-%d.html' % self.bills[-1].pk])
+        self.client.force_login(self.patient.user)
+        self.assertRedirects(self.client.get(url, {'download': '1'}), reverse('home'), fetch_redirect_response=False)
 
-# Create your tests here.
@@ -1,6 +1,14 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI the patient and staff dashboards are served by async views that
+# run their queries concurrently
+if settings.ASYNC_DASHBOARDS:
+    patient_dashboard, staff_dashboard = views.patient_dashboard_async, views.staff_dashboard_async
+else:
+    patient_dashboard, staff_dashboard = views.patient_dashboard, views.staff_dashboard
+
 urlpatterns = [
     path('', views.home, name='home'),
     path('register_patient/', views.register, {'role': 'patient'}, name='register_patient'),
@@ -8,14 +16,16 @@ urlpatterns = [
     path('register_staff/', views.register, {'role': 'staff'}, name='register_staff'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
-    path('patient_dashboard/', views.patient_dashboard, name='patient_dashboard'),
+    path('patient_dashboard/', patient_dashboard, name='patient_dashboard'),
     path('doctor_dashboard/', views.doctor_dashboard, name='doctor_dashboard'),
-    path('staff_dashboard/', views.staff_dashboard, name='staff_dashboard'),
+    path('staff_dashboard/', staff_dashboard, name='staff_dashboard'),
     path('book_appointment/', views.book_appointment, name='book_appointment'),
     path('delete_appointment/<int:appointment_id>/', views.delete_appointment, name='delete_appointment'),
     path('manage_appointments/', views.manage_appointments, name='manage_appointments'),
     path('add_inventory/', views.add_inventory, name='add_inventory'),
     path('update_inventory/<int:id>/', views.update_inventory, name='update_inventory'),
+    path('import_inventory/', views.import_inventory, name='import_inventory'),
+    path('low_stock/', views.low_stock, name='low_stock'),
     path('view_prescriptions/', views.view_prescriptions, name='view_prescriptions'),
     path('delete_prescription/<int:prescription_id>/', views.delete_prescription, name='delete_prescription'),
     path('generate-bill/<int:prescription_id>/', views.generate_bill, name='generate_bill'),
@@ -28,5 +38,17 @@ urlpatterns = [
     path('add_staff/', views.add_staff, name='add_staff'),
     path('delete_doctor/<int:doctor_id>/', views.delete_doctor, name='delete_doctor'),
     path('delete_staff/<int:staff_id>/', views.delete_staff, name='delete_staff'),
+    path('export/bills/', views.export_records, {'kind': 'bills'}, name='export_bills'),
+    path('export/prescriptions/', views.export_records, {'kind': 'prescriptions'}, name='export_prescriptions'),
+    path('export/inventory/', views.export_records, {'kind': 'inventory'}, name='export_inventory'),
+    path('revenue/', views.revenue_report, name='revenue_report'),
+    path('invoices/', views.invoice_archive, name='invoice_archive'),
+    path('search/', views.search_records, name='search_records'),
+    path('api/patient/dashboard/', views.api_patient_dashboard, name='api_patient_dashboard'),
+    path('api/doctor/dashboard/', views.api_doctor_dashboard, name='api_doctor_dashboard'),
+    path('api/doctor/appointments/', views.api_manage_appointments, name='api_manage_appointments'),
+    path('api/doctor/appointments/batch/', views.api_batch_appointments, name='api_batch_appointments'),
+    path('api/availability/', views.api_free_slots, name='api_free_slots'),
+    path('metrics', views.metrics, name='metrics'),
 ]
     
@@ -0,0 +1,100 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import AnonymousUser, User
+from django.utils.crypto import constant_time_compare
+
+from .roles import ROLE_MODELS, load_profile
+
+# Per-process LRU cache of authenticated users and their role profiles, so
+# a request with a cached session reaches the view without a query. Entries
+# are keyed by user id and every hit is still checked against the session's
+# auth hash, as Django does. Signals drop an entry when its user or profile
+# changes or the user logs out; changes made by other processes show up once
+# the entry expires (USER_CACHE_TIMEOUT seconds).
+
+
+class Entry:
+    __slots__ = ('user', 'backend', 'expires', 'profile')
+
+    def __init__(self, user, backend, expires):
+        self.user = user
+        self.backend = backend
+        self.expires = expires
+        self.profile = None
+
+
+class UserCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id, user, backend):
+        entry = Entry(copy.copy(user), backend, time.monotonic() + settings.USER_CACHE_TIMEOUT)
+        with self.lock:
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > settings.USER_CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+users = UserCache()
+
+
+def get_user(request):
+    # Drop-in for django.contrib.auth.get_user()
+    try:
+        user_id = User._meta.pk.to_python(request.session[SESSION_KEY])
+        backend = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if settings.USER_CACHE_TIMEOUT:
+        entry = users.get(user_id)
+        if entry is not None and entry.backend == backend:
+            session_hash = request.session.get(HASH_SESSION_KEY)
+            if session_hash and constant_time_compare(session_hash, entry.user.get_session_auth_hash()):
+                # A copy, so changes a view makes to request.user stay in the request
+                return copy.copy(entry.user)
+    # Not cached, or a session the cached user does not verify: Django's own
+    # lookup handles fallback secrets and flushes stale sessions
+    user = auth.get_user(request)
+    if user.is_authenticated and settings.USER_CACHE_TIMEOUT:
+        users.put(user_id, user, backend)
+    return user
+
+
+def get_profile(user, role, profile_id):
+    entry = users.get(user.pk)
+    cached = entry.profile if entry is not None else None
+    if cached is not None and isinstance(cached, ROLE_MODELS[role]) and cached.pk == profile_id:
+        profile = copy.copy(cached)
+        profile.user = user
+        return profile
+    profile = load_profile(user, role, profile_id)
+    if entry is not None and profile is not None:
+        entry.profile = copy.copy(profile)
+    return profile
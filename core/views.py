@@ -1,12 +1,39 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth import login, authenticate, logout
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
-from .models import Patient, Doctor, Staff, Appointment, Billing, Inventory, Prescription
-from .forms import UserRegistrationForm, PatientForm, DoctorForm, StaffForm, AppointmentForm, PrescriptionForm, InventoryForm, BillingForm
-from datetime import datetime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.static import serve
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.utils import timezone
+from django.template.defaultfilters import pluralize
+from django.utils.cache import patch_cache_control
+from .models import Patient, Doctor, Staff, Appointment, Billing, Inventory, Prescription, DailyRevenue
+from .forms import UserRegistrationForm, PatientForm, DoctorForm, StaffForm, AppointmentForm, PrescriptionForm, InventoryForm, BillingForm, ExportFilterForm, InventoryImportForm, DateRangeForm, InventoryDetailsForm, InventoryMovementForm, AvailabilityForm, RescheduleForm, BatchActionForm, SLOT_TAKEN, slot_taken_error
+from datetime import datetime, timedelta
+import io
 from django.contrib import messages
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from .query_budget import query_budget
+from .pagination import keyset_paginate
+from .roles import DASHBOARDS, remember_role
+from .doctor_choices import get_doctor_choices, get_specialties
+from .dashboard_cache import dashboard_context, fragment_is_cached, get_dashboard_version
+from .async_dashboards import async_login_required, gather_queries, run_sync
+from .exports import FORMATS, export_stream
+from .inventory_import import import_inventory_csv
+from .inventory import InsufficientStock, record_movement, record_opening_stock
+from . import invoices, search
+from .etags import rows_etag
+from .availability import SlotTaken, book_slot, free_slots
+from .appointment_batch import OK, STATUS_ACTIONS, apply_batch
+from .metrics import registry
+from .jobs import enqueue
+from .bills import bill_description
 
 # Home page
 def home(request):
@@ -45,21 +72,13 @@ def login_view(request):
     if request.method == 'POST':
         form = AuthenticationForm(request, request.POST)
         if form.is_valid():
-            username = form.cleaned_data.get('username')
-            password = form.cleaned_data.get('password')
-            user = authenticate(username=username, password=password)
-            if user is not None:
-                login(request, user)
-                # Redirect to appropriate dashboard based on user role
-                if hasattr(user, 'patient'):
-                    return redirect('patient_dashboard')
-                elif hasattr(user, 'doctor'):
-                    return redirect('doctor_dashboard')
-                elif hasattr(user, 'staff'):
-                    return redirect('staff_dashboard')
-            else:
-                # Handle invalid login details
-                return render(request, 'login.html', {'form': form, 'invalid_creds': True})
+            # is_valid() already authenticated (and hashed the password once)
+            user = form.get_user()
+            login(request, user)
+            # Redirect to appropriate dashboard based on user role
+            role, _ = remember_role(user)
+            if role is not None:
+                return redirect(DASHBOARDS[role])
     else:
         form = AuthenticationForm()
     
@@ -73,46 +92,61 @@ def logout_view(request):
 
 # Patient dashboard
 @login_required
+@query_budget(3)
 def patient_dashboard(request):
-    if hasattr(request.user, 'patient'):
-        patient = request.user.patient
-        # Fetch appointments, prescriptions, and bills for the patient
-        appointments = Appointment.objects.filter(patient=patient)
-        prescriptions = Prescription.objects.filter(patient=patient)
-        bills = Billing.objects.filter(patient=patient)
-
+    if request.role == 'patient':
+        patient_id = request.profile_id
         # Allow patient to delete prescriptions
         if request.method == 'POST':
             prescription_id = request.POST.get('prescription_id')
             prescription = get_object_or_404(Prescription, id=prescription_id)
-            if prescription.patient == patient:
+            if prescription.patient_id == patient_id:
                 prescription.delete()
                 return redirect('patient_dashboard')
 
-        return render(request, 'patient_dashboard.html', {'appointments': appointments, 'prescriptions': prescriptions, 'bills': bills})
+        return render(request, 'patient_dashboard.html', {**patient_dashboard_listings(patient_id), **dashboard_context(request)})
     return redirect('home')
 
+def patient_dashboard_listings(patient_id):
+    # Fetch appointments, prescriptions, and bills for the patient
+    return {
+        'appointments': Appointment.objects.filter(patient_id=patient_id).select_related('doctor__user'),
+        'prescriptions': Prescription.objects.filter(patient_id=patient_id).select_related('doctor__user'),
+        'bills': Billing.objects.filter(patient_id=patient_id),
+    }
+
+# Async variant for ASGI (see ASYNC_DASHBOARDS): the listings the template
+# renders are fetched concurrently
+@async_login_required
+@query_budget(3)
+async def patient_dashboard_async(request):
+    if request.role != 'patient' or request.method == 'POST':
+        return await run_sync(patient_dashboard, request)
+    context = {**patient_dashboard_listings(request.profile_id), **dashboard_context(request)}
+    if not fragment_is_cached('patient_dashboard', request.profile_id, context['dashboard_version']):
+        context['appointments'], context['bills'] = await gather_queries(
+            lambda: list(context['appointments']), lambda: list(context['bills']),
+        )
+    return await run_sync(render, request, 'patient_dashboard.html', context)
+
 # Doctor dashboard
 @login_required
+@query_budget(2)
 def doctor_dashboard(request):
-    if hasattr(request.user, 'doctor'):
-        doctor = request.user.doctor
-        appointments = Appointment.objects.filter(doctor=doctor)
-        return render(request, 'doctor_dashboard.html', {'appointments': appointments})
+    if request.role == 'doctor':
+        appointments = Appointment.objects.filter(doctor_id=request.profile_id).select_related('patient__user')
+        return render(request, 'doctor_dashboard.html', {'appointments': appointments, **dashboard_context(request)})
     return redirect('home')
 
 # Staff dashboard
 @login_required
+@query_budget(4)
 def staff_dashboard(request):
-    if hasattr(request.user, 'staff'):
-        staff_member = request.user.staff
+    if request.role == 'staff':
         # Fetch relevant data
-        inventories = Inventory.objects.all()
-        prescriptions = Prescription.objects.all()  # Staff can view all prescriptions
-        patients = Patient.objects.filter(staff=staff_member)
-        bills = Billing.objects.filter(patient__in=patients)
-        doctors = Doctor.objects.all()
-        staff = Staff.objects.all()
+        prescriptions = Prescription.objects.select_related('patient__user', 'doctor__user')  # Staff can view all prescriptions
+        patients = Patient.objects.filter(staff__id=request.profile_id)
+        bills = Billing.objects.filter(patient__in=patients).select_related('patient__user')
 
         # Handle delete bill request
         if request.method == 'POST':
@@ -122,133 +156,275 @@ def staff_dashboard(request):
                 bill.delete()
                 return redirect('staff_dashboard')
 
+        listings = {name: load() for name, load in staff_dashboard_listings(request).items()}
         return render(request, 'staff_dashboard.html', {
             'prescriptions': prescriptions,
-            'inventories': inventories,
-            'doctors': doctors,
-            'staff': staff,
             'patients': patients,
-            'bills': bills
+            'bills': bills,
+            **listings,
         })
     return redirect('home')
 
+def staff_dashboard_listings(request):
+    # Each listing pages independently, newest first
+    return {
+        'inventories': lambda: keyset_paginate(request, Inventory.objects.all(), ('date', 'id'), 'inventory'),
+        'doctors': lambda: keyset_paginate(request, Doctor.objects.select_related('user'), ('id',), 'doctors'),
+        'staff': lambda: keyset_paginate(request, Staff.objects.select_related('user'), ('id',), 'staff'),
+    }
+
+# Async variant for ASGI (see ASYNC_DASHBOARDS): the three listings are
+# paged concurrently
+@async_login_required
+@query_budget(4)
+async def staff_dashboard_async(request):
+    if request.role != 'staff' or request.method == 'POST':
+        return await run_sync(staff_dashboard, request)
+    listings = staff_dashboard_listings(request)
+    context = dict(zip(listings, await gather_queries(*listings.values())))
+    return await run_sync(render, request, 'staff_dashboard.html', context)
+
+def availability_search(filters, limit, max_doctors=None):
+    # (free slots, {doctor id: (name, specialty)}) for AvailabilityForm filters,
+    # over the first max_doctors doctors by name
+    doctors = {doctor_id: (name, specialty) for doctor_id, name, specialty in get_doctor_choices(filters.get('specialty') or None)}
+    if filters.get('doctor'):
+        doctor_id = filters['doctor'].pk
+        doctors = {doctor_id: doctors[doctor_id]} if doctor_id in doctors else {}
+    if max_doctors is not None:
+        doctors = dict(list(doctors.items())[:max_doctors])
+    day = filters.get('date_from') or timezone.localdate()
+    days = min(filters.get('days') or settings.AVAILABILITY_SEARCH_DAYS, settings.AVAILABILITY_MAX_DAYS)
+    start = max(timezone.now(), timezone.make_aware(datetime.combine(day, datetime.min.time())))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=days), datetime.min.time()))
+    return free_slots(doctors, start, end, limit), doctors
+
 # Book appointment view
 @login_required
+@query_budget(12)
 def book_appointment(request):
-    if hasattr(request.user, 'patient'):
+    if request.role == 'patient':
+        # Optional ?specialty= narrows the doctor list
+        specialty = request.GET.get('specialty') or None
         if request.method == 'POST':
-            form = AppointmentForm(request.POST)
+            form = AppointmentForm(request.POST, specialty=specialty)
             if form.is_valid():
                 appointment = form.save(commit=False)
-                appointment.patient = request.user.patient
-                appointment.save()
-                return redirect('patient_dashboard')
+                appointment.patient_id = request.profile_id
+                try:
+                    book_slot(appointment)
+                    return redirect('patient_dashboard')
+                except SlotTaken:
+                    # Lost a race for the slot since the form was validated
+                    form.add_error('date', slot_taken_error())
         else:
-            form = AppointmentForm()
-        return render(request, 'book_appointment.html', {'form': form})
+            form = AppointmentForm(specialty=specialty)
+        # The next free slots, each bookable with one click, once the patient
+        # picked a specialty, doctor or start date; a plain page load stays
+        # free of the search
+        filters = AvailabilityForm(request.GET)
+        searched = filters.is_valid() and any(filters.cleaned_data[name] for name in ('specialty', 'doctor', 'date_from'))
+        doctor_choices = get_doctor_choices(specialty)
+        free = []
+        if searched:
+            slots, doctors = availability_search(filters.cleaned_data, settings.AVAILABILITY_SLOTS, settings.AVAILABILITY_PAGE_DOCTORS)
+            free = [(slot, doctors[slot.doctor_id][0]) for slot in slots]
+        return render(request, 'book_appointment.html', {
+            'form': form, 'specialty': specialty, 'specialties': get_specialties(), 'free_slots': free,
+            'search_days': settings.AVAILABILITY_SEARCH_DAYS, 'searched': searched, 'filters': filters,
+            'doctor_choices': doctor_choices,
+            'more_doctors': searched and not filters.cleaned_data['doctor'] and len(doctor_choices) > settings.AVAILABILITY_PAGE_DOCTORS,
+            'page_doctors': settings.AVAILABILITY_PAGE_DOCTORS,
+        }, status=409 if form.has_error('date', 'slot_taken') else 200)
     return redirect('home')
 
 @login_required
 def delete_appointment(request, appointment_id):
-    appointment = get_object_or_404(Appointment, id=appointment_id)
+    appointment = get_object_or_404(Appointment.objects.select_related('patient', 'doctor'), id=appointment_id)
     
     # Check if the logged-in user is either the patient or the doctor of the appointment
-    if request.user == appointment.patient.user or (request.user == appointment.doctor.user and appointment.status == 'Completed'):
+    if request.user.id == appointment.patient.user_id or (request.user.id == appointment.doctor.user_id and appointment.status == 'Completed'):
         appointment.delete()
         messages.success(request, 'Appointment deleted successfully.')
-    elif hasattr(request.user, 'staff'):
+    elif request.role == 'staff':
         appointment.delete()
         messages.success(request, 'Appointment deleted successfully.')
     else:
         messages.error(request, 'You are not authorized to delete this appointment.')
 
     # Redirect based on the user's role
-    if hasattr(request.user, 'patient'):
-        return redirect('patient_dashboard')
-    elif hasattr(request.user, 'doctor'):
-        return redirect('doctor_dashboard')
-    elif hasattr(request.user, 'staff'):
-        return redirect('staff_dashboard')
-    else:
-        return redirect('home')
+    return redirect(DASHBOARDS.get(request.role, 'home'))
 
 
 @login_required
+@query_budget(8)
 def manage_appointments(request):
-    if hasattr(request.user, 'doctor'):
-        doctor = request.user.doctor
-        appointments = Appointment.objects.filter(doctor=doctor)
+    if request.role == 'doctor':
+        appointments = Appointment.objects.filter(doctor_id=request.profile_id).select_related('patient__user')
 
         if request.method == 'POST':
+            if 'appointment_ids' in request.POST or ':' in request.POST.get('action', ''):
+                run_batch_action(request)
+                return redirect('manage_appointments')
             appointment_id = request.POST.get('appointment_id')
-            appointment = get_object_or_404(Appointment, id=appointment_id)
+            appointment = get_object_or_404(Appointment, id=appointment_id, doctor_id=request.profile_id)
             action = request.POST.get('action')
 
+            if action == 'Reschedule':
+                form = RescheduleForm({'date': request.POST.get('new_date')}, instance=appointment)
+                if not form.is_valid():
+                    messages.error(request, form.errors['date'][0])
+                    return redirect('manage_appointments')
+                appointment.status = 'Rescheduled'
+                try:
+                    book_slot(appointment, update_fields=['date', 'status', 'updated_at'])
+                    messages.success(request, 'Appointment rescheduled successfully.')
+                except SlotTaken:
+                    messages.error(request, SLOT_TAKEN)
+                return redirect('manage_appointments')
+
+            message = None
             if action == 'Cancel':
                 appointment.status = 'Canceled'
-                messages.success(request, 'Appointment canceled successfully.')
-            elif action == 'Reschedule':
-                new_date_str = request.POST.get('new_date')
-                if new_date_str:
-                    try:
-                        new_date = datetime.fromisoformat(new_date_str)
-                        appointment.date = new_date
-                        appointment.status = 'Rescheduled'
-                        messages.success(request, 'Appointment rescheduled successfully.')
-                    except ValueError:
-                        messages.error(request, 'Invalid date format.')
+                message = 'Appointment canceled successfully.'
             elif action == 'Accept':
                 appointment.status = 'Accepted'
-                messages.success(request, 'Appointment accepted successfully.')
+                message = 'Appointment accepted successfully.'
             elif action == 'Complete':
                 appointment.status = 'Completed'
-                messages.success(request, 'Appointment marked as completed successfully.')
+                message = 'Appointment marked as completed successfully.'
 
-            appointment.save()
+            try:
+                with transaction.atomic():
+                    # Only the status: a reschedule racing this request keeps its date
+                    appointment.save(update_fields=['status', 'updated_at'])
+            except IntegrityError:
+                # Accepting a canceled appointment whose time was booked since
+                messages.error(request, SLOT_TAKEN)
+            else:
+                if message:
+                    messages.success(request, message)
             return redirect('manage_appointments')
 
-        return render(request, 'doctor_dashboard.html', {'appointments': appointments})
+        return render(request, 'doctor_dashboard.html', {'appointments': appointments, **dashboard_context(request)})
     return redirect('home')
 
 
+def batch_action(request):
+    # (action, [Outcome]) or (None, form errors) for a BatchActionForm post
+    form = BatchActionForm(request.POST)
+    if not form.is_valid():
+        return None, form.errors
+    data = form.cleaned_data
+    return data['action'], apply_batch(request.profile_id, data['action'], data['ids'], data['new_dates'])
+
+
+def run_batch_action(request):
+    action, outcomes = batch_action(request)
+    if action is None:
+        for error in outcomes.get('__all__', outcomes.get('action', [])):
+            messages.error(request, error)
+        return
+    done = sum(outcome.result == OK for outcome in outcomes)
+    if done:
+        messages.success(request, '%s %d appointment%s.' % (STATUS_ACTIONS.get(action, 'Rescheduled'), done, pluralize(done)))
+    for outcome in outcomes:
+        if outcome.result != OK:
+            messages.error(request, 'Appointment #%d: %s' % (outcome.id, outcome.message))
+
+
 # Add inventory view
 @login_required
 def add_inventory(request):
-    if hasattr(request.user, 'staff'):
+    if request.role == 'staff':
         if request.method == 'POST':
             form = InventoryForm(request.POST)
             if form.is_valid():
-                form.save()
+                with transaction.atomic():
+                    inventory = form.save()
+                    record_opening_stock(inventory, request.user)
                 return redirect('staff_dashboard')  # Redirect to staff dashboard
         else:
             form = InventoryForm()
         return render(request, 'add_inventory.html', {'form': form})
     return redirect('home')
 
-# Update inventory view
+# Bulk inventory upsert from an uploaded CSV
+@login_required
+def import_inventory(request):
+    if request.role != 'staff':
+        return redirect('home')
+    result = None
+    if request.method == 'POST':
+        form = InventoryImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            lines = io.TextIOWrapper(form.cleaned_data['file'].file, encoding='utf-8-sig', newline='')
+            try:
+                result = import_inventory_csv(lines)
+            except (ValueError, UnicodeDecodeError) as e:
+                form.add_error('file', str(e))
+    else:
+        form = InventoryImportForm()
+    return render(request, 'import_inventory.html', {'form': form, 'result': result})
+
+# Update inventory view: stock changes are recorded as ledger movements and
+# applied atomically, so concurrent updates never overwrite each other
 @login_required
 def update_inventory(request, id):
-    if hasattr(request.user, 'staff'):
+    if request.role == 'staff':
         inventory = get_object_or_404(Inventory, id=id)
+        details_form = InventoryDetailsForm(instance=inventory)
+        movement_form = InventoryMovementForm()
         if request.method == 'POST':
-            form = InventoryForm(request.POST, instance=inventory)
-            if form.is_valid():
-                form.save()
-                return redirect('staff_dashboard')  # Redirect to staff dashboard
-        else:
-            form = InventoryForm(instance=inventory)
-        return render(request, 'update_inventory.html', {'form': form})
+            if request.POST.get('action') == 'details':
+                details_form = InventoryDetailsForm(request.POST, instance=inventory)
+                if details_form.is_valid():
+                    # Only the edited fields, so a concurrent stock change is kept
+                    details_form.save(commit=False).save(update_fields=['item_name', 'date'])
+                    return redirect('staff_dashboard')  # Redirect to staff dashboard
+            else:
+                movement_form = InventoryMovementForm(request.POST)
+                if movement_form.is_valid():
+                    data = movement_form.cleaned_data
+                    try:
+                        record_movement(inventory.id, data['kind'], data['quantity'], request.user, data['note'])
+                    except InsufficientStock as e:
+                        movement_form.add_error('quantity', str(e))
+                    else:
+                        messages.success(request, 'Stock updated.')
+                        return redirect('update_inventory', id=inventory.id)
+        movements = inventory.movements.select_related('created_by').order_by('-id')[:20]
+        return render(request, 'update_inventory.html', {
+            'inventory': inventory,
+            'details_form': details_form,
+            'movement_form': movement_form,
+            'movements': movements,
+        })
     return redirect('home')
 
-login_required
+# Items at or below LOW_STOCK_THRESHOLD, lowest stock first
+@login_required
+@query_budget(1)
+def low_stock(request):
+    if request.role != 'staff':
+        return redirect('home')
+    threshold = settings.LOW_STOCK_THRESHOLD
+    items = keyset_paginate(
+        request, Inventory.objects.filter(quantity__lte=threshold), ('quantity', 'id'), 'low_stock', descending=False,
+    )
+    return render(request, 'low_stock.html', {'items': items, 'threshold': threshold})
+
+@login_required
+@query_budget(3)
 def view_prescriptions(request):
-    if hasattr(request.user, 'patient'):
-        prescriptions = Prescription.objects.filter(patient=request.user.patient)
-    elif hasattr(request.user, 'staff'):
-        prescriptions = Prescription.objects.all()
+    if request.role == 'patient':
+        prescriptions = Prescription.objects.filter(patient_id=request.profile_id).select_related('patient__user', 'doctor__user')
+    elif request.role == 'staff':
+        prescriptions = Prescription.objects.select_related('patient__user', 'doctor__user')
     else:
         return redirect('home')
 
+    prescriptions = keyset_paginate(request, prescriptions, ('created_at', 'id'), 'prescriptions')
     return render(request, 'view_prescriptions.html', {'prescriptions': prescriptions})
 
 
@@ -256,42 +432,44 @@ def delete_prescription(request, prescription_id):
     prescription = get_object_or_404(Prescription, id=prescription_id)
 
     # Check if the logged-in user is authorized to delete the prescription
-    if request.user == prescription.patient.user:
+    if request.role == 'patient' and prescription.patient_id == request.profile_id:
         prescription.delete()
         messages.success(request, 'Prescription deleted successfully.')
-    elif hasattr(request.user, 'doctor'):
-        if request.user == prescription.doctor.user:
+    elif request.role == 'doctor':
+        if prescription.doctor_id == request.profile_id:
             prescription.delete()
             messages.success(request, 'Prescription deleted successfully.')
-    elif hasattr(request.user, 'staff'):
+    elif request.role == 'staff':
         # Staff can delete any prescription, but it should not reflect for doctors or patients
         prescription.delete()
         messages.success(request, 'Prescription deleted successfully.')
 
     # Redirect to appropriate dashboard based on the user's role
-    if hasattr(request.user, 'patient'):
+    if request.role == 'patient':
         return redirect('view_prescriptions')
-    elif hasattr(request.user, 'staff'):
+    elif request.role == 'staff':
         return redirect('view_prescriptions_and_bills')
-    elif hasattr(request.user, 'doctor'):
-        return redirect('manage_prescriptions', patient_id=prescription.patient.id)
+    elif request.role == 'doctor':
+        return redirect('manage_prescriptions', patient_id=prescription.patient_id)
     else:
         return redirect('home')
     
 @login_required
 def generate_bill(request, prescription_id):
-    prescription = get_object_or_404(Prescription, id=prescription_id)
-    doctor = prescription.doctor
+    prescription = get_object_or_404(Prescription.objects.select_related('patient__user', 'doctor__user'), id=prescription_id)
 
     if request.method == 'POST':
         form = BillingForm(request.POST)
         if form.is_valid():
             billing_amount = form.cleaned_data['billing_amount']
 
-            # Save the billing information
-            bill = Billing(patient=prescription.patient, doctor=doctor, amount=billing_amount,
-                           date=datetime.now(), description=f"Bill generated for {prescription.patient.user.get_full_name()} by Dr. {doctor.user.get_full_name()}")
-            bill.save()
+            # Save the billing information; the revenue rollup is updated in
+            # the same transaction. The invoice is rendered by a job.
+            bill = Billing(patient=prescription.patient, doctor=prescription.doctor, amount=billing_amount, date=timezone.localdate(),
+                           description=bill_description(prescription.patient, prescription.doctor))
+            with transaction.atomic():
+                bill.save()
+                enqueue('render_invoice', key='render_invoice:%d' % bill.pk, bill_id=bill.pk)
 
             return redirect('view_prescriptions_and_bills')  # Redirect to view all prescriptions and bills after successful bill generation
     else:
@@ -300,10 +478,11 @@ def generate_bill(request, prescription_id):
     return render(request, 'generate_bill.html', {'form': form})
 
 @login_required
+@query_budget(3)
 def view_prescriptions_and_bills(request):
-    if hasattr(request.user, 'staff'):
-        prescriptions = Prescription.objects.all()
-        bills = Billing.objects.all()
+    if request.role == 'staff':
+        prescriptions = keyset_paginate(request, Prescription.objects.select_related('patient__user', 'doctor__user'), ('created_at', 'id'), 'prescriptions')
+        bills = keyset_paginate(request, Billing.objects.select_related('patient__user'), ('date', 'id'), 'bills')
     else:
         return redirect('home')
 
@@ -314,20 +493,21 @@ def delete_bill(request, bill_id):
     bill = get_object_or_404(Billing, id=bill_id)
 
     # Check if the logged-in user is staff or the patient associated with the bill
-    if hasattr(request.user, 'staff') or request.user == bill.patient.user:
+    if request.role == 'staff' or (request.role == 'patient' and bill.patient_id == request.profile_id):
         bill.delete()
 
     # Redirect based on the user's role
-    if hasattr(request.user, 'staff'):
+    if request.role == 'staff':
         return redirect('view_prescriptions_and_bills')
     else:
         return redirect('patient_dashboard')
 
 @login_required
+@query_budget(3)
 def manage_prescriptions(request, patient_id):
-    if hasattr(request.user, 'doctor'):
-        patient = get_object_or_404(Patient, id=patient_id)
-        prescriptions = Prescription.objects.filter(patient=patient, doctor=request.user.doctor)
+    if request.role == 'doctor':
+        patient = get_object_or_404(Patient.objects.select_related('user'), id=patient_id)
+        prescriptions = Prescription.objects.filter(patient=patient, doctor_id=request.profile_id)
         
         if request.method == 'POST':
             action = request.POST.get('action')
@@ -337,7 +517,7 @@ def manage_prescriptions(request, patient_id):
                 form = PrescriptionForm(request.POST)
                 if form.is_valid():
                     prescription = form.save(commit=False)
-                    prescription.doctor = request.user.doctor
+                    prescription.doctor_id = request.profile_id
                     prescription.patient = patient
                     prescription.save()
                     messages.success(request, 'Prescription created successfully.')
@@ -390,7 +570,7 @@ def delete_inventory(request, id):
 
 @login_required
 def add_doctor(request):
-    if hasattr(request.user, 'staff'):
+    if request.role == 'staff':
         if request.method == 'POST':
             user_form = UserRegistrationForm(request.POST)
             doctor_form = DoctorForm(request.POST)
@@ -410,7 +590,7 @@ def add_doctor(request):
     return redirect('home')
 
 def add_staff(request):
-    if hasattr(request.user, 'staff'):
+    if request.role == 'staff':
         if request.method == 'POST':
             user_form = UserRegistrationForm(request.POST)
             staff_form = StaffForm(request.POST)
@@ -441,4 +621,244 @@ def delete_staff(request, staff_id):
     if request.method == 'POST':
         staff.delete()
         return redirect('staff_dashboard')  # Redirect to the staff dashboard or any appropriate URL
-    return render(request, 'staff_delete', {'staff': staff})
\ No newline at end of file
+    return render(request, 'staff_delete', {'staff': staff})
+
+# Streaming CSV/NDJSON export of bills, prescriptions or inventory for staff
+@login_required
+@query_budget(1)  # filter validation only; the rows are read while streaming
+def export_records(request, kind):
+    if request.role != 'staff':
+        return redirect('home')
+    form = ExportFilterForm(request.GET, kind=kind)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text(), content_type='text/plain')
+    filters = form.cleaned_data
+    output_format = filters.pop('format')
+    response = StreamingHttpResponse(export_stream(kind, output_format, **filters), content_type=FORMATS[output_format][0])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (kind, output_format)
+    return response
+
+# Zip of the invoices of the bills in ?date_from=..?date_to= (optionally of
+# one ?doctor=), streamed as it is built (see core.invoices); without
+# ?download= the filter form is shown. Rendered in this process: forking a
+# pool from a threaded server can deadlock on locks other threads hold, so
+# the process pool is left to the render_invoices command.
+@login_required
+@query_budget(2)  # filter validation only; the bills are read while streaming
+def invoice_archive(request):
+    if request.role != 'staff':
+        return redirect('home')
+    form = DateRangeForm(request.GET)
+    if 'download' not in request.GET or not form.is_valid():
+        return render(request, 'invoices.html', {'form': form})
+    filters = form.cleaned_data
+    response = StreamingHttpResponse(invoices.invoice_archive(processes=1, **filters), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="invoices-%s-%s.zip"' % (
+        filters['date_from'] or 'start', filters['date_to'] or 'end',
+    )
+    return response
+
+# Revenue per day and per doctor, read from the DailyRevenue rollup only
+@login_required
+@query_budget(4)
+def revenue_report(request):
+    if request.role != 'staff':
+        return redirect('home')
+    form = DateRangeForm(request.GET)
+    filters = form.cleaned_data if form.is_valid() else {}
+    date_to = filters.get('date_to') or timezone.localdate()
+    date_from = filters.get('date_from') or date_to - timedelta(days=settings.REVENUE_REPORT_DAYS - 1)
+    rollup = DailyRevenue.objects.filter(date__range=(date_from, date_to))
+    if filters.get('doctor'):
+        rollup = rollup.filter(doctor=filters['doctor'])
+
+    totals = rollup.aggregate(bills=Sum('bill_count'), amount=Sum('total_amount'))
+    by_day = rollup.values('date').annotate(bills=Sum('bill_count'), amount=Sum('total_amount')).order_by('-date')
+    by_doctor = (
+        rollup.values('doctor_id', 'doctor__user__first_name', 'doctor__user__last_name', 'doctor__specialty')
+        .annotate(bills=Sum('bill_count'), amount=Sum('total_amount'))
+        .order_by('-amount')
+    )
+    return render(request, 'revenue_report.html', {
+        'form': form,
+        'date_from': date_from,
+        'date_to': date_to,
+        'totals': totals,
+        'by_day': by_day,
+        'by_doctor': by_doctor,
+    })
+
+
+# Staff full-text search; one FTS5 query plus one to name the patients of
+# matching prescriptions and bills
+@login_required
+@query_budget(2)
+def search_records(request):
+    if request.role != 'staff':
+        return redirect('home')
+    query = request.GET.get('q', '').strip()
+    kind = request.GET.get('kind', '')
+    if kind not in search.KINDS:
+        kind = ''
+    results = None
+    if query and search.search_available():
+        results = search.search(request, query, kind or None, settings.SEARCH_PAGE_SIZE)
+    return render(request, 'search.html', {
+        'query': query,
+        'kind': kind,
+        'kinds': list(search.KINDS),
+        'results': results,
+        'available': search.search_available(),
+    })
+
+
+# Read-only JSON versions of the dashboards for polling clients. Each
+# response carries a strong ETag (see core.etags); a poll with a matching
+# If-None-Match gets a 304 after one aggregate query. no-cache makes
+# clients revalidate every time instead of reusing a stale copy.
+APPOINTMENT_FIELDS = ('id', 'date', 'status', 'updated_at')
+
+
+def api_forbidden():
+    return JsonResponse({'error': 'Not allowed for this role'}, status=403)
+
+
+def patient_api_listings(request):
+    patient_id = request.profile_id
+    return (
+        Appointment.objects.filter(patient_id=patient_id).order_by('date', 'id'),
+        Prescription.objects.filter(patient_id=patient_id).order_by('-created_at', '-id'),
+        Billing.objects.filter(patient_id=patient_id).order_by('-date', '-id'),
+    )
+
+
+def patient_api_etag(request):
+    if request.role == 'patient':
+        return rows_etag(*patient_api_listings(request), version=get_dashboard_version('patient', request.profile_id))
+    return None
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@query_budget(4)
+@condition(etag_func=patient_api_etag)
+def api_patient_dashboard(request):
+    if request.role != 'patient':
+        return api_forbidden()
+    appointments, prescriptions, bills = patient_api_listings(request)
+    return JsonResponse({
+        'appointments': list(appointments.values(
+            *APPOINTMENT_FIELDS, 'doctor_id', first_name=F('doctor__user__first_name'), last_name=F('doctor__user__last_name'),
+        )),
+        'prescriptions': list(prescriptions.values('id', 'doctor_id', 'medicine', 'dosage', 'duration', 'created_at', 'updated_at')),
+        'bills': list(bills.values('id', 'doctor_id', 'amount', 'date', 'description', 'updated_at')),
+    })
+
+
+def doctor_api_appointments(request):
+    return Appointment.objects.filter(doctor_id=request.profile_id).order_by('date', 'id')
+
+
+def managed_api_appointments(request):
+    appointments = doctor_api_appointments(request)
+    status = request.GET.get('status')
+    if status:
+        appointments = appointments.filter(status=status)
+    return appointments
+
+
+def doctor_api_etag(request):
+    if request.role == 'doctor':
+        return rows_etag(doctor_api_appointments(request), version=get_dashboard_version('doctor', request.profile_id))
+    return None
+
+
+def managed_api_etag(request):
+    if request.role == 'doctor':
+        return rows_etag(managed_api_appointments(request), version=get_dashboard_version('doctor', request.profile_id))
+    return None
+
+
+def doctor_api_response(request, appointments):
+    if request.role != 'doctor':
+        return api_forbidden()
+    appointments = appointments(request).values(
+        *APPOINTMENT_FIELDS, 'patient_id', first_name=F('patient__user__first_name'), last_name=F('patient__user__last_name'),
+    )
+    return JsonResponse({'appointments': list(appointments)})
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@query_budget(2)
+@condition(etag_func=doctor_api_etag)
+def api_doctor_dashboard(request):
+    return doctor_api_response(request, doctor_api_appointments)
+
+
+# The listing manage_appointments acts on, optionally narrowed with ?status=
+@login_required
+@cache_control(private=True, no_cache=True)
+@query_budget(2)
+@condition(etag_func=managed_api_etag)
+def api_manage_appointments(request):
+    return doctor_api_response(request, managed_api_appointments)
+
+
+# Free appointment slots, earliest first, optionally narrowed with
+# ?specialty= or ?doctor= and starting at ?date_from= (default today) for
+# ?days=; ?limit= caps the number of slots (see core.availability)
+@login_required
+@query_budget(4)
+def api_free_slots(request):
+    form = AvailabilityForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    limit = min(form.cleaned_data['limit'] or settings.AVAILABILITY_SLOTS, settings.AVAILABILITY_MAX_SLOTS)
+    slots, doctors = availability_search(form.cleaned_data, limit)
+    return JsonResponse({'slots': [
+        {
+            'doctor_id': slot.doctor_id,
+            'doctor': doctors[slot.doctor_id][0],
+            'specialty': doctors[slot.doctor_id][1],
+            'start': slot.start,
+            'end': slot.end,
+        }
+        for slot in slots
+    ]})
+
+
+# One action on many of the doctor's appointments: POST the fields of
+# BatchActionForm; every appointment gets a result (ok, not_found, invalid
+# or conflict) in the order posted (see core.appointment_batch)
+@login_required
+@query_budget(8)
+def api_batch_appointments(request):
+    if request.role != 'doctor':
+        return api_forbidden()
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    action, outcomes = batch_action(request)
+    if action is None:
+        return JsonResponse({'errors': outcomes}, status=400)
+    return JsonResponse({'action': action, 'results': [outcome._asdict() for outcome in outcomes]})
+
+
+# Prometheus scrape target; this process's metrics only (see core.metrics)
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Files under STATIC_ROOT, for deployments without a web server in front
+# (SERVE_STATIC). Names from the collectstatic manifest carry a hash of the
+# content, so they may be cached forever; anything else is revalidated.
+def static_file(request, path):
+    response = serve(request, path, document_root=settings.STATIC_ROOT)
+    hashed_names = getattr(staticfiles_storage, 'hashed_files', {}).values()
+    if response.status_code in (200, 304) and path in hashed_names:
+        patch_cache_control(response, public=True, max_age=settings.STATIC_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
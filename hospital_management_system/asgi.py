@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hospital_management_system.settings')
+# Serve the dashboards from the async views that query concurrently
+os.environ.setdefault('HMS_ASYNC_DASHBOARDS', '1')
 
 application = get_asgi_application()
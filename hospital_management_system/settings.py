@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -27,6 +28,13 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
+# Rendering profile, picked with HMS_RENDER_PROFILE. 'production' caches
+# compiled templates for the life of the process, serves static files under
+# content-hashed names with far-future cache headers (run collectstatic
+# first) and compresses responses. 'development' picks up template and CSS
+# edits without a restart.
+RENDER_PROFILE = os.environ.get('HMS_RENDER_PROFILE', 'development' if DEBUG else 'production')
+
 
 # Application definition
 
@@ -41,11 +49,14 @@ INSTALLED_APPS = [
 ]
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.AuthenticationMiddleware',
+    'core.middleware.RoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -54,7 +65,8 @@ ROOT_URLCONF = 'hospital_management_system.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render time recorded for /metrics
+        'BACKEND': 'core.metrics.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -68,19 +80,146 @@ TEMPLATES = [
     },
 ]
 
+if RENDER_PROFILE == 'production':
+    # Explicit loaders rather than APP_DIRS, so they can be wrapped in the
+    # cached loader
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'hospital_management_system.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# HMS_DB_PROFILE selects the backend: 'sqlite' (default) or 'postgresql'.
+# Both keep connections open for HMS_CONN_MAX_AGE seconds and check them
+# before reuse.
+
+DB_PROFILE = os.environ.get('HMS_DB_PROFILE', 'sqlite')
+CONN_MAX_AGE = int(os.environ.get('HMS_CONN_MAX_AGE', '60'))
+
+if DB_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('HMS_DB_NAME', 'hospital'),
+            'USER': os.environ.get('HMS_DB_USER', ''),
+            'PASSWORD': os.environ.get('HMS_DB_PASSWORD', ''),
+            'HOST': os.environ.get('HMS_DB_HOST', ''),
+            'PORT': os.environ.get('HMS_DB_PORT', ''),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+elif DB_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('HMS_SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is locked"
+                'timeout': float(os.environ.get('HMS_SQLITE_BUSY_TIMEOUT', '20')),
+            },
+            # Tests run on a file rather than in memory: an in-memory database
+            # shared between threads fails concurrent writes outright instead
+            # of waiting for the lock, which the booking stress test relies on
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        }
     }
+else:
+    raise ValueError('Unknown HMS_DB_PROFILE %r; use sqlite or postgresql' % DB_PROFILE)
+
+# Pragmas run on every new SQLite connection (see core.signals); only
+# per-connection ones belong here. synchronous=NORMAL is safe under WAL and
+# skips an fsync per commit. Set HMS_SQLITE_PRAGMAS=0 for SQLite's defaults.
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative: KiB rather than pages
+    'temp_store': 'MEMORY',
+} if os.environ.get('HMS_SQLITE_PRAGMAS', '1') != '0' else {}
+
+# Journal mode stored in the database file itself, so it is switched once
+# per deployment with `manage.py sqlite_journal_mode` rather than on every
+# connection. WAL lets readers proceed while a write is in progress.
+SQLITE_JOURNAL_MODE = os.environ.get('HMS_SQLITE_JOURNAL_MODE', 'WAL')
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'default',
+    },
+    # Rendered dashboard fragments; point at a shared backend (Redis,
+    # Memcached) when running several processes
+    'dashboard': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'dashboard',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Sessions for the cache and cached_db engines; must be shared (Redis,
+    # Memcached) when running several processes, or a logout in one process
+    # leaves the session alive in the others
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
 }
 
+# Session storage, picked with HMS_SESSION_ENGINE:
+# db             a query per request
+# cached_db      cache reads, written through to the database (default)
+# cache          cache only; sessions are lost when the cache is
+# signed_cookies no server state, so sessions cannot be ended server side
+SESSION_ENGINE_CHOICES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINE_CHOICES[os.environ.get('HMS_SESSION_ENGINE', 'cached_db')]
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Per-process cache of authenticated users and their profiles (see
+# core.user_cache). Bounds how long a change made by another process (e.g. a
+# deactivated account) can go unnoticed; 0 turns the cache off.
+USER_CACHE_TIMEOUT = int(os.environ.get('HMS_USER_CACHE_TIMEOUT', '30'))
+USER_CACHE_MAX_ENTRIES = 1000
+DASHBOARD_CACHE_ALIAS = 'dashboard'
+DASHBOARD_CACHE_TIMEOUT = 600
+
+# Logins fetch the user's profile rows along with the user (see core.backends)
+AUTHENTICATION_BACKENDS = ['core.backends.ModelBackend']
+
+# Hasher for new passwords, picked with HMS_PASSWORD_HASHER; the others stay
+# listed so existing hashes keep verifying (and are rehashed on login).
+# argon2 and bcrypt need the argon2-cffi and bcrypt packages.
+PASSWORD_HASHER_CHOICES = {
+    'pbkdf2': 'core.hashers.PBKDF2PasswordHasher',
+    'argon2': 'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'bcrypt': 'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'scrypt': 'django.contrib.auth.hashers.ScryptPasswordHasher',
+}
+PASSWORD_HASHER = os.environ.get('HMS_PASSWORD_HASHER', 'pbkdf2')
+PASSWORD_HASHERS = [PASSWORD_HASHER_CHOICES[PASSWORD_HASHER]] + [
+    path for name, path in PASSWORD_HASHER_CHOICES.items() if name != PASSWORD_HASHER
+]
+
+# PBKDF2 work factor; Django 5.0's default is 720000. Each login costs one
+# hash, so this sets how many logins per second a core can serve.
+PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('HMS_PBKDF2_ITERATIONS', '720000'))
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -117,8 +256,113 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    # collectstatic writes each file under a name containing a hash of its
+    # content, so the files can be cached forever
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.ManifestStaticFilesStorage' if RENDER_PROFILE == 'production'
+            else 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        ),
+    },
+}
+
+# Serve STATIC_ROOT from Django itself (see core.views.static_file) rather
+# than a web server in front of it
+SERVE_STATIC = RENDER_PROFILE == 'production'
+
+# Seconds browsers may cache content-hashed static files
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Response compression: brotli when the brotli package is installed and the
+# client accepts it, else gzip. Smaller bodies are sent as they are.
+COMPRESSION_ENABLED = os.environ.get('HMS_COMPRESSION', '1' if RENDER_PROFILE == 'production' else '0') == '1'
+COMPRESSION_MIN_SIZE = 1024
+BROTLI_QUALITY = 5
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Raise instead of logging a warning when a view goes over its @query_budget
+QUERY_BUDGET_STRICT = False
+
+# Keyset pagination of staff listings; ?page_size= may override up to the max
+KEYSET_PAGE_SIZE = 25
+KEYSET_MAX_PAGE_SIZE = 200
+
+# Seconds a user's resolved role stays cached (also invalidated on change)
+ROLE_CACHE_TIMEOUT = 300
+
+# Rows fetched per database round trip (and lines per response chunk) by the
+# bill and prescription exports
+EXPORT_CHUNK_SIZE = 2000
+
+# Invoice archives (core.invoices): where rendered invoices are kept, worker
+# processes rendering them, bills per worker task, and archive bytes
+# collected before a chunk is streamed out
+INVOICE_CACHE_DIR = os.environ.get('HMS_INVOICE_CACHE_DIR', BASE_DIR / 'invoice_cache')
+INVOICE_PROCESSES = int(os.environ.get('HMS_INVOICE_PROCESSES', min(4, os.cpu_count() or 1)))
+INVOICE_CHUNK_SIZE = 200
+INVOICE_ARCHIVE_CHUNK_BYTES = 256 * 1024
+
+# Valid rows upserted per bulk write by the inventory CSV import
+INVENTORY_IMPORT_CHUNK_SIZE = 1000
+
+# Route the patient and staff dashboards to async views (asgi.py turns this
+# on; WSGI keeps the sync views, which are cheaper there)
+ASYNC_DASHBOARDS = os.environ.get('HMS_ASYNC_DASHBOARDS', '0') == '1'
+
+# Whether the async dashboards give each query its own thread and
+# connection; off runs them one after another on the shared sync thread
+DASHBOARD_CONCURRENT_QUERIES = True
+
+# Days shown by the revenue report when no date range is given
+REVENUE_REPORT_DAYS = 30
+
+# Items at or below this quantity are listed on the low stock page
+LOW_STOCK_THRESHOLD = 10
+
+# Results per page of staff search
+SEARCH_PAGE_SIZE = 25
+
+# Working hours of doctors without DoctorSchedule rows, as (weekday, start,
+# end, slot minutes) with Monday = 0; times are in TIME_ZONE
+DEFAULT_WORKING_HOURS = [(weekday, '09:00', '17:00', 30) for weekday in range(5)]
+
+# Days ahead the free slot search covers by default and at most, and the
+# slots it returns by default (also listed on the booking page) and at most
+AVAILABILITY_SEARCH_DAYS = 14
+AVAILABILITY_MAX_DAYS = 60
+AVAILABILITY_SLOTS = 20
+AVAILABILITY_MAX_SLOTS = 100
+# Doctors the booking page searches at most, the first by name; picking a
+# doctor searches just that one
+AVAILABILITY_PAGE_DOCTORS = 10
+
+# Appointments a doctor can act on with one batch action
+BATCH_ACTION_MAX_APPOINTMENTS = 200
+
+# Background jobs (core.jobs, run by manage.py run_workers): attempts per job,
+# seconds before the first retry (doubling after each further failure),
+# seconds after which a running job counts as abandoned, and seconds idle
+# workers wait before polling the queue again
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_TIMEOUT = 300
+JOB_POLL_INTERVAL = 1.0
+
+# Request metrics served at /metrics in the Prometheus text format, to the
+# listed client addresses only
+METRICS_ENABLED = os.environ.get('HMS_METRICS', '1') == '1'
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Requests taking at least this many milliseconds are logged, with their SQL,
+# to the core.metrics.slow logger (None turns the log off)
+SLOW_REQUEST_MS = 500
@@ -14,8 +14,13 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from core.views import static_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -23,3 +28,6 @@ urlpatterns = [
    
 ]
 
+if settings.SERVE_STATIC:
+    urlpatterns.append(re_path(r'^%s(?P<path>.*)$' % re.escape(settings.STATIC_URL.lstrip('/')), static_file, name='static_file'))
+